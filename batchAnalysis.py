@@ -0,0 +1,221 @@
+"""Offline analysis of saved sessions.
+
+`python batchAnalysis.py <data directory> ...` finds every session under the
+given directories (session directories and old .gz pickles, see
+sessionCatalog.findSessions), analyzes the ones it has not seen on a process
+pool and prints per-animal hit/FA rates, d', lick latencies and psychometric
+curves over force (from the varyForce sessions only).
+
+Per-session results are kept in a JSON-lines cache keyed by path. A session is
+only analyzed again when its files' mtime or size change; with --hash a changed
+session whose contents hash the same (copied or touched files) keeps its cached
+result. Session directories are analyzed from their header and trial index
+alone -- outcome, force and lick latency are written per trial -- so the
+sample streams are never read. Old pickles have to be loaded and scored from
+their traces.
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import performanceMetrics
+import sessionCatalog
+import sessionStorage
+import trialSchedule
+
+
+CACHE_FILE = os.path.join(os.getcwd(), r'analysis_cache.jsonl') ## next to the settings file, like the session catalog
+CACHE_VERSION = 3 ## bump when analyzeSession changes, so old results are recomputed
+LEGACY_DOWNSAMPLE = 10 ## old pickles saved with downSample on hold traces decimated by 10
+
+
+def _sessionFiles(path):
+    ## the files an analysis depends on
+    if os.path.isdir(path):
+        return [os.path.join(path, sessionStorage.HEADER_FILE), os.path.join(path, sessionStorage.INDEX_FILE)]
+    return [path]
+
+
+def signature(path):
+    """(mtime, size) of the session's files; a cached result is reused while this is unchanged."""
+    stats = [os.stat(fileName) for fileName in _sessionFiles(path) if os.path.exists(fileName)]
+    return [max(stat.st_mtime_ns for stat in stats), sum(stat.st_size for stat in stats)]
+
+
+def contentHash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    for fileName in _sessionFiles(path):
+        if not os.path.exists(fileName):
+            continue
+        with open(fileName, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _legacyTrials(session):
+    ## (result, lick latency, force) per trial, scored from the traces of an old pickle
+    taskParameters = session['taskParameters']
+    Fs = taskParameters['Fs'] / LEGACY_DOWNSAMPLE if taskParameters.get('downSample') else taskParameters['Fs'] ## rate of the saved traces
+    for trial, result in enumerate(session['results']):
+        ao = np.atleast_2d(session['ao_data'][trial])
+        force = float(np.abs(ao[1]).max()) * trialSchedule.MN_PER_VOLT if len(ao) > 1 else None
+        latency = None
+        licks = np.atleast_2d(session['di_data'][trial])[0]
+        tone = np.flatnonzero(np.atleast_2d(session['do_data'][trial])[0])
+        if result in ('hit', 'FA') and len(tone): ## the lick that decided the trial is the first one after tone onset
+            lickSamples = np.flatnonzero(licks[tone[0]:])
+            if len(lickSamples):
+                latency = lickSamples[0] / Fs
+        yield str(result), latency, force
+
+
+def analyzeSession(path):
+    """Outcome counts, rates, d', lick latencies and psychometric counts for one saved session."""
+    if sessionStorage.sessionPath(path):
+        header = sessionStorage.loadHeader(path)
+        taskParameters = header['taskParameters']
+        trials = ((t['result'], t.get('lickLatency'), t.get('force') if t.get('goTrial') else None)
+                  for t in sessionStorage.SessionReader(path).trials if t.get('result') in performanceMetrics.CODES)
+    else:
+        import compress_pickle
+        session = compress_pickle.load(path)
+        taskParameters = session['taskParameters']
+        trials = _legacyTrials(session)
+    varyForce = bool(taskParameters.get('varyForce'))
+    metrics = performanceMetrics.PerformanceMetrics(forceBins=performanceMetrics.FORCE_BINS)
+    hitLatencies = []
+    for result, latency, force in trials:
+        metrics.update(result, latency=latency, force=force if varyForce else None) ## fixed-force sessions stay out of the psychometric
+        if result == 'hit' and latency is not None:
+            hitLatencies.append(latency)
+    entry = sessionCatalog.makeEntry(path, taskParameters, dict(zip(performanceMetrics.OUTCOMES, metrics.counts.tolist())))
+    del entry['taskParameters'] ## the catalog has them; keep the cache small
+    entry.update({'varyForce': varyForce, 'hitRate': metrics.hitRate, 'FARate': metrics.FARate,
+                  'dprime': metrics.dprime, 'medianHitLatency': float(np.median(hitLatencies)) if hitLatencies else None,
+                  'latencySum': dict(zip(performanceMetrics.OUTCOMES, metrics.latencySum.tolist())),
+                  'latencyCount': dict(zip(performanceMetrics.OUTCOMES, metrics.latencyCount.tolist())),
+                  'forceTrials': metrics.forceTrials.tolist(), 'forceHits': metrics.forceHits.tolist()})
+    return entry
+
+
+def _analyze(path, knownHash, useHash):
+    ## runs in a worker process; never raises, so one bad file cannot take down the batch
+    try:
+        digest = contentHash(path) if useHash else None
+        if digest is not None and digest == knownHash:
+            return path, None, digest, None
+        return path, analyzeSession(path), digest, None
+    except Exception as e:
+        return path, None, None, repr(e)
+
+
+def loadCache(cacheFile=CACHE_FILE):
+    """{path: cache line} for every analyzed session; later lines replace earlier ones."""
+    cache = {}
+    if not os.path.isfile(cacheFile):
+        return cache
+    with open(cacheFile, 'r') as f:
+        for line in f:
+            try:
+                cached = json.loads(line)
+            except ValueError:
+                continue ## partially written line
+            if cached.get('version') == CACHE_VERSION:
+                cache[os.path.normcase(cached['path'])] = cached
+    return cache
+
+
+def analyzeDirectories(roots, cacheFile=CACHE_FILE, workers=None, useHash=False, log=print):
+    """Analysis results (see analyzeSession) for every session under roots, analyzing only new or changed sessions."""
+    cache = loadCache(cacheFile)
+    results = {}
+    stale = []
+    for root in roots:
+        for path in sessionCatalog.findSessions(root):
+            path = os.path.abspath(path)
+            key = os.path.normcase(path)
+            cached = cache.get(key)
+            current = signature(path)
+            if cached is not None and cached['signature'] == current:
+                results[key] = cached['result']
+            else:
+                stale.append((path, current, cached))
+    log('{} sessions cached, {} to analyze'.format(len(results), len(stale)))
+    if not stale:
+        return list(results.values())
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(stale) // (4 * workers)) ## amortize the inter-process round trips over thousands of small jobs
+    with open(cacheFile, 'a') as f, concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        jobs = pool.map(_analyze, [path for path, current, cached in stale],
+                        [cached.get('hash') if cached else None for path, current, cached in stale],
+                        [useHash] * len(stale), chunksize=chunksize)
+        for (path, current, cached), (_, result, digest, error) in zip(stale, jobs):
+            if error is not None:
+                log('skipping {}: {}'.format(path, error))
+                continue
+            if result is None: ## same contents as the cached result, only the file times changed
+                result = cached['result']
+            results[os.path.normcase(path)] = result
+            f.write(json.dumps({'version': CACHE_VERSION, 'path': path, 'signature': current, 'hash': digest, 'result': result},
+                               default=sessionStorage._jsonDefault) + '\n')
+        f.flush()
+    return list(results.values())
+
+
+def summarizeAnimals(sessions):
+    """Pool each animal's sessions: total counts, rates, d', mean latencies and psychometric curve."""
+    byAnimal = collections.defaultdict(list)
+    for session in sessions:
+        byAnimal[session['animal']].append(session)
+    summaries = {}
+    for animal, animalSessions in sorted(byAnimal.items(), key=lambda item: str(item[0])):
+        animalSessions.sort(key=lambda session: session['date'])
+        counts = {outcome: sum(session['counts'][outcome] for session in animalSessions) for outcome in performanceMetrics.OUTCOMES}
+        metrics = performanceMetrics.PerformanceMetrics(forceBins=performanceMetrics.FORCE_BINS)
+        metrics.counts[:] = [counts[outcome] for outcome in performanceMetrics.OUTCOMES]
+        metrics.latencySum[:] = [sum(session['latencySum'][outcome] for session in animalSessions) for outcome in performanceMetrics.OUTCOMES]
+        metrics.latencyCount[:] = [sum(session['latencyCount'][outcome] for session in animalSessions) for outcome in performanceMetrics.OUTCOMES]
+        metrics.forceTrials[:] = np.sum([session['forceTrials'] for session in animalSessions], axis=0)
+        metrics.forceHits[:] = np.sum([session['forceHits'] for session in animalSessions], axis=0)
+        edges, forceTrials, hitFractions = metrics.psychometric()
+        summaries[animal] = {'sessions': len(animalSessions), 'forceSessions': sum(session['varyForce'] for session in animalSessions),
+                             'trials': sum(counts.values()), 'counts': counts,
+                             'hitRate': metrics.hitRate, 'FARate': metrics.FARate, 'dprime': metrics.dprime,
+                             'hitLatency': metrics.meanLatency('hit'), 'FALatency': metrics.meanLatency('FA'),
+                             'psychometric': [(max(edge, 0), int(n), fraction) for edge, n, fraction in zip(edges, forceTrials, hitFractions) if n],
+                             'dprimeBySession': [(session['date'], session['dprime']) for session in animalSessions]}
+    return summaries
+
+
+def report(summaries):
+    lines = []
+    for animal, summary in summaries.items():
+        lines.append('{0}: {1} sessions, {2} trials, Hit Rate = {3:0.2f}, FA Rate = {4:0.2f}, d\' = {5:0.2f}, hit latency {6:0.0f} ms'.format(
+            animal, summary['sessions'], summary['trials'], summary['hitRate'], summary['FARate'], summary['dprime'],
+            summary['hitLatency']*1000))
+        if summary['psychometric']:
+            lines.append('\tpsychometric from {} varyForce sessions:'.format(summary['forceSessions']))
+        for lowerEdge, numTrials, hitFraction in summary['psychometric']:
+            lines.append('\t>= {0:0.0f} mN: {1:0.2f} hits ({2} trials)'.format(lowerEdge, hitFraction, numTrials))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('roots', nargs='+', help='directories to search for sessions')
+    parser.add_argument('--cache', default=CACHE_FILE)
+    parser.add_argument('--workers', type=int, default=None, help='analysis processes (default: one per cpu)')
+    parser.add_argument('--hash', action='store_true', help='reuse cached results for changed files whose contents hash the same')
+    parser.add_argument('--json', help='also write the per-animal summaries to this file')
+    args = parser.parse_args()
+    summaries = summarizeAnimals(analyzeDirectories(args.roots, args.cache, args.workers, args.hash))
+    print(report(summaries))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summaries, f, indent=2, default=sessionStorage._jsonDefault)
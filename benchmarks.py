@@ -0,0 +1,223 @@
+"""Benchmarks for the trial loop.
+
+Run all of them with `python benchmarks.py`, or pick some by name, e.g.
+`python benchmarks.py waveforms`.
+"""
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.signal
+
+import digitalEvents
+import downsampling
+import sessionStorage
+import simDaq
+import waveforms
+
+
+DEFAULT_PARAMETERS = {'Fs': 20000, 'trialDuration': 7., 'forceTime': 1., 'forceDuration': 3., 'timeToTone': 3.,
+                      'toneDuration': 0.02, 'rewardWindowDuration': 1., 'playTone': True, 'enablePunish': False,
+                      'abortEarlyLick': True, 'rewardAllGos': False, 'forceContinuous': False, 'force': 50.}
+
+
+def timeit(function, repeats):
+    times = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+    return np.median(times)
+
+
+def legacyWaveforms(taskParameters, force_volts):
+    ## the per-trial build runTrial used to do: fresh arrays, arange ramps and a python loop for the camera line
+    Fs = taskParameters['Fs']
+    numSamples = int(Fs * taskParameters['trialDuration'])
+    forceTime_samples = int(taskParameters['forceTime'] * Fs)
+    forceDuration_samples = int(taskParameters['forceDuration'] * Fs)
+    samplesToToneStart = int(forceTime_samples + taskParameters['timeToTone'] * Fs)
+    samplesToRewardEnd = int(samplesToToneStart + taskParameters['rewardWindowDuration'] * Fs)
+    ao_out = np.zeros([2,numSamples])
+    do_out = np.zeros([7,numSamples],dtype='bool')
+    do_out[0,samplesToToneStart:int(samplesToToneStart+taskParameters['toneDuration']*Fs)] = True
+    do_out[1,1:-1] = True
+    ao_out[1,:forceTime_samples] = np.arange(0,1,1/forceTime_samples) * force_volts
+    ao_out[1,forceTime_samples:forceTime_samples+forceDuration_samples] = force_volts
+    ao_out[1,forceTime_samples+forceDuration_samples:forceTime_samples+forceDuration_samples+forceTime_samples] = np.arange(1,0,-1/forceTime_samples) * force_volts
+    do_out[2,samplesToToneStart+50:samplesToRewardEnd] = True
+    do_out[4,forceTime_samples:samplesToToneStart] = True
+    cameraOnsets = np.int32(np.arange(0.01,taskParameters['trialDuration'],1/30)*Fs)
+    cameraOffsets = np.int32(cameraOnsets+0.005*Fs)
+    for on_off in zip(cameraOnsets,cameraOffsets):
+        do_out[5,on_off[0]:on_off[1]] = True
+    return ao_out, do_out
+
+
+def benchmarkWaveforms(rates=(20000, 50000, 100000), repeats=50):
+    print('Waveform build time per trial ({} s trials)'.format(DEFAULT_PARAMETERS['trialDuration']))
+    print('{:>10} {:>12} {:>12} {:>8}'.format('Fs (Hz)', 'legacy (ms)', 'cached (ms)', 'speedup'))
+    for Fs in rates:
+        taskParameters = dict(DEFAULT_PARAMETERS, Fs=Fs)
+        Fs_samples = lambda seconds: int(seconds * Fs)
+        forceTime_samples = Fs_samples(taskParameters['forceTime'])
+        samplesToToneStart = forceTime_samples + Fs_samples(taskParameters['timeToTone'])
+        builder = waveforms.WaveformBuilder()
+
+        def cached():
+            ao_out, do_out = builder.build(taskParameters, True, False, 1., forceTime_samples, Fs_samples(taskParameters['forceDuration']),
+                                           samplesToToneStart, samplesToToneStart + Fs_samples(taskParameters['toneDuration']),
+                                           samplesToToneStart + Fs_samples(taskParameters['rewardWindowDuration']))
+            builder.release(ao_out, do_out)
+
+        cached() ## fills the cache and the buffer pool
+        legacy = timeit(lambda: legacyWaveforms(taskParameters, 1.), repeats)
+        new = timeit(cached, repeats)
+        print('{:>10} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(Fs, legacy*1000, new*1000, legacy/new))
+
+
+def syntheticTrial(Fs=20000, trialDuration=7., seed=0):
+    ## raw int16 length/force traces (smooth command plus noise), a lick train and the output waveforms
+    random = np.random.default_rng(seed)
+    numSamples = int(Fs * trialDuration)
+    t = np.arange(numSamples) / Fs
+    command = np.clip(t - 1, 0, 1) * (t < 4) + np.clip(5 - t, 0, 1) * (t >= 4)
+    ai = np.stack([command * 8000 + random.normal(0, 20, numSamples),
+                   command * 12000 + random.normal(0, 40, numSamples)]).astype(np.int16)
+    licks = np.zeros(numSamples, dtype='bool')
+    for onset in np.int32(random.uniform(4, 5, 8) * Fs):
+        licks[onset:onset + int(0.03 * Fs)] = True
+    builder = waveforms.WaveformBuilder()
+    forceTime_samples = int(Fs)
+    ao_out, do_out = builder.build(dict(DEFAULT_PARAMETERS, Fs=Fs, trialDuration=trialDuration), True, False, 0.9,
+                                   forceTime_samples, 3 * forceTime_samples, 4 * forceTime_samples,
+                                   4 * forceTime_samples + int(0.02 * Fs), 5 * forceTime_samples)
+    return {'ai': ai, 'ao': ao_out, 'di_events': digitalEvents.toEvents(licks), 'do_events': digitalEvents.toEvents(do_out)}
+
+
+def benchmarkCodecs(numTrials=20):
+    trial = syntheticTrial()
+    rawBytes = sum(data.nbytes for data in trial.values()) * numTrials
+    print('Session write throughput and size, {} trials, {:0.1f} MB raw'.format(numTrials, rawBytes/1e6))
+    print('{:>8} {:>8} {:>10} {:>10} {:>7}'.format('codec', 'shuffle', 'write MB/s', 'read MB/s', 'ratio'))
+    directory = tempfile.mkdtemp()
+    try:
+        for codec in sessionStorage.CODECS:
+            for shuffle in (False, True):
+                path = os.path.join(directory, '{}_{}'.format(codec, shuffle))
+                t0 = time.perf_counter()
+                writer = sessionStorage.SessionWriter(path, {'channels': {}}, codec=codec, shuffle=shuffle)
+                for i in range(numTrials):
+                    writer.appendTrial(i, trial)
+                writer.close()
+                writeTime = time.perf_counter() - t0
+                t0 = time.perf_counter()
+                session = sessionStorage.SessionReader(path)
+                for i in range(numTrials):
+                    for name in trial:
+                        np.asarray(session.trial(i, name)).sum()
+                readTime = time.perf_counter() - t0
+                print('{:>8} {:>8} {:>10.0f} {:>10.0f} {:>7.2f}'.format(codec, str(shuffle), rawBytes/1e6/writeTime,
+                                                                     rawBytes/1e6/readTime, rawBytes/writer.bytesWritten))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmarkDownsampling(rates=(20000, 50000), channelCounts=(4, 16, 64), factor=10, repeats=5):
+    ## the legacy path is scipy.signal.decimate(x, factor, 0) per array: an IIR design per call, filtered forward and backward
+    ## filter quality: a 5 Hz signal plus noise above the new Nyquist frequency, which must not alias into the output
+    Fs = DEFAULT_PARAMETERS['Fs']
+    t = np.arange(int(Fs * DEFAULT_PARAMETERS['trialDuration'])) / Fs
+    signal = 1000 * np.sin(2 * np.pi * 5 * t)
+    noisy = signal + 300 * np.sin(2 * np.pi * 0.9 * Fs / 2 * t) + 300 * np.sin(2 * np.pi * 0.6 * Fs / factor * t)
+    middle = slice(len(t) // factor // 10, -len(t) // factor // 10) ## away from the trial edges
+    error = lambda out: np.sqrt(np.mean((out[middle] - signal[::factor][middle])**2))
+    print('Downsampling by {} ({} s trials, {} cpus); rms error on a 5 Hz signal with out-of-band noise: legacy {:0.2f}, zero-phase {:0.2f}, causal (delay removed) {:0.2f}'.format(
+        factor, DEFAULT_PARAMETERS['trialDuration'], os.cpu_count(), error(scipy.signal.decimate(noisy, factor, 0)),
+        error(downsampling.downsample(noisy, factor)),
+        error(np.roll(downsampling.downsample(noisy, factor, zeroPhase=False), -downsampling.describe(factor, False)['delay'] // factor))))
+    print('{:>8} {:>9} {:>12} {:>15} {:>12} {:>12} {:>8}'.format(
+        'Fs (Hz)', 'channels', 'legacy (ms)', 'zero-phase (ms)', 'causal (ms)', 'pooled (ms)', 'speedup'))
+    downsampler = downsampling.Downsampler(factor)
+    try:
+        for Fs in rates:
+            for numChannels in channelCounts:
+                x = np.random.default_rng(0).normal(0, 1000, (numChannels, int(Fs * DEFAULT_PARAMETERS['trialDuration'])))
+                halves = [x[:numChannels // 2], x[numChannels // 2:]] ## handed over as ai and ao
+                legacyTime = timeit(lambda: [scipy.signal.decimate(half, factor, 0) for half in halves], repeats)
+                zeroPhaseTime = timeit(lambda: downsampling.downsample(x, factor), repeats)
+                causalTime = timeit(lambda: downsampling.downsample(x, factor, zeroPhase=False), repeats)
+                pooledTime = timeit(lambda: downsampler.downsample(halves), repeats)
+                print('{:>8} {:>9} {:>12.1f} {:>15.1f} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(
+                    Fs, numChannels, legacyTime*1000, zeroPhaseTime*1000, causalTime*1000, pooledTime*1000, legacyTime/pooledTime))
+    finally:
+        downsampler.close()
+
+
+## the rest of what the GUI's updateParameters produces, for running whole sessions on the simulated daq
+SESSION_PARAMETERS = dict(DEFAULT_PARAMETERS, numTrials=20, downSample=False, falseAlarmTimeout=0., varyTone=False,
+                          goProbability=0.5, alternate=False, varyForce=False, save=True, animal='benchmark',
+                          continuous=False, earlyTermination=False, codec='none', shuffle=False, seed=0)
+
+
+def runSimulatedSession(taskParameters, speed=None, seed=0):
+    ## one runTask session against a simulated rig; returns runTask's summary, the device and the wall time
+    import controlPanel
+    device = simDaq.useDevice(simDaq.SimDevice(speed=speed, mouse=simDaq.SimMouse(seed=seed)))
+    tasks = controlPanel.setupDaq(dict(controlPanel.DEFAULT_SETTINGS), taskParameters,
+                                  'continuous' if taskParameters['continuous'] else 'task', backend=simDaq)
+    try:
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            summary = controlPanel.runTask(*tasks[:4], taskParameters, catalog=None)
+        wallTime = time.perf_counter() - t0
+    finally:
+        for task in tasks[:4]:
+            task.close()
+    return summary, device, wallTime
+
+
+def benchmarkTrialLoop(rates=(10000, 20000, 50000), durations=(2., 7.), sessionLengths=(20, 100), continuous=False):
+    ## speed=None runs the simulated hardware as fast as the loop consumes it, so everything
+    ## that is not acquisition shows up as overhead; in continuous mode use a real-time speed instead
+    import controlPanel ## imported up front so its module-level allocations don't count as memory growth
+    print('Trial loop on the simulated daq ({} mode)'.format('continuous' if continuous else 'finite'))
+    print('{:>8} {:>6} {:>7} {:>14} {:>10} {:>11} {:>11} {:>9}'.format(
+        'Fs (Hz)', 'dur', 'trials', 'overhead (ms)', 'gap (ms)', 'mem +(MB)', 'save (ms)', 'stall (s)'))
+    directory = tempfile.mkdtemp()
+    try:
+        for Fs in rates:
+            for duration in durations:
+                for numTrials in sessionLengths:
+                    taskParameters = dict(SESSION_PARAMETERS, Fs=Fs, trialDuration=duration, numTrials=numTrials,
+                                          continuous=continuous, earlyTermination=continuous, savePath=directory)
+                    tracemalloc.start()
+                    before = tracemalloc.get_traced_memory()[0]
+                    summary, device, wallTime = runSimulatedSession(taskParameters, speed=1. if continuous else None)
+                    memoryGrowth = tracemalloc.get_traced_memory()[0] - before
+                    tracemalloc.stop()
+                    runs = np.array(device.runs)
+                    acquisitionTime = np.sum(runs[:, 1] - runs[:, 0])
+                    ## time from one trial's hardware stopping to the next one starting
+                    gap = np.mean(runs[1:, 0] - runs[:-1, 1]) if len(runs) > 1 else np.nan
+                    print('{:>8} {:>6.1f} {:>7} {:>14.2f} {:>10.2f} {:>11.2f} {:>11.2f} {:>9.2f}'.format(
+                        Fs, duration, numTrials, (wallTime - acquisitionTime) / numTrials * 1000, gap * 1000,
+                        memoryGrowth / 1e6, summary['writeTime'] / numTrials * 1000, summary['stallTime']))
+                    shutil.rmtree(summary['session'])
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = {'waveforms': benchmarkWaveforms, 'codecs': benchmarkCodecs, 'downsampling': benchmarkDownsampling,
+              'trialLoop': benchmarkTrialLoop}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
+        print()
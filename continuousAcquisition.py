@@ -0,0 +1,283 @@
+"""Continuous acquisition mode.
+
+Instead of arming four finite tasks for every trial, the AI/DI tasks stream for
+the whole session into preallocated ring buffers (filled from an every-N-samples
+callback) and the AO/DO tasks are fed without regeneration by a feeder thread
+that writes idle blocks between trials. Trials are sample-indexed epochs cut out
+of the input stream, and the samples between trials are kept as well. With
+earlyTermination set, a trial is cut short as soon as its lick scorer has an
+outcome: the event lines (tone, reward, punish, ...) are cut, the force
+command ramps to where the next trial starts (to zero, or with forceContinuous
+to the next trial's first sample) and the next trial can follow once the
+Arduino listens again: after a reward or punishment (hit, FA) mainTask.ino
+ignores its inputs for 3 s and after an abort for 5 s, so the next trial is held
+back until that lockout has passed (see LOCKOUTS). Between trials the outputs
+hold the last force command written, as a finite AO task does.
+"""
+import queue
+import threading
+
+import numpy as np
+import nidaqmx.stream_readers
+from nidaqmx.constants import AcquisitionType, RegenerationMode
+
+import instrumentation
+import lickScoring
+import waveforms
+
+
+class RingBuffer:
+    """Fixed-size (channels x capacity) buffer addressed by absolute sample number.
+
+    write (on the daq callback thread) and read copy under the same lock, so a read
+    never returns samples that are overwritten while it copies them.
+    """
+
+    def __init__(self, numChannels, capacity, dtype='float64'):
+        self.data = np.zeros((numChannels, capacity), dtype=dtype)
+        self.capacity = capacity
+        self.totalWritten = 0
+        self._condition = threading.Condition()
+
+    def write(self, samples):
+        samples = np.asarray(samples).reshape(self.data.shape[0], -1)
+        total = n = samples.shape[1]
+        if n > self.capacity:
+            samples, n = samples[:, -self.capacity:], self.capacity
+        with self._condition:
+            start = (self.totalWritten + total - n) % self.capacity
+            first = min(n, self.capacity - start)
+            self.data[:, start:start + first] = samples[:, :first]
+            self.data[:, :n - first] = samples[:, first:]
+            self.totalWritten += total
+            self._condition.notify_all()
+
+    def waitFor(self, sampleNumber, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: self.totalWritten >= sampleNumber, timeout)
+
+    def read(self, start, stop):
+        """Copy samples [start, stop) out of the buffer; they must not have been overwritten yet."""
+        index = np.arange(start, stop) % self.capacity
+        with self._condition:
+            if start < self.totalWritten - self.capacity or stop > self.totalWritten:
+                raise IndexError('samples {}-{} are not in the buffer (have {}-{})'.format(
+                    start, stop, max(self.totalWritten - self.capacity, 0), self.totalWritten))
+            return self.data[:, index]
+
+
+OUTPUT_BUFFER = 0.2 ## s of output queued on the device; bounds how fast a trial can be cut short
+## s after the deciding lick during which mainTask.ino sits in delay() and ignores tone, reward and abort
+## lines; the 35 ms solenoid pulse and a little slack are added on top
+LOCKOUTS = {'hit': 3., 'FA': 3., 'abort': 5.}
+LOCKOUT_MARGIN = 0.1
+
+
+def setupContinuousTiming(ai_task, di_task, ao_task, do_task, Fs, clock_input, bufferSamples):
+    for task in (ai_task, di_task):
+        task.timing.cfg_samp_clk_timing(Fs, source=clock_input, sample_mode=AcquisitionType.CONTINUOUS,
+                                        samps_per_chan=bufferSamples)
+    for task in (ao_task, do_task):
+        task.timing.cfg_samp_clk_timing(Fs, source=clock_input, sample_mode=AcquisitionType.CONTINUOUS,
+                                        samps_per_chan=int(Fs*OUTPUT_BUFFER))
+        task.out_stream.regen_mode = RegenerationMode.DONT_ALLOW_REGENERATION
+
+
+class ContinuousAcquisition:
+    """Streams a whole session; startTrial/finishTrial match the finite-task trial loop."""
+
+    def __init__(self, ai_task, di_task, ao_task, do_task, Fs, trialSamples, blockSamples=None, streamReaders=nidaqmx.stream_readers,
+                 timer=instrumentation.NULL_TIMER):
+        self.ai_task, self.di_task, self.ao_task, self.do_task = ai_task, di_task, ao_task, do_task
+        self.timer = timer
+        self.blockSamples = blockSamples or int(Fs * 0.05)
+        capacity = 4 * trialSamples
+        ## unscaled int16 analog and port-byte lick samples, as in FiniteAcquisition
+        self.ai_buffer = RingBuffer(len(ai_task.channel_names), capacity, dtype=np.int16)
+        self.di_buffer = RingBuffer(len(di_task.channel_names), capacity, dtype=np.uint8)
+        self.ai_reader = streamReaders.AnalogUnscaledReader(ai_task.in_stream)
+        self.di_reader = streamReaders.DigitalSingleChannelReader(di_task.in_stream)
+        self.ai_chunk = np.empty((len(ai_task.channel_names), self.blockSamples), dtype=np.int16)
+        self.di_chunk = np.empty(self.blockSamples, dtype=np.uint8)
+        self.idle_ao = np.zeros((len(ao_task.channel_names), self.blockSamples)) ## repeats the last AO sample written
+        self.idle_do = np.zeros((len(do_task.channel_names), self.blockSamples), dtype='bool')
+        self.trials = queue.Queue()
+        self.samplesWritten = 0 ## output samples handed to the daq so far
+        self.lastEpochEnd = 0
+        self.running = False
+        self.firstTrial = None
+        self.error = None
+        ai_task.register_every_n_samples_acquired_into_buffer_event(self.blockSamples, self._readAnalog)
+        di_task.register_every_n_samples_acquired_into_buffer_event(self.blockSamples, self._readDigital)
+
+    def _readAnalog(self, task_handle, every_n_samples_event_type, number_of_samples, callback_data):
+        if number_of_samples != self.ai_chunk.shape[1]:
+            self.ai_chunk = np.empty((self.ai_chunk.shape[0], number_of_samples), dtype=np.int16)
+        self.ai_reader.read_int16(self.ai_chunk, number_of_samples_per_channel=number_of_samples)
+        self.ai_buffer.write(self.ai_chunk)
+        self.timer.count('samplesRead', self.ai_chunk.size)
+        return 0
+
+    def _readDigital(self, task_handle, every_n_samples_event_type, number_of_samples, callback_data):
+        if number_of_samples != self.di_chunk.shape[0]:
+            self.di_chunk = np.empty(number_of_samples, dtype=np.uint8)
+        self.di_reader.read_many_sample_port_byte(self.di_chunk, number_of_samples_per_channel=number_of_samples)
+        self.di_buffer.write(self.di_chunk)
+        self.timer.count('samplesRead', self.di_chunk.size)
+        return 0
+
+    def _writeBlock(self, ao_block, do_block):
+        with self.timer.span('writeOutputs'): ## includes waiting for room on the device
+            self.ao_task.write(ao_block)
+            self.do_task.write(do_block)
+        self.samplesWritten += ao_block.shape[1]
+        if not np.array_equal(ao_block[:, -1], self.idle_ao[:, 0]):
+            self.idle_ao[:] = ao_block[:, -1:]
+
+    def _feed(self):
+        ## keeps the output buffers topped up; writes block until there is room on the device
+        try:
+            if self.firstTrial is not None:
+                self._feedTrial(self.firstTrial, self.blockSamples)
+                self.firstTrial = None
+            while self.running:
+                try:
+                    trial = self.trials.get_nowait()
+                except queue.Empty:
+                    self._writeBlock(self.idle_ao, self.idle_do)
+                    continue
+                trial['startSample'] = self.samplesWritten
+                trial['started'].set()
+                self._feedTrial(trial)
+        except Exception as e:
+            self.error = e
+            self.running = False
+
+    def _restLevel(self, trial, level):
+        ## where a trial cut short leaves the force command: at rest, or with forceContinuous where the next
+        ## trial starts (the force stays on between go trials), else where it is now
+        if not trial['forceContinuous']:
+            return np.zeros_like(level)
+        upcoming = trial.get('upcoming')
+        if upcoming is not None and upcoming.done() and upcoming.exception() is None:
+            return upcoming.result()[0]['ao_out'][:, :1].copy()
+        return level
+
+    def _feedTrial(self, trial, firstSample=0):
+        for i in range(firstSample, trial['numSamples'], self.blockSamples):
+            if trial['terminate'].is_set() and i > 0:
+                ## ramp the force command to its rest level, end the trial's events and drop the rest of the trial
+                rampSamples = max(trial['forceTime_samples'], 1)
+                level = trial['ao_out'][:, i-1:i]
+                ao_ramp = level + (self._restLevel(trial, level) - level) * np.linspace(0, 1, rampSamples)
+                do_ramp = np.zeros((trial['do_out'].shape[0], rampSamples), dtype='bool')
+                remaining = trial['do_out'][:, i:i+rampSamples]
+                do_ramp[:, :remaining.shape[1]] = remaining ## trigger and camera run on through the ramp
+                do_ramp[list(waveforms.EVENT_LINES)] = False
+                do_ramp[waveforms.TRIGGER, -1] = False
+                for j in range(0, rampSamples, self.blockSamples):
+                    self._writeBlock(ao_ramp[:, j:j+self.blockSamples], do_ramp[:, j:j+self.blockSamples])
+                trial['ao_out'] = np.concatenate([trial['ao_out'][:, :i], ao_ramp], axis=1)
+                trial['do_out'] = np.concatenate([trial['do_out'][:, :i], do_ramp], axis=1)
+                trial['numSamples'] = trial['ao_out'].shape[1]
+                break
+            self._writeBlock(trial['ao_out'][:, i:i+self.blockSamples], trial['do_out'][:, i:i+self.blockSamples])
+        trial.pop('upcoming', None)
+        trial['written'].set()
+        ## a trial cut short at its outcome may end inside the Arduino's lockout; rest until it has passed
+        restUntil = trial['startSample'] + trial.get('restUntil', 0)
+        while self.running and self.samplesWritten < restUntil:
+            self._writeBlock(self.idle_ao, self.idle_do)
+
+    def start(self, firstTrial):
+        ## the first trial starts before the tasks do so its trigger pulse starts the input tasks
+        self._prepare(firstTrial)
+        firstTrial['startSample'] = 0
+        firstTrial['started'].set()
+        self._writeBlock(firstTrial['ao_out'][:, :self.blockSamples], firstTrial['do_out'][:, :self.blockSamples])
+        self.firstTrial = firstTrial
+        self.running = True
+        self.ai_task.start()
+        self.di_task.start()
+        self.ao_task.start()
+        self.do_task.start()
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+        self.feeder.start()
+
+    def _prepare(self, trial):
+        trial['started'] = threading.Event()
+        trial['written'] = threading.Event()
+        trial['terminate'] = threading.Event()
+
+    def startTrial(self, trial):
+        if not self.running and self.error is None:
+            self.start(trial)
+        else:
+            self._prepare(trial)
+            self.trials.put(trial)
+
+    def _waitEvent(self, event):
+        ## events the feeder sets; if the feeder has died (e.g. on an output underflow), raise its error instead
+        while not event.wait(timeout=1):
+            if self.error is not None:
+                raise self.error
+
+    def _waitFor(self, sampleNumber):
+        for ringBuffer in (self.ai_buffer, self.di_buffer):
+            while not ringBuffer.waitFor(sampleNumber, timeout=1):
+                if self.error is not None:
+                    raise self.error
+
+    def finishTrial(self, trial):
+        timer = self.timer
+        with timer.span('waitStart'):
+            self._waitEvent(trial['started'])
+        start = trial['startSample']
+        ## score the lick line as it streams in
+        scorer = trial['scorer']
+        chunk = max(int(lickScoring.SCORING_INTERVAL * trial['Fs']), 1)
+        with timer.span('acquire'):
+            while not scorer.decided and scorer.position < trial['numSamples']:
+                position = min(scorer.position + chunk, trial['numSamples'])
+                self.di_buffer.waitFor(start + position, timeout=1)
+                if self.error is not None:
+                    raise self.error
+                available = min(self.di_buffer.totalWritten - start, trial['numSamples'])
+                if available > scorer.position:
+                    with timer.span('score'):
+                        scorer.update(self.di_buffer.read(start + scorer.position, start + available)[0])
+        if scorer.decided:
+            trial['decidedAt'] = scorer.position / trial['Fs']
+            if trial['earlyTermination']:
+                if scorer.result in LOCKOUTS:
+                    trial['restUntil'] = scorer.lickSample + int((LOCKOUTS[scorer.result] + LOCKOUT_MARGIN) * trial['Fs'])
+                trial['terminate'].set()
+        with timer.span('waitDone'):
+            self._waitEvent(trial['written']) ## numSamples is final once the feeder is done with the trial
+            stop = start + trial['numSamples']
+            self._waitFor(stop)
+        with timer.span('readEpoch'):
+            ai_data = self.ai_buffer.read(start, stop)
+            di_data = self.di_buffer.read(start, stop)[0]
+            ## keep what was acquired between the previous trial and this one, as far back as both buffers
+            ## still hold it; a block of margin keeps the callbacks from overwriting the start before it is read
+            gapStart = max([self.lastEpochEnd] + [ringBuffer.totalWritten - ringBuffer.capacity + self.blockSamples
+                                                  for ringBuffer in (self.ai_buffer, self.di_buffer)])
+            gapStart = min(gapStart, start)
+            trial['ai_iti'] = self.ai_buffer.read(gapStart, start)
+            trial['di_iti'] = self.di_buffer.read(gapStart, start)[0]
+        self.lastEpochEnd = stop
+        return ai_data, di_data
+
+    def release(self, trial):
+        pass ## epochs are copied out of the ring buffers
+
+    def stop(self):
+        self.running = False
+        if hasattr(self, 'feeder'):
+            self.feeder.join()
+        for task in (self.do_task, self.ao_task, self.ai_task, self.di_task):
+            task.stop()
+        ## unregister so the same tasks can be used for another session
+        self.ai_task.register_every_n_samples_acquired_into_buffer_event(self.blockSamples, None)
+        self.di_task.register_every_n_samples_acquired_into_buffer_event(self.blockSamples, None)
@@ -1,16 +1,50 @@
-import nidaqmx
+import importlib
 import numpy as np
-import scipy.signal
-import matplotlib.pyplot as plt
 import time
-import compress_pickle as pickle
 from json import (load as jsonload, dump as jsondump)
 import os
-import PySimpleGUI as sg
+import sys
 import threading
-
+from concurrent.futures import ThreadPoolExecutor
+import sessionStorage
+import sessionCatalog
+import lickScoring
+import waveforms
+import digitalEvents
+import instrumentation
+import taskControl
+import performanceMetrics
+import trialSchedule
+import downsampling
+from performanceMetrics import dprime
+
+
+class LazyModule:
+    ## stands in for a module until the first attribute access imports it, so the GUI toolkit, plotting and
+    ## the daq driver only load when a window is opened or a daq task is made (see sessionRunner)
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+nidaqmx = LazyModule('nidaqmx')
+sg = LazyModule('PySimpleGUI')
+continuousAcquisition = LazyModule('continuousAcquisition')
+lickMonitor = LazyModule('lickMonitor')
+liveDisplay = LazyModule('liveDisplay')
 
 SETTINGS_FILE = os.path.join(os.getcwd(), r'settings_file.cfg') #os.path.dirname(__file__)
+
+def settingsFile(rig=None):
+    ## each rig on a multi-rig host keeps its own settings profile next to the default one
+    if rig is None:
+        return SETTINGS_FILE
+    return os.path.join(os.path.dirname(SETTINGS_FILE), 'settings_file_{}.cfg'.format(rig))
+
 DEFAULT_SETTINGS = {'lengthChannel_input': 'Dev2/ai0',
                     'forceChannel_input': 'Dev2/ai1',
                     'lengthChannel_output': 'Dev2/ao0',
@@ -24,7 +58,8 @@ DEFAULT_SETTINGS = {'lengthChannel_input': 'Dev2/ai0',
                     'punish_output': '/Dev2/port0/line1',
                     'lick_input': '/Dev2/port0/line7',
                     'clock_input': '/Dev2/PFI0',
-                    'trigger_input': '/Dev2/PFI1'
+                    'trigger_input': '/Dev2/PFI1',
+                    'lickCounter': 'Dev2/ctr0'
                    }
 # "Map" from the settings dictionary keys to the window's element keys
 SETTINGS_KEYS_TO_ELEMENT_KEYS = {'lengthChannel_input': '-LENGTH IN-',
@@ -40,14 +75,15 @@ SETTINGS_KEYS_TO_ELEMENT_KEYS = {'lengthChannel_input': '-LENGTH IN-',
                                  'punish_output': '-PUNISH OUT-',
                                  'lick_input': '-LICK IN-',
                                  'clock_input': '-CLOCK IN-',
-                                 'trigger_input': '-TRIGGER IN-'
+                                 'trigger_input': '-TRIGGER IN-',
+                                 'lickCounter': '-LICK COUNTER-'
                                 }
 
 ##################### Load/Save Settings File #####################
 def load_settings(settings_file, default_settings):
     try:
         with open(settings_file, 'r') as f:
-            settings = jsonload(f)
+            settings = dict(default_settings, **jsonload(f)) ## settings added since the file was saved get their defaults
     except Exception as e:
         sg.popup_quick_message(f'exception {e}', 'No settings file found... will create one for you', keep_on_top=True, background_color='red', text_color='white')
         settings = default_settings
@@ -89,6 +125,7 @@ def create_settings_window(settings):
                 [TextLabel('Lick Input'),sg.Input(key='-LICK IN-')],
                 [TextLabel('Clock Input'),sg.Input(key='-CLOCK IN-')],
                 [TextLabel('Trigger Input'),sg.Input(key='-TRIGGER IN-')],
+                [TextLabel('Lick Counter'),sg.Input(key='-LICK COUNTER-')],
                 [sg.Button('Save'), sg.Button('Exit')]  ]
 
     window = sg.Window('Settings', layout, keep_on_top=True, finalize=True)
@@ -103,27 +140,29 @@ def create_settings_window(settings):
 
 
 ##################### Set up DAQ tasks #####################
-def setupDaq(settings,taskParameters,setup='task'):
-    numSamples = int(taskParameters['Fs']*taskParameters['trialDuration'])
-    if setup == 'task':
-        ai_task = nidaqmx.Task()
+def streamReaders(task):
+    ## the stream_readers of the backend a task came from (nidaqmx, or simDaq for testing)
+    name = type(task).__module__.split('.')[0]
+    if name == 'nidaqmx':
+        return importlib.import_module('nidaqmx.stream_readers') ## a submodule nidaqmx itself does not import
+    return sys.modules[name].stream_readers
+
+
+def setupDaq(settings,taskParameters,setup='task',backend=nidaqmx):
+    ## backend is nidaqmx, or anything providing the same Task interface (see simDaq)
+    if setup in ('task', 'continuous'):
+        ai_task = backend.Task()
         ai_task.ai_channels.add_ai_voltage_chan(settings['lengthChannel_input'],name_to_assign_to_channel='length_in')
         ai_task.ai_channels.add_ai_voltage_chan(settings['forceChannel_input'],name_to_assign_to_channel='force_in')
-        ai_task.timing.cfg_samp_clk_timing(taskParameters['Fs'], source=settings['clock_input'], samps_per_chan=numSamples)
-        ai_task.triggers.start_trigger.cfg_dig_edge_start_trig(settings['trigger_input'])
 
-        di_task = nidaqmx.Task()
+        di_task = backend.Task()
         di_task.di_channels.add_di_chan(settings['lick_input'],name_to_assign_to_lines='lick')
-        di_task.timing.cfg_samp_clk_timing(taskParameters['Fs'], source=settings['clock_input'], samps_per_chan=numSamples)
-        di_task.triggers.start_trigger.cfg_dig_edge_start_trig(settings['trigger_input'])
 
-        ao_task = nidaqmx.Task()
+        ao_task = backend.Task()
         ao_task.ao_channels.add_ao_voltage_chan(settings['lengthChannel_output'],name_to_assign_to_channel='length_out')
         ao_task.ao_channels.add_ao_voltage_chan(settings['forceChannel_output'],name_to_assign_to_channel='force_out')
-        ao_task.timing.cfg_samp_clk_timing(taskParameters['Fs'], source=settings['clock_input'], samps_per_chan=numSamples)
-        ao_task.triggers.start_trigger.cfg_dig_edge_start_trig(settings['trigger_input'])
 
-        do_task = nidaqmx.Task()
+        do_task = backend.Task()
         do_task.do_channels.add_do_chan(settings['tone_output'],name_to_assign_to_lines='tone')
         do_task.do_channels.add_do_chan(settings['trigger_output'],name_to_assign_to_lines='trigger')
         do_task.do_channels.add_do_chan(settings['reward_output'],name_to_assign_to_lines='reward')
@@ -131,259 +170,548 @@ def setupDaq(settings,taskParameters,setup='task'):
         do_task.do_channels.add_do_chan(settings['abort_output'],name_to_assign_to_lines='abort')
         do_task.do_channels.add_do_chan(settings['camera_output'],name_to_assign_to_lines='camera')
         do_task.do_channels.add_do_chan(settings['punish_output'],name_to_assign_to_lines='punish')
-        do_task.timing.cfg_samp_clk_timing(taskParameters['Fs'], source=settings['clock_input'], samps_per_chan=numSamples)
+
+        configureTaskTiming((ai_task, di_task, ao_task, do_task), settings, taskParameters, setup)
+        for task in (ai_task, di_task, ao_task): ## do_task produces the trigger
+            task.triggers.start_trigger.cfg_dig_edge_start_trig(settings['trigger_input'])
         return (ai_task, di_task, ao_task, do_task, setup)
 
     elif setup == 'lickMonitor':
-        di_task = nidaqmx.Task()
-        di_task.di_channels.add_di_chan(settings['lick input'],name_to_assign_to_lines='lick')
-        di_task.timing.cfg_change_detection_timing(falling_edge_chan=settings['lick input'],
-            sample_mode = AcquisitionType.CONTINUOUS, samps_per_chan = 2)
-        return(di_task, setup)
+        di_task, ci_task = lickMonitor.setupLickMonitor(settings, backend)
+        return(di_task, ci_task, setup)
 
     elif setup == 'dispenseReward':
-        do_task = nidaqmx.Task()
+        do_task = backend.Task()
         do_task.do_channels.add_do_chan(settings['squirt_output'],name_to_assign_to_lines='squirt')
         do_task.timing.cfg_samp_clk_timing(taskParameters['Fs'], source=settings['clock_input'], samps_per_chan=100)
         return(do_task, setup)
 
+def configureTaskTiming(tasks, settings, taskParameters, setup='task'):
+    ## sample clock timing of the four trial tasks; can be redone on existing tasks when Fs or the trial length change
+    numSamples = int(taskParameters['Fs']*taskParameters['trialDuration'])
+    if setup == 'task': ## finite tasks, re-armed every trial
+        for task in tasks:
+            task.timing.cfg_samp_clk_timing(taskParameters['Fs'], source=settings['clock_input'], samps_per_chan=numSamples)
+    else: ## streaming for the whole session (see continuousAcquisition)
+        continuousAcquisition.setupContinuousTiming(*tasks, taskParameters['Fs'], settings['clock_input'], numSamples)
+
+
+class DaqPool:
+    ## Keeps every mode's tasks (see setupDaq) alive for the whole GUI session instead of rebuilding them
+    ## on every switch. Only the active mode holds its hardware: switching unreserves the outgoing tasks
+    ## and commits the incoming ones, so starting and stopping them afterwards is cheap. A mode's tasks
+    ## are only rebuilt (or, for the trial tasks, re-timed) when the parameters they were set up with change.
+    def __init__(self, settings, backend=nidaqmx):
+        self.settings = settings
+        self.backend = backend
+        self.configs = {} ## mode -> (configuration key, tasks)
+        self.active = None
+        self.lastSwitchTime = 0 ## s taken by the last acquire()
+
+    def _key(self, mode, taskParameters):
+        if mode in ('task', 'continuous'):
+            return (taskParameters['Fs'], int(taskParameters['Fs']*taskParameters['trialDuration']))
+        if mode == 'dispenseReward':
+            return (taskParameters['Fs'],) ## the squirt pulse is clocked at Fs
+        return () ## lickMonitor runs on change detection, whatever the session's Fs
+
+    def _control(self, mode, action):
+        for task in self.configs[mode][1]:
+            task.control(action)
+
+    def acquire(self, mode, taskParameters):
+        """The mode's tasks (setupDaq's return value without the mode), committed and ready to start."""
+        TaskMode = self.backend.constants.TaskMode
+        t0 = time.perf_counter()
+        key = self._key(mode, taskParameters)
+        if self.active is not None and self.active != mode:
+            self._control(self.active, TaskMode.TASK_UNRESERVE)
+            self.active = None
+        if mode in self.configs and self.configs[mode][0] != key:
+            if self.active == mode:
+                self._control(mode, TaskMode.TASK_UNRESERVE)
+                self.active = None
+            tasks = self.configs[mode][1]
+            if mode in ('task', 'continuous'):
+                configureTaskTiming(tasks, self.settings, taskParameters, mode)
+                self.configs[mode] = (key, tasks)
+            else:
+                for task in tasks:
+                    task.close()
+                del self.configs[mode]
+        if mode not in self.configs:
+            self.configs[mode] = (key, setupDaq(self.settings, taskParameters, mode, self.backend)[:-1])
+        if self.active != mode:
+            self._control(mode, TaskMode.TASK_COMMIT)
+            self.active = mode
+        self.lastSwitchTime = time.perf_counter() - t0
+        return self.configs[mode][1]
+
+    def close(self):
+        ## releases all hardware; the pool can still be used afterwards (e.g. with new settings)
+        for key, tasks in self.configs.values():
+            for task in tasks:
+                task.close()
+        self.configs = {}
+        self.active = None
+
 ##################### Define task functions #####################
-# global lastLickTime = time.time()
-# def monitorLicks(settings,taskParameters):
-#     global lastLickTime
-#     lastLickTime = time.time()
-#     di_task, daqStatus = setupDaq(settings,taskParameters,setup='lickMonitor')
-#     di_task.start()
-#     while time.time() - lastLickTime < taskParameters['lickTimeout']:  ## need to setup task parameters to include this
-#         di_task.register_signal_event(nidaqmx.constants.Signal.CHANGE_DETECTION_EVENT,callbackUpdateLickTime)
-#         print(lastLickTime)
-#     di_task.stop()
-#     di_task.close()
-#     return
-#
-# def callbackUpdateLickTime(task_handle,signal_type=nidaqmx.contansts.Signal.CHANGE_DETECTION_EVENT,callback_data):
-#     print('Callback function ran')
-#     global lastLickTime
-#     lastLickTime = datetime.now()
-#     return 0
-
-
-
-def runTask(ai_task, di_task, ao_task, do_task, taskParameters):
-
-    di_data = {} ## dictionary that saves digital inputs coming from the daq
-    ai_data = {} ## dictionary that saves analog inputs coming from the daq
-    do_data = {}
-    ao_data = {}
-    results = []
+def monitorLicks(pool, taskParameters, onLick=None):
+    ## standalone lick monitor (spout checks, habituation); see lickMonitor
+    di_task, ci_task = pool.acquire('lickMonitor', taskParameters)
+    monitor = lickMonitor.LickMonitor(di_task, ci_task, onLick=onLick, streamReaders=streamReaders(di_task))
+    monitor.start()
+    return monitor
+
+
+def runTask(ai_task, di_task, ao_task, do_task, taskParameters, display=None, control=None, status=None, catalog=sessionCatalog.CATALOG_FILE):
+    ## display: optional liveDisplay.DisplayFeed; it is only ever put to, so it cannot hold up the loop
+    ## control/status: optional taskControl.TaskControl and StatusBus; with a status bus, progress goes there instead of stdout
+    ## catalog: saved sessions are added to this sessionCatalog file (None to skip)
+    log = print if status is None else status.log
+    if status is not None:
+        status.post('state', state='running')
+
+    metrics = performanceMetrics.PerformanceMetrics(window=20, forceBins=FORCE_BINS if taskParameters['varyForce'] else None)
     originalProb = taskParameters['goProbability']
     taskParameters['toneDuration'] = 0.02 ## hard coding this because the actual duration is set by the arduino
+    schedule = trialSchedule.TrialSchedule(taskParameters.get('seed'))
+    taskParameters['seed'] = schedule.seed ## saved with the parameters, so the session can be replayed
+    log('Trial schedule seed {}'.format(schedule.seed))
     if taskParameters['save']:
-        fileName = '{}\\{}_{}.gz'.format(taskParameters['savePath'],time.strftime('%Y%m%d_%H%M%S'),
-                                                  taskParameters['animal'])
-    for trial in range(taskParameters['numTrials']):
-        print('On trial {} of {}'.format(trial+1,taskParameters['numTrials']))
-
-
-        ai_data[trial], di_data[trial], ao_data[trial], do_data[trial], result = runTrial(ai_task, di_task, ao_task, do_task, taskParameters)
-
-        results.append(result)
-        temp = np.array(results)
-        try:
-            hitRate = np.sum(temp=='hit')/(np.sum(temp=='hit')+np.sum(temp=='miss')+1)
-            FARate = np.sum(temp=='FA')/(np.sum(temp=='FA')+np.sum(temp=='CR')+1)
-            print('\tHit Rate = {0:0.2f}, FA Rate = {1:0.2f}, d\' = {2:0.2f}'.format(hitRate,FARate,dprime(hitRate,FARate)))
-        except ZeroDivisionError:
-            pass
-        if result == 'FA':
-            time.sleep(taskParameters['falseAlarmTimeout'])
-
-        last20 = temp[-20:]
-        FA_rate_last20 = np.sum(last20=='FA')/(np.sum(last20=='FA')+np.sum(last20=='CR'))
-        hitRate_last20 = np.sum(last20=='hit')/(np.sum(last20=='hit')+np.sum(last20=='miss'))
-        print('\tHit Rate Last 20 = {}; Total hits = {}'.format(hitRate_last20,np.sum(temp=='hit')))
-        ### these statements try to sculpt behavior during the task
-        if len(last20) == 20 and FA_rate_last20 > 0.9:
-            taskParameters['goProbability'] = 0
-            print('\t\tforced no-go trial')
+        sessionName = os.path.join(taskParameters['savePath'],'{}_{}'.format(time.strftime('%Y%m%d_%H%M%S'),
+                                                  taskParameters['animal']))
+        writer = sessionStorage.AsyncSessionWriter(sessionName, {'taskParameters': taskParameters,
+                                                            'channels': {'ai': ai_task.channel_names,
+                                                                         'di': di_task.channel_names,
+                                                                         'ao': ao_task.channel_names,
+                                                                         'do': do_task.channel_names},
+                                                            'scaling': {'ai': analogScaling(ai_task)},
+                                                            'downsampleFactor': downsampleFactor(taskParameters),
+                                                            'downsampleFilter': downsampling.describe(downsampleFactor(taskParameters), not taskParameters.get('causalFilter', False)) if taskParameters['downSample'] else None},
+                                                   codec=taskParameters.get('codec', 'none'), shuffle=taskParameters.get('shuffle', False))
+        sessionName = writer.path ## gets a suffix if another session already has this name
+        timer = instrumentation.TrialTimer(os.path.join(sessionName, instrumentation.LOG_FILE), enabled=taskParameters.get('instrument', False))
+        writer.timer = timer
+        trialSchedule.save(sessionName, schedule, taskParameters)
+        def saveTrial(trialNumber, trial, data, result): ## each trial is written once, on the writer thread
+            writer.appendTrial(trialNumber, data, onWritten=trial['release'], result=result, goTrial=trial['goTrial'], force=trial['force'],
+                               crutch=trial['crutch'], goProbability=trial['goProbability'], numSamples=trial['numSamples'], startSample=trial.get('startSample'),
+                               lickLatency=trial['scorer'].latency)
+    else:
+        saveTrial = None
+        timer = instrumentation.TrialTimer(enabled=taskParameters.get('instrument', False))
+    acquisition = pipeline = None
+    try:
+        if taskParameters.get('continuous'):
+            acquisition = continuousAcquisition.ContinuousAcquisition(ai_task, di_task, ao_task, do_task, taskParameters['Fs'],
+                                                                       int(taskParameters['Fs']*taskParameters['trialDuration']),
+                                                                       streamReaders=streamReaders(ai_task), timer=timer)
+        else:
+            acquisition = FiniteAcquisition(ai_task, di_task, ao_task, do_task, timer=timer)
+        if display is not None:
+            display.scaling = analogScaling(ai_task)
+            def onTrialProcessed(trialNumber, trial, data, result):
+                display.putTrial(trialNumber, trial, data, result)
+                if saveTrial is not None:
+                    saveTrial(trialNumber, trial, data, result)
+                else:
+                    trial['release']()
         else:
-            taskParameters['goProbability'] = originalProb
-
-        if taskParameters['save'] and trial % 50 == 0: ## save every fifty trials
-            outDict = {}
-
-            outDict['taskParameters'] = taskParameters
-            outDict['di_data'] = {**di_data}
-            outDict['di_channels'] = di_task.channel_names
-            outDict['ai_data'] = {**ai_data}
-            outDict['ai_channels'] = ai_task.channel_names
-            outDict['do_data'] = {**do_data}
-            outDict['do_channels'] = do_task.channel_names
-            outDict['ao_data'] = {**ao_data}
-            outDict['ao_channels'] = ao_task.channel_names
-            outDict['results'] = np.array(results)
-            pickle.dump(outDict,fileName)
-
-    print('\n\nTask Finished, {} rewards delivered\n'.format(np.sum(temp=='hit')))
+            onTrialProcessed = saveTrial
+        pipeline = TrialPipeline(acquisition, taskParameters, onTrialProcessed=onTrialProcessed, timer=timer, log=log, schedule=schedule)
+        trial = 0
+        while trial < taskParameters['numTrials']: ## numTrials can be changed during the session
+            log('On trial {} of {}'.format(trial+1,taskParameters['numTrials']))
+
+
+            trialInfo, result = pipeline.runTrial()
+
+            with timer.span('metrics'):
+                metrics.update(result, latency=trialInfo['scorer'].latency, force=trialInfo['force'])
+                log('\tHit Rate = {0:0.2f}, FA Rate = {1:0.2f}, d\' = {2:0.2f}'.format(metrics.hitRate,metrics.FARate,metrics.dprime))
+                if display is not None:
+                    display.putMetrics(trial, metrics)
+                if status is not None:
+                    status.post('trial', trial=trial, numTrials=taskParameters['numTrials'], result=result, metrics=metrics.snapshot())
+            if result == 'FA':
+                with timer.span('FATimeout'):
+                    time.sleep(taskParameters['falseAlarmTimeout'])
+
+            log('\tHit Rate Last 20 = {}; Total hits = {}'.format(metrics.windowHitRate,metrics.counts[performanceMetrics.HIT]))
+            if control is not None:
+                ## commands from the GUI are applied here, between trials, and only by this thread
+                taskParameters['goProbability'] = originalProb ## compare updates against the set value, not a sculpted one
+                changes = control.checkpoint(taskParameters, log, status)
+                if changes:
+                    originalProb = taskParameters['goProbability']
+                    pipeline.parametersChanged()
+                if control.stopRequested:
+                    timer.endTrial(trial, result=result)
+                    break
+            ### these statements try to sculpt behavior during the task
+            if metrics.windowFull and metrics.windowFARate > 0.9:
+                taskParameters['goProbability'] = 0
+                log('\t\tforced no-go trial')
+            else:
+                taskParameters['goProbability'] = originalProb
+            timer.endTrial(trial, result=result)
+            trial += 1
+    finally:
+        ## also when the session fails: stop the daq and the workers, and close the session so the trials
+        ## already written are marked complete
+        try:
+            if pipeline is not None:
+                pipeline.close()
+            elif acquisition is not None:
+                acquisition.stop()
+        finally:
+            taskParameters['goProbability'] = originalProb ## resetting here so the appropriate probability is saved
+            if taskParameters['save']:
+                writer.close(taskParameters=taskParameters, counts=metrics.snapshot()['counts'])
+    log('\n\nTask Finished, {} rewards delivered\n'.format(metrics.counts[performanceMetrics.HIT]))
+    if metrics.forceBins is not None:
+        for lowerEdge, numTrials, hitFraction in zip(*metrics.psychometric()):
+            if numTrials:
+                log('\t>= {0:0.0f} mN: {1:0.2f} hits ({2} trials)'.format(max(lowerEdge, 0), hitFraction, numTrials))
+    log(pipeline.report())
     ## saving data and results
-    taskParameters['goProbability'] = originalProb ## resetting here so the appropriate probability is saved
     if taskParameters['save']:
-        print('...saving data...\n')
-        outDict = {}
+        counts = metrics.snapshot()['counts']
+        trialSchedule.save(sessionName, schedule, taskParameters) ## again, in case numTrials or the plan's parameters changed
+        log(writer.report())
+        log('Data saved in {}\n'.format(sessionName))
+        if catalog is not None:
+            try:
+                sessionCatalog.record(sessionCatalog.makeEntry(sessionName, taskParameters, counts), catalog)
+            except OSError as e:
+                log('Could not add the session to the catalog: {!r}'.format(e))
+    timer.close() ## work still in flight when the loop ended is added to the last trial
+    if timer.enabled:
+        log(timer.summary())
+    ## summary for callers that run sessions programmatically (benchmarks, scripts)
+    summary = {'metrics': metrics.snapshot(), 'overlappedTime': pipeline.overlappedTime, 'timer': timer}
+    if taskParameters['save']:
+        summary.update(session=sessionName, writeTime=writer.writeTime, stallTime=writer.stallTime,
+                       bytesWritten=writer.writer.bytesWritten)
+    if status is not None:
+        status.post('state', state='finished')
+    return summary
+
 
-        outDict['taskParameters'] = taskParameters
-        outDict['di_data'] = {**di_data}
-        outDict['di_channels'] = di_task.channel_names
-        outDict['ai_data'] = {**ai_data}
-        outDict['ai_channels'] = ai_task.channel_names
-        outDict['do_data'] = {**do_data}
-        outDict['do_channels'] = do_task.channel_names
-        outDict['ao_data'] = {**ao_data}
-        outDict['ao_channels'] = ao_task.channel_names
-        outDict['results'] = np.array(results)
+def runTaskThread(tasks, taskParameters, display, control, status):
+    ## target of the GUI's task thread: the GUI always hears that the run ended, even if it failed
+    try:
+        runTask(*tasks, taskParameters, display=display, control=control, status=status)
+    except Exception as e:
+        status.log('Task stopped with an error: {!r}'.format(e))
+        status.post('error', text=repr(e))
+        status.post('state', state='finished')
+    finally:
+        status.close()
 
-        pickle.dump(outDict,fileName)
-        print('Data saved in {}\n'.format(fileName))
+DOWNSAMPLE_FACTOR = downsampling.DEFAULT_FACTOR ## applied to analog channels when downSample is on, unless downsampleFactor is set
 
-lastTrialGo = False
+def downsampleFactor(taskParameters):
+    return taskParameters.get('downsampleFactor', DOWNSAMPLE_FACTOR) if taskParameters['downSample'] else 1
 
-def runTrial(ai_task, di_task, ao_task, do_task, taskParameters):
+FORCE_BINS = performanceMetrics.FORCE_BINS
+defaultWaveformBuilder = waveforms.WaveformBuilder()
+defaultSchedule = trialSchedule.TrialSchedule() ## for runTrial; runTask seeds a schedule per session
+
+def buildTrial(taskParameters, waveformBuilder=defaultWaveformBuilder, schedule=defaultSchedule, trialNumber=None):
+    ## takes this trial's decisions from the schedule and makes its output waveforms; does not touch the daq
+    messages = []
     ## Calculated Parameters
     if taskParameters['varyTone']:
         timeToToneRange = (taskParameters['forceTime']+taskParameters['timeToTone'],taskParameters['forceTime']+taskParameters['forceDuration']-taskParameters['rewardWindowDuration'])
-        print('Time to tone range = {} to {} s'.format(timeToToneRange[0],timeToToneRange[1]))
+        messages.append('Time to tone range = {} to {} s'.format(timeToToneRange[0],timeToToneRange[1]))
     numSamples = int(taskParameters['Fs'] * taskParameters['trialDuration'])
     if taskParameters['varyForce']:
-        taskParameters['crutchForce'] = 75  ## add this to the GUI in the future
-        taskParameters['forceRange'] = [0.5, 50] ## add this to the GUI in the future
-        crutchTrial = np.random.binomial(1,0.25) ## crutch force applies to 25% of Go trials
-        if crutchTrial:
-            print('crutch trial')
-            force_volts = taskParameters['crutchForce']/53.869
-        else:
-            force_volts = (np.random.random_sample()*(taskParameters['forceRange'][1]-taskParameters['forceRange'][0]) + taskParameters['forceRange'][0])/53.869
-            print('{0:0.1f} mN trial'.format(force_volts*53.869))
-    else:
-        force_volts = taskParameters['force']/53.869
+        taskParameters['crutchForce'] = trialSchedule.CRUTCH_FORCE  ## add this to the GUI in the future
+        taskParameters['forceRange'] = list(trialSchedule.FORCE_RANGE) ## add this to the GUI in the future
+    previousGo = schedule.previousGo
+    decision = schedule.decide(taskParameters, trialNumber)
+    if taskParameters['varyForce']:
+        if decision['crutch']:
+            messages.append('crutch trial')
+        elif decision['goTrial']:
+            messages.append('{0:0.1f} mN trial'.format(decision['force']))
     forceTime_samples = int(taskParameters['forceTime'] * taskParameters['Fs'])
     forceDuration_samples = int(taskParameters['forceDuration'] * taskParameters['Fs'])
-    samplesToToneStart = int(forceTime_samples + taskParameters['timeToTone'] * taskParameters['Fs'])
-    samplesToToneEnd = int(samplesToToneStart + taskParameters['toneDuration'] * taskParameters['Fs'])
-    samplesToRewardEnd = int(samplesToToneStart + taskParameters['rewardWindowDuration'] * taskParameters['Fs'])
-    if taskParameters['varyTone']:
-        timeToTone = (timeToToneRange[1]-timeToToneRange[0])*np.random.random_sample()+timeToToneRange[0]
-        samplesToToneStart = int(timeToTone * taskParameters['Fs'])
-        samplesToToneEnd = int(samplesToToneStart + taskParameters['toneDuration'] * taskParameters['Fs'])
-        samplesToRewardEnd = int(samplesToToneStart + taskParameters['rewardWindowDuration'] * taskParameters['Fs'])
-
-    ## determining whether this trial is go or no-go
-    goTrial = np.random.binomial(1,taskParameters['goProbability'])
-    global lastTrialGo
-    if taskParameters['alternate']:
-        goTrial = not lastTrialGo
+    goTrial = decision['goTrial']
     ## setting up daq outputs
-    ao_out = np.zeros([2,numSamples])
-    do_out = np.zeros([7,numSamples],dtype='bool')
-    if taskParameters['playTone']:
-      do_out[0,samplesToToneStart:samplesToToneEnd] = True ## tone
-    do_out[1,1:-1] = True ## trigger (tells the intan system when to record and the non-DO nidaq tasks when to start)
-
-    if goTrial:
-        ao_out[1,:forceTime_samples] = np.arange(0,1,1/forceTime_samples) * force_volts
-        ao_out[1,forceTime_samples:forceTime_samples+forceDuration_samples] = force_volts
-        ao_out[1,forceTime_samples+forceDuration_samples:forceTime_samples+forceDuration_samples+forceTime_samples] = np.arange(1,0,-1/forceTime_samples) * force_volts
-
-        do_out[2,samplesToToneStart+50:samplesToRewardEnd] = True ## reward window
-        if taskParameters['rewardAllGos']:
-            do_out[3,samplesToToneStart+50:samplesToToneStart+150] = True  ## delivers reward via squirt
-    if not goTrial:
-        ao_out[1,:] = 0
-        if taskParameters['enablePunish']:
-            do_out[6,samplesToToneStart+50:samplesToRewardEnd] = True ## punish window
-            print('punishing FAs w/ NaCl')
-
-    if  taskParameters['forceContinuous']: ## overwriting force command so that it changes at the beginning of transition trials
-        if goTrial:
-            if not lastTrialGo:
-                ao_out[1,:forceTime_samples] = np.arange(0,1,1/forceTime_samples) * force_volts
-                ao_out[1,forceTime_samples:] = force_volts
-            else:
-                ao_out[1,:] = force_volts
-            do_out[2,samplesToToneStart:samplesToRewardEnd] = True ## reward window
-            if taskParameters['rewardAllGos']:
-                do_out[3,samplesToToneStart+50:samplesToToneStart+500] = True  ## delivers reward via squirt
-        if not goTrial:
-            if lastTrialGo:
-                ao_out[1,:forceTime_samples] = np.arange(1,0,-1/forceTime_samples) * force_volts
-                ao_out[1,forceTime_samples:] = 0
-            else:
-                ao_out[1,:] = 0
-
-    if taskParameters['abortEarlyLick']:
-        do_out[4,forceTime_samples:samplesToToneStart] = True
-
-    ## making camera trigger
-    cameraRate = 30 # Hz
-    cameraOnsets = np.int32(np.arange(0.01,taskParameters['trialDuration'],1/cameraRate)*taskParameters['Fs'])
-    cameraOffsets = np.int32(cameraOnsets+0.005*taskParameters['Fs'])
-    for on_off in zip(cameraOnsets,cameraOffsets):
-        do_out[5,on_off[0]:on_off[1]] = True
-
-    ## writing daq outputs onto device
-    do_task.write(do_out)
-    ao_task.write(ao_out)
-
-    ## starting tasks (make sure do_task is started last -- it triggers the others)
-    ai_task.start()
-    di_task.start()
-    ao_task.start()
-    do_task.start()
-    do_task.wait_until_done()
-
-    ## adding data to the outputs
-    ai_data = np.array(ai_task.read(numSamples))
-    di_data = np.array(di_task.read(numSamples))
-    ao_data = ao_out
-    do_data = do_out
-
-    ## stopping tasks
-    do_task.stop()
-    ao_task.stop()
-    ai_task.stop()
-    di_task.stop()
-
+    if not goTrial and taskParameters['enablePunish']:
+        messages.append('punishing FAs w/ NaCl')
+    ao_out, do_out = waveformBuilder.build(taskParameters, goTrial, previousGo, decision['force_volts'], forceTime_samples, forceDuration_samples,
+                                           decision['samplesToToneStart'], decision['samplesToToneEnd'], decision['samplesToRewardEnd'])
+
+    trial = {'goTrial': goTrial, 'force_volts': decision['force_volts'], 'force': decision['force'], 'crutch': decision['crutch'],
+             'trialNumber': decision['trialNumber'], 'numSamples': numSamples, 'Fs': taskParameters['Fs'],
+             'earlyTermination': taskParameters.get('earlyTermination', False), 'forceContinuous': taskParameters['forceContinuous'],
+             'forceTime_samples': forceTime_samples, 'samplesToToneStart': decision['samplesToToneStart'],
+             'samplesToRewardEnd': decision['samplesToRewardEnd'], 'ao_out': ao_out, 'do_out': do_out,
+             'goProbability': taskParameters['goProbability'], 'previousGo': previousGo,
+             'messages': messages, 'buffers': (ao_out, do_out)}
+    trial['scorer'] = lickScoring.OnlineLickScorer(trial, taskParameters['Fs'], taskParameters['abortEarlyLick'])
+    return trial
+
+
+RESULT_MESSAGES = {'abort': '\tTrial Aborted, early lick', 'hit': '\tHit', 'miss': '\tMiss',
+                   'FA': '\tFalse Alarm', 'CR': '\tCorrect Rejection'}
+
+def scoreTrial(di_data, trial, taskParameters, log=print):
+    ## the scorer has usually seen the lick line already (see finishTrial); feed it anything it missed
+    scorer = trial['scorer']
+    if scorer.position < len(di_data):
+        scorer.update(di_data[scorer.position:])
+    result = scorer.finish()
     ## printing trial result
-    if taskParameters['abortEarlyLick'] == True and sum(di_data[forceTime_samples:samplesToToneStart]) > 0:
-        print('\tTrial Aborted, early lick')
-        result = 'abort'
-        if goTrial == 1:
-            lastTrialGo = True
-        else:
-            lastTrialGo = False
+    if scorer.latency is not None:
+        log('{0}, lick latency = {1:0.3f} s'.format(RESULT_MESSAGES[result], scorer.latency))
     else:
-        if goTrial == 1:
-            if sum(di_data[samplesToToneStart:samplesToRewardEnd]) > 0:
-                print('\tHit')
-                result = 'hit'
+        log(RESULT_MESSAGES[result])
+    if 'decidedAt' in trial:
+        log('\tOutcome known {0:0.2f} s into the trial'.format(trial['decidedAt']))
+    return result
+
+
+def postProcessTrial(ai_data, di_data, trial, taskParameters, timer=instrumentation.NULL_TIMER, downsampler=None):
+    ## analog channels are downsampled (on downsampler's pool when given, see downsampling); digital lines are
+    ## kept as edge times at full resolution (see digitalEvents)
+    with timer.span('toEvents'):
+        data = {'ai': ai_data, 'ao': trial['ao_out'],
+                'di_events': digitalEvents.toEvents(di_data), 'do_events': digitalEvents.toEvents(trial['do_out'])}
+        if 'ai_iti' in trial:
+            data['ai_iti'], data['di_iti_events'] = trial['ai_iti'], digitalEvents.toEvents(trial['di_iti'])
+    if taskParameters['downSample']:
+        with timer.span('decimate'):
+            ## ai stays in raw int16 units; the filter error is well below one count
+            if downsampler is not None:
+                ai, data['ao'] = downsampler.downsample([ai_data, trial['ao_out']])
             else:
-                print('\tMiss')
-                result = 'miss'
-            lastTrialGo = True
+                factor, zeroPhase = downsampleFactor(taskParameters), not taskParameters.get('causalFilter', False)
+                ai, data['ao'] = (downsampling.downsample(ai_data, factor, zeroPhase),
+                                  downsampling.downsample(trial['ao_out'], factor, zeroPhase))
+            data['ai'] = np.clip(np.round(ai), -32768, 32767).astype(np.int16)
+    return data
+
+
+def analogScaling(ai_task):
+    ## polynomial coefficients (lowest order first) converting each channel's raw int16 samples to volts
+    return [list(channel.ai_dev_scaling_coeff) for channel in ai_task.ai_channels]
+
+
+class FiniteAcquisition:
+    ## per-trial start/stop of the four finite tasks. Samples are read unscaled (int16 analog, port
+    ## bytes for the lick line) by stream readers straight into pooled buffers; see analogScaling
+    def __init__(self, ai_task, di_task, ao_task, do_task, timer=instrumentation.NULL_TIMER):
+        self.ai_task, self.di_task, self.ao_task, self.do_task = ai_task, di_task, ao_task, do_task
+        self.timer = timer
+        self.ai_reader = streamReaders(ai_task).AnalogUnscaledReader(ai_task.in_stream)
+        self.di_reader = streamReaders(di_task).DigitalSingleChannelReader(di_task.in_stream)
+        self._pool = []
+        self._lock = threading.Lock()
+
+    def _buffers(self, numSamples):
+        with self._lock:
+            while self._pool:
+                ai_data, di_data = self._pool.pop()
+                if di_data.shape[0] == numSamples:
+                    return ai_data, di_data
+        return np.empty([len(self.ai_task.channel_names),numSamples],dtype=np.int16), np.empty(numSamples,dtype=np.uint8)
+
+    def release(self, trial):
+        ## hand the trial's input buffers back once nothing reads them any more
+        if 'inputBuffers' in trial:
+            with self._lock:
+                self._pool.append(trial.pop('inputBuffers'))
+
+    def startTrial(self, trial):
+        ## writing daq outputs onto device
+        with self.timer.span('writeOutputs'):
+            self.do_task.write(trial['do_out'])
+            self.ao_task.write(trial['ao_out'])
+
+        ## starting tasks (make sure do_task is started last -- it triggers the others)
+        with self.timer.span('startTasks'):
+            self.ai_task.start()
+            self.di_task.start()
+            self.ao_task.start()
+            self.do_task.start()
+
+    def finishTrial(self, trial):
+        timer = self.timer
+        numSamples = trial['numSamples']
+        ai_data, di_data = trial['inputBuffers'] = self._buffers(numSamples)
+        ## reading the lick line in small chunks while the trial runs so the outcome is known as it happens
+        chunk = max(int(lickScoring.SCORING_INTERVAL * trial['Fs']), 1)
+        with timer.span('acquire'):
+            for i in range(0, numSamples, chunk):
+                n = min(chunk, numSamples - i)
+                self.di_reader.read_many_sample_port_byte(di_data[i:i+n], number_of_samples_per_channel=n)
+                with timer.span('score'):
+                    trial['scorer'].update(di_data[i:i+n])
+                if trial['scorer'].decided and 'decidedAt' not in trial:
+                    trial['decidedAt'] = (i + n) / trial['Fs']
+        with timer.span('waitDone'):
+            self.do_task.wait_until_done()
+
+        ## adding data to the outputs
+        with timer.span('readAnalog'):
+            self.ai_reader.read_int16(ai_data, number_of_samples_per_channel=numSamples)
+        timer.count('samplesRead', ai_data.size + di_data.size)
+
+        ## stopping tasks
+        with timer.span('stopTasks'):
+            self.do_task.stop()
+            self.ao_task.stop()
+            self.ai_task.stop()
+            self.di_task.stop()
+        return ai_data, di_data
+
+    def stop(self):
+        ## normally a no-op; after a failed trial the tasks may still be running
+        for task in (self.do_task, self.ao_task, self.ai_task, self.di_task):
+            task.stop()
+
+
+def runTrial(ai_task, di_task, ao_task, do_task, taskParameters):
+    trial = buildTrial(taskParameters)
+    for message in trial['messages']:
+        print(message)
+    acquisition = FiniteAcquisition(ai_task, di_task, ao_task, do_task)
+    acquisition.startTrial(trial)
+    ai_data, di_data = acquisition.finishTrial(trial)
+    result = scoreTrial(di_data, trial, taskParameters)
+    data = postProcessTrial(ai_data, di_data, trial, taskParameters)
+    factor = downsampleFactor(taskParameters)
+    di_data = digitalEvents.eventsToDense(data['di_events'], 1, trial['numSamples'], factor)[0]
+    do_data = digitalEvents.eventsToDense(data['do_events'], waveforms.NUM_DO_LINES, trial['numSamples'], factor)
+    ai_data = sessionStorage.scaleAnalog(data['ai'], analogScaling(ai_task)) ## in volts, as ai_task.read returned them
+    return ai_data, di_data, data['ao'], do_data, result
+
+
+class TrialPipeline:
+    ## Runs trials back to back while overlapping the software work with acquisition: trial N+1's
+    ## waveforms are built while trial N is on the hardware, and trial N's downsampling and saving
+    ## happen on a second worker while trial N+1 runs. Post-processing runs on a single worker so
+    ## onTrialProcessed(trialNumber, trial, data, result) is called in trial order, where data is the
+    ## stream name -> array dict from postProcessTrial. data can share the trial's pooled buffers, so
+    ## onTrialProcessed must call trial['release']() once it no longer needs them.
+    def __init__(self, acquisition, taskParameters, onTrialProcessed=None, timer=instrumentation.NULL_TIMER, log=print, schedule=None):
+        self.acquisition = acquisition
+        self.schedule = schedule if schedule is not None else trialSchedule.TrialSchedule(taskParameters.get('seed'))
+        self.timer = timer
+        self.log = log
+        self.taskParameters = taskParameters
+        self.onTrialProcessed = onTrialProcessed
+        self.waveformBuilder = waveforms.WaveformBuilder() ## waveform cache and buffer pool for this session
+        self.downsampler = downsampling.Downsampler(downsampleFactor(taskParameters), zeroPhase=not taskParameters.get('causalFilter', False)) \
+            if taskParameters['downSample'] else None
+        self.builder = ThreadPoolExecutor(max_workers=1)
+        self.processor = ThreadPoolExecutor(max_workers=1)
+        self.nextTrial = None
+        self.processing = []
+        self.processedTime = 0 ## post-processing time of the trials already collected from self.processing
+        self.trialCount = 0
+        self.overlappedTime = 0 ## seconds of build/post-processing work hidden behind acquisition
+        self.rebuilds = 0
+        self.parametersVersion = 0 ## bumped whenever taskParameters change between trials
+
+    def _timed(self, function, *args):
+        t0 = time.perf_counter()
+        out = function(*args)
+        return out, time.perf_counter() - t0
+
+    def _build(self, trialNumber):
+        with self.timer.span('build'):
+            return buildTrial(self.taskParameters, self.waveformBuilder, self.schedule, trialNumber)
+
+    def _takeNextTrial(self):
+        if self.nextTrial is None:
+            return self._build(self.trialCount)
+        t0 = time.perf_counter()
+        with self.timer.span('waitBuild'):
+            trial, buildTime = self.nextTrial.result()
+        waited = time.perf_counter() - t0
+        self.nextTrial = None
+        if trial['goProbability'] != self.taskParameters['goProbability'] or self.nextTrialVersion != self.parametersVersion:
+            ## the parameters were changed (by sculpting or from the GUI) after this trial was prebuilt
+            self.schedule.previousGo = trial['previousGo'] ## rebuilt from the same draws, under the new parameters
+            self.rebuilds += 1
+            self.waveformBuilder.release(*trial['buffers'])
+            return self._build(self.trialCount)
+        self.overlappedTime += max(buildTime - waited, 0)
+        return trial
+
+    def _process(self, trialNumber, ai_data, di_data, trial, result):
+        data, processTime = self._timed(postProcessTrial, ai_data, di_data, trial, self.taskParameters, self.timer, self.downsampler)
+        def release():
+            self.waveformBuilder.release(*trial['buffers'])
+            self.acquisition.release(trial)
+        trial['release'] = release
+        if self.onTrialProcessed is not None:
+            self.onTrialProcessed(trialNumber, trial, data, result)
         else:
-            if sum(di_data[samplesToToneStart:samplesToRewardEnd]) > 0:
-                print('\tFalse Alarm')
-                result = 'FA'
+            release()
+        return processTime
+
+    def checkProcessing(self):
+        ## collects finished post-processing and re-raises its errors (a failing save, say) right away,
+        ## so the session stops instead of running on without its data
+        pending = []
+        for future in self.processing:
+            if future.done():
+                self.processedTime += future.result()
             else:
-                print('\tCorrect Rejection')
-                result = 'CR'
-            lastTrialGo = False
-
-    if taskParameters['downSample']:
-        ai_data = scipy.signal.decimate(ai_data, 10,0)
-        di_data = np.bool8(scipy.signal.decimate(di_data,10,0))
-        ao_data = scipy.signal.decimate(ao_data,10,0)
-        do_data = np.bool8(scipy.signal.decimate(do_out,10,0))
-    return ai_data, di_data, ao_data, do_data, result
+                pending.append(future)
+        self.processing = pending
+
+    def runTrial(self):
+        self.checkProcessing()
+        trial = self._takeNextTrial()
+        for message in trial['messages']:
+            self.log(message)
+        self.acquisition.startTrial(trial)
+        ## the hardware is running now; prepare the next trial in the meantime
+        self.nextTrial = self.builder.submit(self._timed, self._build, self.trialCount + 1)
+        trial['upcoming'] = self.nextTrial ## a trial cut short in continuous mode ramps to where this one starts
+        self.nextTrialVersion = self.parametersVersion
+        ai_data, di_data = self.acquisition.finishTrial(trial)
+        with self.timer.span('scoreTrial'):
+            result = scoreTrial(di_data, trial, self.taskParameters, self.log)
+        self.processing.append(self.processor.submit(self._process, self.trialCount, ai_data, di_data, trial, result))
+        self.trialCount += 1
+        return trial, result
+
+    def parametersChanged(self):
+        ## a trial prebuilt before now is rebuilt instead of run (see _takeNextTrial)
+        self.parametersVersion += 1
+
+    def close(self):
+        ## safe to call after a failed trial: the daq and the workers are stopped whatever is raised here
+        try:
+            if self.nextTrial is not None: ## the prebuilt trial is never run, so undo its effect on alternation
+                nextTrial, self.nextTrial = self.nextTrial, None
+                self.schedule.previousGo = nextTrial.result()[0]['previousGo']
+            t0 = time.perf_counter()
+            for future in self.processing:
+                self.processedTime += future.result()
+            waited = time.perf_counter() - t0
+            self.overlappedTime += max(self.processedTime - waited, 0)
+        finally:
+            self.processing = []
+            self.acquisition.stop()
+            self.builder.shutdown()
+            self.processor.shutdown()
+            if self.downsampler is not None:
+                self.downsampler.close()
+
+    def report(self):
+        perTrial = self.overlappedTime / max(self.trialCount, 1)
+        return 'Pipelining hid {0:0.2f} s of inter-trial work ({1:0.1f} ms/trial, {2} trials rebuilt)'.format(
+            self.overlappedTime, perTrial*1000, self.rebuilds)
 
 
 def dispense(do_task,taskParameters):
@@ -394,13 +722,31 @@ def dispense(do_task,taskParameters):
     do_task.start()
     do_task.wait_until_done()
     do_task.stop()
-def dprime(hitRate,falseAlarmRate):
-    return(scipy.stats.norm.ppf(hitRate) - scipy.stats.norm.ppf(falseAlarmRate))
+def parseSeed(text):
+    ## the Seed field: empty for a new seed each session, otherwise a non-negative integer. Anything else is
+    ## reported and ignored (a new seed is drawn) rather than taking the GUI down
+    text = str(text).strip()
+    if not text:
+        return None
+    try:
+        seed = int(text)
+        if seed >= 0:
+            return seed
+    except ValueError:
+        pass
+    sg.popup('Seed must be a non-negative integer; ignoring {!r}, a new seed will be drawn'.format(text))
+    return None
+
+
 def updateParameters(values):
     taskParameters = {}
     taskParameters['numTrials'] = int(values['-NumTrials-'])
     taskParameters['Fs'] = int(values['-SampleRate-'])
     taskParameters['downSample'] = values['-DownSample-']
+    taskParameters['downsampleFactor'] = int(values['-DownsampleFactor-'])
+    taskParameters['causalFilter'] = values['-CausalFilter-']
+    taskParameters['continuous'] = values['-Continuous-']
+    taskParameters['earlyTermination'] = values['-EarlyTermination-']
     taskParameters['trialDuration'] =  float(values['-TrialDuration-'])
     taskParameters['falseAlarmTimeout'] = float(values['-FalseAlarmTimeout-'])
     taskParameters['playTone'] = values['-PlayTone-']
@@ -419,21 +765,86 @@ def updateParameters(values):
     taskParameters['forceContinuous'] = values['-EnableContinuous-']
     taskParameters['savePath'] = values['-SavePath-']
     taskParameters['save'] = values['-Save-']
+    taskParameters['codec'] = values['-Codec-']
+    taskParameters['shuffle'] = values['-Shuffle-']
+    taskParameters['instrument'] = values['-Instrument-']
     taskParameters['animal'] = values['-Animal-']
+    taskParameters['seed'] = parseSeed(values['-Seed-']) ## None: a new seed each session
     return taskParameters
 
 
+def setParameters(window, tempParameters):
+    ## fills the task panel from a saved taskParameters dict; older sessions lack some keys
+    window.Element('-NumTrials-').Update(value=tempParameters['numTrials'])
+    window.Element('-SampleRate-').Update(value=tempParameters['Fs'])
+    window.Element('-DownSample-').Update(value=tempParameters['downSample'])
+    window.Element('-DownsampleFactor-').Update(value=tempParameters.get('downsampleFactor', DOWNSAMPLE_FACTOR))
+    window.Element('-CausalFilter-').Update(value=tempParameters.get('causalFilter', False))
+    window.Element('-Continuous-').Update(value=tempParameters.get('continuous', False))
+    window.Element('-EarlyTermination-').Update(value=tempParameters.get('earlyTermination', False))
+    window.Element('-TrialDuration-').Update(value=tempParameters['trialDuration'])
+    window.Element('-FalseAlarmTimeout-').Update(value=tempParameters['falseAlarmTimeout'])
+    if 'playTone' in tempParameters.keys():
+        window.Element('-PlayTone-').Update(value=tempParameters['playTone'])
+    else:
+        window.Element('-PlayTone-').Update(value=True)
+    window.Element('-TimeToTone-').Update(value=tempParameters['timeToTone'])
+    window.Element('-VaryTone-').Update(value=tempParameters['varyTone'])
+    if 'abortEarlyLick' in tempParameters.keys():
+        window.Element('-AbortEarlyLick-').Update(value=tempParameters['abortEarlyLick'])
+    else:
+        window.Element('-AbortEarlyLick-').Update(value=False)
+    window.Element('-RewardWindowDuration-').Update(value=tempParameters['rewardWindowDuration'])
+    window.Element('-RewardAllGos-').Update(value=tempParameters['rewardAllGos'])
+    window.Element('-GoProbability-').Update(value=tempParameters['goProbability'])
+    window.Element('-Alternate-').Update(value=tempParameters['alternate'])
+    if 'varyForce' in tempParameters.keys():
+        window.Element('-VaryForce-').Update(value=tempParameters['varyForce'])
+    else:
+        window.Element('-VaryForce-').Update(value=False)
+    window.Element('-Force-').Update(value=tempParameters['force'])
+    window.Element('-ForceRampTime-').Update(value=tempParameters['forceTime'])
+    window.Element('-StepDuration-').Update(value=tempParameters['forceDuration'])
+    window.Element('-EnableContinuous-').Update(value=tempParameters['forceContinuous'])
+    window.Element('-Codec-').Update(value=tempParameters.get('codec', 'none'))
+    window.Element('-Shuffle-').Update(value=tempParameters.get('shuffle', False))
+    window.Element('-Instrument-').Update(value=tempParameters.get('instrument', False))
+    window.Element('-Seed-').Update(value='') ## a loaded session's trial order is only repeated if its seed is entered on purpose
+
+
+def choosePreviousSession(animal):
+    ## lists the animal's cataloged sessions (all sessions if no animal is given); returns the chosen entry or None
+    if animal:
+        sessions = sessionCatalog.sessionsFor(animal)
+    else:
+        sessions = sorted(sessionCatalog.load().values(), key=lambda entry: entry['date'], reverse=True)
+    if not sessions:
+        sg.popup('No cataloged sessions for {}'.format(animal or 'any animal'))
+        return None
+    rows = ['{0}  {1:<10} {2:>4} trials  hit {hit}  miss {miss}  FA {FA}  CR {CR}  abort {abort}'.format(
+        entry['date'], entry['animal'] or '', entry['numTrials'], **entry['counts']) for entry in sessions]
+    window = sg.Window('Previous sessions', [[sg.Listbox(rows, size=(90, min(len(rows), 20)), key='-Sessions-', bind_return_key=True)],
+                                             [sg.Button('Load'), sg.Button('Cancel')]], modal=True, finalize=True)
+    event, values = window.read()
+    chosen = window['-Sessions-'].get_indexes() if event in ('Load', '-Sessions-') else ()
+    window.close()
+    return sessions[chosen[0]] if chosen else None
+
+
 ##################### Open and run panel #####################
 
-def the_gui():
+def the_gui(rig=None):
 
     sg.theme('Default1')
     textWidth = 23
     inputWidth = 6
-    window, settings = None, load_settings(SETTINGS_FILE, DEFAULT_SETTINGS )
+    window, settings = None, load_settings(settingsFile(rig), DEFAULT_SETTINGS )
 
     layout = [  [sg.Text('Number of Trials',size=(textWidth,1)), sg.Input(100,size=(inputWidth,1),key='-NumTrials-')],
-                [sg.Text('Sample Rate (Hz)',size=(textWidth,1)), sg.Input(default_text=20000,size=(inputWidth,1),key='-SampleRate-'),sg.Check('Downsample?',default=True,key='-DownSample-')],
+                [sg.Text('Sample Rate (Hz)',size=(textWidth,1)), sg.Input(default_text=20000,size=(inputWidth,1),key='-SampleRate-'),sg.Check('Downsample?',default=True,key='-DownSample-'),sg.Check('Continuous?',default=False,key='-Continuous-'),
+                 sg.Check('End trials at outcome?',default=False,key='-EarlyTermination-',tooltip='continuous mode only')],
+                [sg.Text('Downsample Factor',size=(textWidth,1)), sg.Input(default_text=DOWNSAMPLE_FACTOR,size=(inputWidth,1),key='-DownsampleFactor-'),
+                 sg.Check('Causal filter?',default=False,key='-CausalFilter-',tooltip='zero-phase when off')],
                 [sg.Text('Trial Duration (s)',size=(textWidth,1)), sg.Input(default_text=7,size=(inputWidth,1),key='-TrialDuration-')],
                 [sg.Text('False Alarm Timeout (s)',size=(textWidth,1)),sg.Input(default_text=3,size=(inputWidth,1),key='-FalseAlarmTimeout-')],
                 [sg.Check('Play Tone?',default=True,key='-PlayTone-'),sg.Check('Enable punish?',default=False,key='-EnablePunish-')],
@@ -446,86 +857,142 @@ def the_gui():
                 [sg.Text('Step Duration (s)',size=(textWidth,1)),sg.Input(default_text=3,size=(inputWidth,1),key='-StepDuration-'),sg.Check('Continue to Nogo?',key='-EnableContinuous-')],
                 [sg.Text('Save Path',size=(textWidth,1)),sg.Input(os.path.normpath('E://DATA/Behavior/'),size=(20,1),key='-SavePath-'),
                  sg.Check('Save?',default=True,key='-Save-')],
+                [sg.Text('Compression',size=(textWidth,1)),sg.Combo(list(sessionStorage.CODECS),default_value='none',readonly=True,key='-Codec-'),
+                 sg.Check('Byte shuffle?',default=False,key='-Shuffle-'),sg.Check('Log stage timing?',default=False,key='-Instrument-')],
                 [sg.Text('Animal ID',size=(textWidth,1)),sg.Input(size=(20,1),key='-Animal-')],
-                [sg.Button('Run Task',size=(30,2)),sg.Button('Dispense Reward',size=(30,2))],
+                [sg.Text('Schedule Seed',size=(textWidth,1)),sg.Input(size=(20,1),key='-Seed-'),sg.Text('(blank for a new seed)')],
+                [sg.Button('Run Task',size=(30,2)),sg.Button('Dispense Reward',size=(30,2)),sg.Check('Live display?',default=True,key='-LiveDisplay-')],
+                [sg.Button('Pause',disabled=True),sg.Button('Resume',disabled=True),sg.Button('Stop After Trial',disabled=True),
+                 sg.Text('',size=(50,1),key='-Status-')],
                 [sg.Button('Update Parameters'),sg.Button('Exit'),sg.Button('Setup DAQ'),
-                 sg.Input(key='Load Parameters', visible=False, enable_events=True), sg.FileBrowse('Load Parameters',initial_folder='Z:\\HarveyLab\\Tier1\\Alan\\Behavior'),sg.Button('Test Lick Monitor')],
+                 sg.Input(key='Load Parameters', visible=False, enable_events=True), sg.FileBrowse('Load Parameters',initial_folder='Z:\\HarveyLab\\Tier1\\Alan\\Behavior'),sg.Button('Previous Sessions'),sg.Button('Test Lick Monitor')],
              [sg.Output(size=(70,20),key='-OUTPUT-')]]
 
-    window = sg.Window('Sustained Detection Task',layout)
+    window = sg.Window('Sustained Detection Task' if rig is None else 'Sustained Detection Task ({})'.format(rig),layout)
     event, values = window.read(10)
     taskParameters = updateParameters(values)
+    display = displayFeed = None
+    control = None ## taskControl.TaskControl of the running task, None when idle
+    pool = DaqPool(settings) ## daq tasks for every mode, built on first use and kept until exit
+    monitor = None ## lickMonitor.LickMonitor while 'Test Lick Monitor' is on
+    lastMonitorReport = 0
 
     while True:
-        event, values = window.read()
+        ## poll while the live display is open so it can redraw between GUI events
+        event, values = window.read(timeout=50 if display is not None or monitor is not None else None)
+        if display is not None and not display.update(displayFeed):
+            display.close()
+            display = None
+        if monitor is not None and time.perf_counter() - lastMonitorReport > 1:
+            window['-Status-'].update(monitor.report())
+            lastMonitorReport = time.perf_counter()
+        if event == sg.TIMEOUT_KEY:
+            continue
+        if event == taskControl.STATUS_EVENT:
+            ## one batch of status from the task thread: a single print for all of its log lines
+            batch = values[event]
+            lines = [item['text'] for item in batch if item['kind'] == 'log']
+            if lines:
+                print('\n'.join(lines))
+            for item in batch:
+                if item['kind'] == 'trial':
+                    window['-Status-'].update('Trial {} of {}: {}; hit rate {:0.2f}, FA rate {:0.2f}'.format(
+                        item['trial']+1, item['numTrials'], item['result'], item['metrics']['hitRate'], item['metrics']['FARate']))
+                elif item['kind'] == 'state':
+                    running = item['state'] != 'finished'
+                    window['Pause'].update(disabled=item['state'] != 'running')
+                    window['Resume'].update(disabled=item['state'] != 'paused')
+                    window['Stop After Trial'].update(disabled=not running or item['state'] == 'stopping')
+                    window['Run Task'].update(disabled=running)
+                    if not running:
+                        control = None
+            continue
         print(event)
         if event in (sg.WIN_CLOSED, 'Exit'):
             break
         if event == 'Update Parameters':
             taskParameters = updateParameters(values)
+            if control is not None:
+                control.updateParameters(taskParameters) ## applied by the task thread before its next trial
             print('parameters updated')
+        if event == 'Pause' and control is not None:
+            control.pause()
+        if event == 'Resume' and control is not None:
+            control.resume()
+        if event == 'Stop After Trial' and control is not None:
+            control.stop()
+        if control is not None and event in ('Setup DAQ', 'Run Task', 'Dispense Reward', 'Test Lick Monitor'):
+            print('{} is not available while a task is running'.format(event))
+            continue
+        if monitor is not None and event in ('Setup DAQ', 'Run Task', 'Dispense Reward', 'Test Lick Monitor'):
+            ## the monitor needs the lick line to itself, so anything else that uses the daq turns it off
+            monitor.stop()
+            print('Lick monitor stopped. ' + monitor.report())
+            monitor = None
+            window['-Status-'].update('')
+            if event == 'Test Lick Monitor':
+                continue
+        if event == 'Test Lick Monitor':
+            monitor = monitorLicks(pool, taskParameters)
+            print('Lick monitor running in {:0.1f} ms; press Test Lick Monitor again to stop'.format(pool.lastSwitchTime*1000))
 
 
         if event == 'Setup DAQ':
             event,values = create_settings_window(settings).read(close=True)
             if event == 'Save':
-                save_settings(SETTINGS_FILE,settings,values)
+                save_settings(settingsFile(rig),settings,values)
+                pool.close() ## channels may have moved; tasks are rebuilt on next use
         if event == 'Run Task':
             taskParameters = updateParameters(values)
             print('parameters updated')
-            try:
-                if daqStatus != 'task':
-                    do_task.close()
-                    ai_task, di_task, ao_task, do_task, daqStatus = setupDaq(settings,taskParameters)
-            except NameError:
-                ai_task, di_task, ao_task, do_task, daqStatus = setupDaq(settings,taskParameters)
-            threading.Thread(target=runTask, args=(ai_task, di_task, ao_task, do_task, taskParameters), daemon=True).start()
+            daqSetup = 'continuous' if taskParameters['continuous'] else 'task'
+            ai_task, di_task, ao_task, do_task = pool.acquire(daqSetup, taskParameters)
+            print('DAQ ready for {} mode in {:0.1f} ms'.format(daqSetup, pool.lastSwitchTime*1000))
+            if values['-LiveDisplay-']:
+                if display is None:
+                    display = liveDisplay.LiveDisplay()
+                displayFeed = liveDisplay.DisplayFeed()
+            else:
+                if display is not None:
+                    display.close()
+                display = displayFeed = None
+            control = taskControl.TaskControl()
+            ## the task thread gets its own copy of the parameters; later changes reach it through control
+            taskThread = threading.Thread(target=runTaskThread, args=((ai_task, di_task, ao_task, do_task), dict(taskParameters), displayFeed,
+                                                                    control, taskControl.StatusBus(window)), daemon=True)
+            taskThread.start()
         if event == 'Dispense Reward':
-            try:
-                if daqStatus != 'dispenseReward':
-                    ai_task.close()
-                    di_task.close()
-                    ao_task.close()
-                    do_task.close()
-                    do_task, daqStatus = setupDaq(settings,taskParameters,'dispenseReward')
-            except NameError:
-                do_task, daqStatus = setupDaq(settings,taskParameters,'dispenseReward')
-            dispense(do_task,taskParameters)
+            t0 = time.perf_counter()
+            reward_task, = pool.acquire('dispenseReward', taskParameters)
+            dispense(reward_task,taskParameters)
+            print('Reward dispensed in {:0.1f} ms (mode switch {:0.1f} ms)'.format((time.perf_counter()-t0)*1000, pool.lastSwitchTime*1000))
+        if event == 'Previous Sessions':
+            entry = choosePreviousSession(values['-Animal-'])
+            if entry is not None:
+                print('Updating parameters from {}'.format(entry['path']))
+                setParameters(window, entry['taskParameters'])
         if event == 'Load Parameters':
             print(f'Updating parameters from {values["Load Parameters"]}')
             try:
-                tempParameters = pickle.load(values['Load Parameters'])['taskParameters']
-                window.Element('-NumTrials-').Update(value=tempParameters['numTrials'])
-                window.Element('-SampleRate-').Update(value=tempParameters['Fs'])
-                window.Element('-DownSample-').Update(value=tempParameters['downSample'])
-                window.Element('-TrialDuration-').Update(value=tempParameters['trialDuration'])
-                window.Element('-FalseAlarmTimeout-').Update(value=tempParameters['falseAlarmTimeout'])
-                if 'playTone' in tempParameters.keys():
-                    window.Element('-PlayTone-').Update(value=tempParameters['playTone'])
-                else:
-                    window.Element('-PlayTone-').Update(value=True)
-                window.Element('-TimeToTone-').Update(value=tempParameters['timeToTone'])
-                window.Element('-VaryTone-').Update(value=tempParameters['varyTone'])
-                if 'abortEarlyLick' in tempParameters.keys():
-                    window.Element('-AbortEarlyLick-').Update(value=tempParameters['abortEarlyLick'])
-                else:
-                    window.Element('-AbortEarlyLick-').Update(value=False)
-                window.Element('-RewardWindowDuration-').Update(value=tempParameters['rewardWindowDuration'])
-                window.Element('-RewardAllGos-').Update(value=tempParameters['rewardAllGos'])
-                window.Element('-GoProbability-').Update(value=tempParameters['goProbability'])
-                window.Element('-Alternate-').Update(value=tempParameters['alternate'])
-                if 'varyForce' in tempParameters.keys():
-                    window.Element('-VaryForce-').Update(value=tempParameters['varyForce'])
-                else:
-                    window.Element('-VaryForce-').Update(value=False)
-                window.Element('-Force-').Update(value=tempParameters['force'])
-                window.Element('-ForceRampTime-').Update(value=tempParameters['forceTime'])
-                window.Element('-StepDuration-').Update(value=tempParameters['forceDuration'])
-                window.Element('-EnableContinuous-').Update(value=tempParameters['forceContinuous'])
+                ## the catalog has the parameters without opening the session; otherwise read them once and catalog them
+                entry = sessionCatalog.lookup(values['Load Parameters'])
+                if entry is None:
+                    entry = sessionCatalog.entryFromFile(values['Load Parameters'])
+                    sessionCatalog.record(entry)
+                tempParameters = entry['taskParameters']
+                setParameters(window, tempParameters)
             except:
                 'invalid file'
+    if display is not None:
+        display.close()
+    if control is not None: ## let a running task finish its trial before its tasks go away
+        control.stop()
+        taskThread.join(timeout=taskParameters['trialDuration'] + taskParameters['falseAlarmTimeout'] + 5)
+    if monitor is not None:
+        monitor.stop()
+    pool.close()
     window.close()
 
 if __name__ == '__main__':
-    the_gui()
+    the_gui(sys.argv[1] if len(sys.argv) > 1 else None) ## `python controlPanel.py <rig>` for one of several rigs on this host
     print('Exiting Program')
@@ -0,0 +1,38 @@
+"""Event (edge) representation of digital lines.
+
+Digital channels are stored as one int32 row per pulse, [line, rising, falling],
+with sample indices at full acquisition resolution. A pulse still high at the
+end of the trace gets falling = numSamples. eventsToDense rebuilds the dense
+boolean traces, optionally at a downsampled resolution.
+"""
+import numpy as np
+
+
+def toEvents(lines):
+    """(lines x samples) or (samples,) digital array -> (pulses x 3) int32 [line, rising, falling]."""
+    lines = np.atleast_2d(np.asarray(lines) != 0)
+    padded = np.zeros((lines.shape[0], lines.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = lines
+    change = np.diff(padded, axis=1)
+    risingLines, rising = np.nonzero(change == 1)
+    falling = np.nonzero(change == -1)[1]
+    ## rows come out line by line and in time order, so the k-th rise pairs with the k-th fall
+    return np.stack([risingLines, rising, falling], axis=1).astype(np.int32)
+
+
+def eventsToDense(events, numLines, numSamples, factor=1):
+    """Rebuild a (numLines x ceil(numSamples/factor)) bool array from events, sampling every factor-th sample."""
+    events = np.asarray(events).reshape(-1, 3)
+    numOut = -(-numSamples // factor)
+    edges = np.zeros((numLines, numOut + 1), dtype=np.int32)
+    ## output sample j covers input sample j*factor; a pulse is high from ceil(rising/factor) to ceil(falling/factor)
+    np.add.at(edges, (events[:, 0], -(-events[:, 1] // factor)), 1)
+    np.add.at(edges, (events[:, 0], -(-events[:, 2] // factor)), -1)
+    return np.cumsum(edges[:, :-1], axis=1) > 0
+
+
+def lineEvents(events, line):
+    """(rising, falling) sample indices for one line."""
+    events = np.asarray(events).reshape(-1, 3)
+    events = events[events[:, 0] == line]
+    return events[:, 1], events[:, 2]
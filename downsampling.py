@@ -0,0 +1,77 @@
+"""Analog downsampling.
+
+Replaces scipy.signal.decimate(x, q, 0), which designs an 8th order Chebyshev
+IIR filter on every call and runs it forward and backward over every input
+sample, with a linear-phase FIR anti-aliasing filter applied polyphase: only the
+samples that are kept are computed. Filter designs are cached per factor and
+length.
+
+zeroPhase=True compensates the filter's delay, as decimate's zero_phase did.
+Causal output (zeroPhase=False) never looks at later samples and lags the input
+by (numTaps-1)/2 input samples; describe() reports the delay for the session header.
+
+A trial's channels (analog inputs and outputs) go through together as the rows
+of one array. A Downsampler splits the rows into blocks and filters them on its
+own thread pool (the filtering runs in compiled code), so many channels are
+spread over the cores while the caller only hands over buffers.
+"""
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+DEFAULT_FACTOR = 10
+TAPS_PER_FACTOR = 20 ## filter length per unit of factor, as in scipy.signal.decimate's FIR option
+
+
+@functools.lru_cache(maxsize=None)
+def design(factor, numTaps=None):
+    """Low-pass FIR coefficients for downsampling by factor (read-only, shared between callers)."""
+    import scipy.signal ## slow to import; only needed once a session downsamples
+    numTaps = numTaps or TAPS_PER_FACTOR * factor + 1
+    coefficients = scipy.signal.firwin(numTaps, 1. / factor, window='hamming')
+    coefficients.setflags(write=False)
+    return coefficients
+
+
+def downsample(x, factor=DEFAULT_FACTOR, zeroPhase=True, numTaps=None):
+    """Downsample x (... x samples) along its last axis; returns ceil(samples/factor) float samples."""
+    import scipy.signal
+    coefficients = design(factor, numTaps)
+    x = np.asarray(x, dtype=np.float64)
+    if zeroPhase:
+        return scipy.signal.resample_poly(x, 1, factor, axis=-1, window=coefficients)
+    numOut = -(-x.shape[-1] // factor)
+    return scipy.signal.upfirdn(coefficients, x, down=factor, axis=-1)[..., :numOut]
+
+
+def describe(factor=DEFAULT_FACTOR, zeroPhase=True, numTaps=None):
+    ## for the session header
+    return {'factor': factor, 'filter': 'fir', 'numTaps': len(design(factor, numTaps)), 'zeroPhase': zeroPhase,
+            'delay': 0 if zeroPhase else (len(design(factor, numTaps)) - 1) // 2}
+
+
+class Downsampler:
+
+    def __init__(self, factor=DEFAULT_FACTOR, zeroPhase=True, numTaps=None, workers=None, channelsPerJob=4):
+        self.factor = factor
+        self.zeroPhase = zeroPhase
+        self.numTaps = len(design(factor, numTaps))
+        self.channelsPerJob = channelsPerJob
+        self.pool = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1))
+
+    def describe(self):
+        return describe(self.factor, self.zeroPhase, self.numTaps)
+
+    def downsample(self, arrays):
+        """Downsample a list of (channels x samples) arrays with the same number of samples; returns float arrays."""
+        rows = np.concatenate([np.atleast_2d(array) for array in arrays]).astype(np.float64, copy=False)
+        blocks = [self.pool.submit(downsample, rows[start:start + self.channelsPerJob], self.factor, self.zeroPhase, self.numTaps)
+                  for start in range(0, len(rows), self.channelsPerJob)]
+        out = np.concatenate([block.result() for block in blocks])
+        return np.split(out, np.cumsum([len(np.atleast_2d(array)) for array in arrays])[:-1])
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,141 @@
+"""Trial loop instrumentation.
+
+A TrialTimer collects monotonic-clock spans around the stages of the trial
+loop (building, writing outputs, acquiring, scoring, post-processing, saving)
+and counters such as samples read and bytes written. endTrial() closes one
+iteration of the trial loop: the spans and counts gathered since the previous
+call are appended as one JSON line to the timing log and kept for summary().
+Work that overlaps with acquisition (prebuilding the next trial, processing
+and saving the previous one) is counted in the iteration in which it finishes.
+
+NULL_TIMER is disabled: span() hands back a shared no-op context manager and
+count() returns immediately, so instrumented code costs next to nothing when
+timing is off.
+"""
+import collections
+import contextlib
+import json
+import threading
+import time
+
+import numpy as np
+
+
+LOG_FILE = 'timing.jsonl' ## written inside the session directory
+HISTOGRAM_EDGES = (0.1, 1, 10, 100, 1000) ## ms; bins of the per-stage histograms in summary()
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class _Span:
+    __slots__ = ('timer', 'stage', 't0')
+
+    def __init__(self, timer, stage):
+        self.timer = timer
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.stage, time.perf_counter_ns() - self.t0)
+        return False
+
+
+class TrialTimer:
+
+    def __init__(self, logFile=None, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._spans = collections.defaultdict(int) ## ns per stage in the current iteration
+        self._counts = collections.defaultdict(int)
+        self.stageTimes = collections.defaultdict(list) ## stage -> seconds per iteration
+        self.totals = collections.defaultdict(int) ## counter -> session total
+        self.numTrials = 0
+        self._log = open(logFile, 'a') if enabled and logFile else None
+
+    def span(self, stage):
+        """Context manager timing one occurrence of a stage; occurrences within a trial add up."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, stage)
+
+    def add(self, stage, nanoseconds):
+        with self._lock:
+            self._spans[stage] += nanoseconds
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counts[name] += n
+
+    def endTrial(self, trial, **info):
+        if not self.enabled:
+            return
+        with self._lock:
+            spans, self._spans = self._spans, collections.defaultdict(int)
+            counts, self._counts = self._counts, collections.defaultdict(int)
+        seconds = {stage: ns / 1e9 for stage, ns in spans.items()}
+        for stage, duration in seconds.items():
+            ## stages that did not run this iteration count as 0 so every history has one entry per trial
+            history = self.stageTimes[stage]
+            history.extend([0.] * (self.numTrials - len(history)))
+            history.append(duration)
+        for name, n in counts.items():
+            self.totals[name] += n
+        self.numTrials += 1
+        if self._log is not None:
+            entry = {'trial': trial, 'time': time.time(), 'spans': seconds, 'counts': dict(counts)}
+            entry.update(info)
+            self._log.write(json.dumps(entry) + '\n')
+            self._log.flush()
+
+    def durations(self, stage):
+        """The stage's time in each trial so far, in ms."""
+        history = self.stageTimes.get(stage, [])
+        return np.asarray(history + [0.] * (self.numTrials - len(history))) * 1000
+
+    def histogram(self, stage):
+        """Per-trial counts of the stage's duration in the HISTOGRAM_EDGES bins (ms), below the first edge first."""
+        durations = self.durations(stage)
+        return np.bincount(np.searchsorted(HISTOGRAM_EDGES, durations, side='right'), minlength=len(HISTOGRAM_EDGES) + 1)
+
+    def summary(self):
+        if not self.enabled or not self.numTrials:
+            return ''
+        edges = ['<{}'.format(HISTOGRAM_EDGES[0])] + ['>={}'.format(edge) for edge in HISTOGRAM_EDGES]
+        lines = ['Stage timing over {} trials (ms per trial)'.format(self.numTrials),
+                 '{:>14} {:>8} {:>8} {:>8} {:>8}   histogram ({} ms)'.format('stage', 'mean', 'median', 'p95', 'max', ' '.join(edges))]
+        for stage in self.stageTimes:
+            durations = self.durations(stage)
+            lines.append('{:>14} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}   {}'.format(
+                stage, durations.mean(), np.median(durations), np.percentile(durations, 95), durations.max(),
+                ' '.join(str(n) for n in self.histogram(stage))))
+        for name, total in self.totals.items():
+            lines.append('{:>14} {} ({:0.0f} per trial)'.format(name, total, total / self.numTrials))
+        return '\n'.join(lines)
+
+    def close(self):
+        """Fold work that finished after the last endTrial (processing and saving the last trial) into the last trial."""
+        if self.enabled and self.numTrials:
+            with self._lock:
+                spans, self._spans = self._spans, collections.defaultdict(int)
+                counts, self._counts = self._counts, collections.defaultdict(int)
+            for stage, ns in spans.items():
+                history = self.stageTimes[stage]
+                history.extend([0.] * (self.numTrials - len(history)))
+                history[-1] += ns / 1e9
+            for name, n in counts.items():
+                self.totals[name] += n
+            if self._log is not None and (spans or counts):
+                self._log.write(json.dumps({'afterLastTrial': True, 'time': time.time(),
+                                            'spans': {stage: ns / 1e9 for stage, ns in spans.items()},
+                                            'counts': dict(counts)}) + '\n')
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+NULL_TIMER = TrialTimer(enabled=False)
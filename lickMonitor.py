@@ -0,0 +1,141 @@
+"""Hardware-timed lick monitor.
+
+The lick line is read with change detection, so the DI task only produces a
+sample when the line changes, and a counter task sampled on the same
+ChangeDetectionEvent latches a free-running 100 kHz timebase count at each
+change. Every lick edge therefore has a hardware timestamp (10 us resolution),
+however late the host gets round to reading it. An every-N-samples callback
+(N=1) hands new edges to LickMonitor as they arrive; nothing polls.
+
+The monitor needs the lick line to itself, so it runs when no trial tasks do:
+spout checks, habituation and the time between sessions. Inside a session the
+continuous acquisition mode keeps the lick line between trials instead.
+"""
+import threading
+import time
+
+import numpy as np
+import nidaqmx.stream_readers
+from nidaqmx.constants import AcquisitionType, Edge
+
+from continuousAcquisition import RingBuffer
+
+
+TIMEBASE = '100kHzTimebase'
+TIMEBASE_HZ = 100e3
+MAX_CHANGE_RATE = 1000 ## Hz; nominal rate for the counter's external sample clock
+BUFFER_SAMPLES = 10000
+
+
+def deviceName(channel):
+    return channel.strip('/').split('/')[0]
+
+
+def setupLickMonitor(settings, backend=nidaqmx):
+    ## change-detection DI task on the lick line plus a counter timestamping each change
+    device = deviceName(settings['lick_input'])
+    di_task = backend.Task()
+    di_task.di_channels.add_di_chan(settings['lick_input'], name_to_assign_to_lines='lick')
+    di_task.timing.cfg_change_detection_timing(rising_edge_chan=settings['lick_input'], falling_edge_chan=settings['lick_input'],
+                                               sample_mode=AcquisitionType.CONTINUOUS, samps_per_chan=BUFFER_SAMPLES)
+    ci_task = backend.Task()
+    channel = ci_task.ci_channels.add_ci_count_edges_chan(settings['lickCounter'], name_to_assign_to_channel='lickTimestamp',
+                                                          edge=Edge.RISING, initial_count=0)
+    channel.ci_count_edges_term = '/{}/{}'.format(device, TIMEBASE)
+    ci_task.timing.cfg_samp_clk_timing(MAX_CHANGE_RATE, source='/{}/ChangeDetectionEvent'.format(device),
+                                       sample_mode=AcquisitionType.CONTINUOUS, samps_per_chan=BUFFER_SAMPLES)
+    return di_task, ci_task
+
+
+class LickMonitor:
+    """Lick onsets with hardware timestamps (s since start()), plus rate and inter-lick-interval stats."""
+
+    def __init__(self, di_task, ci_task, onLick=None, history=10000, streamReaders=nidaqmx.stream_readers):
+        self.di_task, self.ci_task = di_task, ci_task
+        self.onLick = onLick ## called with each lick's onset time, on the daq callback thread
+        self.di_reader = streamReaders.DigitalSingleChannelReader(di_task.in_stream)
+        self.ci_reader = streamReaders.CounterReader(ci_task.in_stream)
+        self.onsets = RingBuffer(1, history, dtype=np.float64)
+        self.latencies = RingBuffer(1, history, dtype=np.float64) ## host callback time - hardware time, per lick
+        self._states = np.empty(BUFFER_SAMPLES, dtype=np.uint8)
+        self._counts = np.empty(BUFFER_SAMPLES, dtype=np.uint32)
+        self._lock = threading.Lock()
+        self.running = False
+
+    def _reset(self):
+        self.lickCount = 0
+        self.lickHigh = False
+        self._lastCount = 0
+        self._wraps = 0 ## the 32 bit counter wraps every ~12 h at 100 kHz
+
+    def _onChange(self, task_handle, every_n_samples_event_type, number_of_samples, callback_data):
+        now = time.perf_counter()
+        with self._lock:
+            ## an earlier callback may already have read this change along with its own
+            n = min(self.di_task.in_stream.avail_samp_per_chan, BUFFER_SAMPLES)
+            if not n:
+                return 0
+            states, counts = self._states[:n], self._counts[:n]
+            self.di_reader.read_many_sample_port_byte(states, number_of_samples_per_channel=n)
+            self.ci_reader.read_many_sample_uint32(counts, number_of_samples_per_channel=n)
+            ticks = counts.astype(np.int64)
+            wrapped = np.diff(np.concatenate([[self._lastCount], ticks])) < 0
+            ticks += (self._wraps + np.cumsum(wrapped)) << 32
+            self._wraps += int(wrapped.sum())
+            self._lastCount = int(counts[-1])
+            times = ticks / TIMEBASE_HZ
+            high = states != 0
+            rising = high & ~np.concatenate([[self.lickHigh], high[:-1]])
+            self.lickHigh = bool(high[-1])
+            onsets = times[rising]
+            if len(onsets):
+                self.onsets.write(onsets)
+                self.latencies.write(now - self.t0 - onsets)
+                self.lickCount += len(onsets)
+        if self.onLick is not None:
+            for onset in onsets:
+                self.onLick(onset)
+        return 0
+
+    def start(self):
+        self._reset()
+        self.di_task.register_every_n_samples_acquired_into_buffer_event(1, self._onChange)
+        self.ci_task.start() ## the counter must be armed before the first change
+        self.t0 = time.perf_counter() ## timebase count 0, to within the start call
+        self.di_task.start()
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.di_task.stop()
+        self.ci_task.stop()
+        self.di_task.register_every_n_samples_acquired_into_buffer_event(1, None)
+
+    def recentLicks(self, window=None):
+        """Lick onset times (s since start()) still in the history, optionally only the last `window` seconds."""
+        with self._lock:
+            total = self.onsets.totalWritten
+            onsets = self.onsets.read(max(total - self.onsets.capacity, 0), total)[0]
+        if window is not None:
+            onsets = onsets[onsets >= time.perf_counter() - self.t0 - window]
+        return onsets
+
+    def stats(self, window=10.):
+        """Lick count, rate over the last `window` s, inter-lick intervals and callback latency."""
+        recent = self.recentLicks(window)
+        intervals = np.diff(recent)
+        with self._lock:
+            total = self.latencies.totalWritten
+            latencies = self.latencies.read(max(total - 100, 0), total)[0]
+        span = min(window, time.perf_counter() - self.t0) ## the monitor may not have run for a whole window yet
+        return {'licks': self.lickCount, 'rate': len(recent) / span if span > 0 else np.nan,
+                'meanILI': intervals.mean() if len(intervals) else np.nan,
+                'medianILI': np.median(intervals) if len(intervals) else np.nan,
+                'latency': np.median(latencies) if len(latencies) else np.nan}
+
+    def report(self, window=10.):
+        stats = self.stats(window)
+        return 'Licks: {0} total, {1:0.1f}/s over the last {2:0.0f} s, ILI median {3:0.0f} ms (mean {4:0.0f} ms), callback latency {5:0.1f} ms'.format(
+            stats['licks'], stats['rate'], window, stats['medianILI']*1000, stats['meanILI']*1000, stats['latency']*1000)
@@ -0,0 +1,55 @@
+"""Online lick scoring.
+
+OnlineLickScorer is fed the lick line in chunks while a trial runs and decides
+the outcome (hit/miss/FA/CR/abort) as soon as the first lick lands in the abort
+or response window, or as soon as the response window has passed without one.
+"""
+import numpy as np
+
+
+SCORING_INTERVAL = 0.005 ## s of lick samples read per chunk while a trial runs
+
+
+class OnlineLickScorer:
+
+    def __init__(self, trial, Fs, abortEarlyLick):
+        self.Fs = Fs
+        self.goTrial = trial['goTrial']
+        self.abortWindow = (trial['forceTime_samples'], trial['samplesToToneStart']) if abortEarlyLick else (0, 0)
+        self.responseWindow = (trial['samplesToToneStart'], trial['samplesToRewardEnd'])
+        self.position = 0 ## number of lick samples seen so far
+        self.result = None
+        self.lickSample = None ## sample (from trial start) of the lick that decided the trial
+
+    @property
+    def decided(self):
+        return self.result is not None
+
+    @property
+    def latency(self):
+        ## s from tone onset to the deciding lick; negative for early (abort) licks
+        if self.lickSample is None:
+            return None
+        return (self.lickSample - self.responseWindow[0]) / self.Fs
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk)
+        start = self.position
+        self.position += len(chunk)
+        if self.result is None:
+            licks = np.flatnonzero(chunk) + start
+            early = licks[(licks >= self.abortWindow[0]) & (licks < self.abortWindow[1])]
+            response = licks[(licks >= self.responseWindow[0]) & (licks < self.responseWindow[1])]
+            if len(early): ## the abort window ends before the response window starts
+                self.result, self.lickSample = 'abort', int(early[0])
+            elif len(response):
+                self.result, self.lickSample = ('hit' if self.goTrial else 'FA'), int(response[0])
+        if self.result is None and self.position >= self.responseWindow[1]:
+            self.result = 'miss' if self.goTrial else 'CR'
+        return self.result
+
+    def finish(self):
+        ## end of trial: an undecided trial had no licks in its windows
+        if self.result is None:
+            self.result = 'miss' if self.goTrial else 'CR'
+        return self.result
@@ -0,0 +1,169 @@
+"""Live session display.
+
+The task side only hands data to a DisplayFeed: a bounded queue whose puts never
+block (updates are dropped if the display falls behind), filled from the
+pipeline's processing thread and the trial loop. The GUI thread drains the feed
+from its event loop and redraws a LiveDisplay window with blitting. Everything
+drawn comes from fixed-size buffers -- the last trial decimated to TRACE_POINTS,
+the last RASTER_TRIALS lick rasters and the last HISTORY_TRIALS performance
+points -- so a refresh costs the same on trial 10 and trial 1000.
+"""
+import collections
+import queue
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+import PySimpleGUI as sg
+
+import digitalEvents
+import sessionStorage
+from continuousAcquisition import RingBuffer
+
+
+TRACE_POINTS = 1000 ## points per displayed trace, whatever the sample rate and trial length
+RASTER_TRIALS = 30
+HISTORY_TRIALS = 200
+RESULT_COLORS = {'hit': 'tab:green', 'miss': 'k', 'FA': 'tab:red', 'CR': 'tab:blue', 'abort': '0.6'}
+
+
+class DisplayFeed:
+    """Thread-safe, non-blocking hand-off from the task thread to the GUI."""
+
+    def __init__(self, scaling=None, maxPending=64):
+        self.scaling = scaling ## per-channel raw -> volts coefficients (see analogScaling)
+        self._queue = queue.Queue(maxsize=maxPending)
+        self.dropped = 0
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def putTrial(self, trialNumber, trial, data, result):
+        ## called while the trial's buffers are still valid, so copy out a decimated version here
+        ai = data['ai']
+        step = max(ai.shape[1] // TRACE_POINTS, 1)
+        traces = ai[:, ::step]
+        traces = sessionStorage.scaleAnalog(traces, self.scaling) if self.scaling else traces.astype(float)
+        licks = digitalEvents.lineEvents(data['di_events'], 0)[0] / trial['Fs']
+        self._put(('trial', trialNumber, trial['numSamples'] / trial['Fs'], traces, licks,
+                   trial['samplesToToneStart'] / trial['Fs'], result))
+
+    def putMetrics(self, trialNumber, metrics):
+        self._put(('metrics', trialNumber, metrics.hitRate, metrics.FARate, metrics.dprime))
+
+    def get(self):
+        """Everything queued so far, oldest first."""
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                return items
+
+
+class LiveDisplay:
+    """Monitoring window: last trial's traces, recent lick rasters and running hit/FA/d'."""
+
+    def __init__(self, channelNames=('length', 'force')):
+        self.window = sg.Window('Live Monitor', [[sg.Canvas(key='-Canvas-')]], finalize=True, resizable=True)
+        self.figure = Figure(figsize=(6, 7), tight_layout=True)
+        self.traceAxes, self.rasterAxes, self.rateAxes = self.figure.subplots(3, 1)
+        self.canvas = FigureCanvasTkAgg(self.figure, self.window['-Canvas-'].TKCanvas)
+        self.canvas.get_tk_widget().pack(side='top', fill='both', expand=1)
+
+        ## animated artists are left out of full draws and drawn over the cached background instead
+        self.traces = [self.traceAxes.plot([], [], label=name, animated=True)[0] for name in channelNames]
+        self.tone = self.traceAxes.axvline(0, color='0.7', ls='--', animated=True)
+        self.traceAxes.set_xlabel('time (s)')
+        self.traceAxes.set_ylabel('V')
+        self.traceAxes.legend(loc='upper right')
+        self.rasterLines = {result: self.rasterAxes.plot([], [], '|', color=color, label=result, animated=True)[0]
+                            for result, color in RESULT_COLORS.items()}
+        self.rasterAxes.set_ylim(-0.5, RASTER_TRIALS - 0.5)
+        self.rasterAxes.set_ylabel('trials ago')
+        self.rasterAxes.invert_yaxis()
+        self.rateLines = [self.rateAxes.plot([], [], label=label, color=color, animated=True)[0]
+                          for label, color in (('hit rate', 'tab:green'), ('FA rate', 'tab:red'), ("d'", 'k'))]
+        self.rateAxes.set_xlim(-HISTORY_TRIALS + 1, 0)
+        self.rateAxes.set_ylim(-0.1, 1.1)
+        self.rateAxes.set_xlabel('trials ago')
+        self.rateAxes.legend(loc='upper left')
+        self.artists = self.traces + [self.tone] + list(self.rasterLines.values()) + self.rateLines
+
+        self.raster = collections.deque(maxlen=RASTER_TRIALS) ## (lick times, result) per trial, newest last
+        self.history = RingBuffer(3, HISTORY_TRIALS) ## hit rate, FA rate, d' per trial
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self._onDraw)
+        self.canvas.draw()
+
+    def _onDraw(self, event):
+        ## any full redraw (resize, rescaled axes) invalidates the cached background
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self._drawArtists()
+
+    def _drawArtists(self):
+        for artist in self.artists:
+            artist.axes.draw_artist(artist)
+
+    def _expand(self, axes, low, high, margin=0.1):
+        ## grows the y limits to fit new data; returns True when a full redraw is needed
+        bottom, top = axes.get_ylim()
+        if low >= bottom and high <= top:
+            return False
+        pad = (max(high, top) - min(low, bottom)) * margin
+        axes.set_ylim(min(low, bottom) - pad, max(high, top) + pad)
+        return True
+
+    def _addTrial(self, duration, traces, licks, toneTime, result):
+        t = np.linspace(0, duration, traces.shape[1], endpoint=False)
+        for line, trace in zip(self.traces, traces):
+            line.set_data(t, trace)
+        self.tone.set_xdata([toneTime, toneTime])
+        self.raster.appendleft((licks, result))
+        for name, line in self.rasterLines.items():
+            rows = [(times, np.full(len(times), row)) for row, (times, rowResult) in enumerate(self.raster) if rowResult == name]
+            line.set_data(np.concatenate([x for x, y in rows]) if rows else [], np.concatenate([y for x, y in rows]) if rows else [])
+        stale = False
+        if self.traceAxes.get_xlim() != (0, duration):
+            self.traceAxes.set_xlim(0, duration)
+            self.rasterAxes.set_xlim(0, duration)
+            stale = True
+        return self._expand(self.traceAxes, traces.min(), traces.max()) or stale
+
+    def _addMetrics(self, hitRate, FARate, dprime):
+        self.history.write(np.array([[hitRate], [FARate], [dprime]]))
+        rates = self.history.read(max(self.history.totalWritten - HISTORY_TRIALS, 0), self.history.totalWritten)
+        x = np.arange(-rates.shape[1] + 1, 1)
+        for line, values in zip(self.rateLines, rates):
+            line.set_data(x, values)
+        finite = rates[np.isfinite(rates)]
+        return self._expand(self.rateAxes, finite.min(), finite.max()) if finite.size else False
+
+    def update(self, feed):
+        """Apply whatever the feed has queued and redraw; returns False once the window has been closed."""
+        event, values = self.window.read(timeout=0)
+        if event == sg.WIN_CLOSED:
+            return False
+        items = feed.get()
+        if not items:
+            return True
+        stale = False
+        for item in items:
+            if item[0] == 'trial':
+                stale = self._addTrial(*item[2:]) or stale
+            else:
+                stale = self._addMetrics(*item[2:]) or stale
+        if stale or self.background is None:
+            self.canvas.draw() ## redraws the static parts and recaptures the background (see _onDraw)
+        else:
+            self.canvas.restore_region(self.background)
+            self._drawArtists()
+        self.canvas.blit(self.figure.bbox)
+        self.canvas.flush_events()
+        return True
+
+    def close(self):
+        self.window.close()
@@ -0,0 +1,211 @@
+"""Several rigs from one host.
+
+`python multiRig.py rigs.json` runs a session on every rig listed in the file,
+each rig in its own process. The trial loop, writer thread, downsampling pool
+and module state of one rig share nothing with another's, so one rig's saving
+or analysis cannot hold up another's trials, and throughput scales with the
+number of DAQ devices (and cores). The file maps rig names to a settings
+profile and the task parameters (the keys updateParameters produces):
+
+    {"rig1": {"parameters": "mouse1.json"},
+     "rig2": {"settings": {"lick_input": "/Dev3/port0/line7", ...}, "parameters": {...}}}
+
+"settings" is a settings file or a dict of changes to DEFAULT_SETTINGS; without
+it the rig uses the profile the GUI keeps for it (`python controlPanel.py rig1`
+edits the same file). "parameters" is a JSON file or a dict.
+
+This process is the supervisor. It collects every rig's StatusBus batches from
+one queue, keeps each rig's state and latest metrics, and prints a combined
+status line every few seconds. Ctrl-C asks every rig to stop after its current
+trial; sessions end normally and are saved.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+import taskControl
+
+
+REPORT_INTERVAL = 5 ## s between combined status lines
+
+
+def _loadJson(source):
+    if isinstance(source, dict):
+        return dict(source)
+    with open(source, 'r') as f:
+        return json.load(f)
+
+
+def loadProfile(rig, entry):
+    """(settings, taskParameters) for one rig's entry in the rigs file."""
+    import controlPanel
+    settings = dict(controlPanel.DEFAULT_SETTINGS)
+    source = entry.get('settings', controlPanel.settingsFile(rig))
+    if isinstance(source, dict) or os.path.isfile(source):
+        settings.update(_loadJson(source))
+    return settings, _loadJson(entry['parameters'])
+
+
+class _QueueWindow:
+    ## stands in for the GUI window a StatusBus posts to: batches go to the supervisor, tagged with the rig
+    def __init__(self, rig, statusQueue):
+        self.rig = rig
+        self.statusQueue = statusQueue
+
+    def write_event_value(self, key, batch):
+        self.statusQueue.put((self.rig, batch))
+
+
+def _forwardCommands(commandQueue, control):
+    ## supervisor -> this rig's TaskControl; None ends the forwarding
+    while True:
+        command = commandQueue.get()
+        if command is None:
+            return
+        name, argument = command
+        if name == 'update':
+            control.updateParameters(argument)
+        else:
+            getattr(control, name)()
+
+
+def rigProcess(rig, settings, taskParameters, statusQueue, commandQueue, simulate=False):
+    """Body of one rig's process: set up its daq and run one session, reporting through statusQueue."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) ## Ctrl-C reaches the supervisor, which stops rigs between trials
+    status = taskControl.StatusBus(_QueueWindow(rig, statusQueue))
+    control = taskControl.TaskControl()
+    threading.Thread(target=_forwardCommands, args=(commandQueue, control), daemon=True).start()
+    tasks = ()
+    try:
+        import controlPanel
+        if simulate:
+            import simDaq
+            backend = simDaq
+        else:
+            import nidaqmx
+            backend = nidaqmx
+        tasks = controlPanel.setupDaq(settings, taskParameters, 'continuous' if taskParameters.get('continuous') else 'task',
+                                      backend=backend)[:4]
+    except Exception as e:
+        status.post('error', text='Could not set up the daq: {!r}'.format(e))
+        status.post('state', state='finished')
+        status.close()
+        return
+    try:
+        controlPanel.runTaskThread(tasks, taskParameters, None, control, status) ## closes status
+    finally:
+        for task in tasks:
+            task.close()
+
+
+class RigSupervisor:
+
+    def __init__(self, profiles, simulate=False, verbose=False, log=print):
+        ## profiles: {rig: (settings, taskParameters)}
+        self.profiles = profiles
+        self.simulate = simulate
+        self.verbose = verbose ## print every rig's log lines, not just state changes and errors
+        self.log = log
+        self.context = multiprocessing.get_context('spawn') ## what Windows uses anyway; no daq handles are inherited
+        self.statusQueue = self.context.Queue()
+        self.commandQueues = {}
+        self.processes = {}
+        self.rigs = {rig: {'state': 'starting', 'trial': None, 'numTrials': taskParameters['numTrials'], 'result': None,
+                           'metrics': None, 'errors': []} for rig, (settings, taskParameters) in profiles.items()}
+
+    def start(self):
+        for rig, (settings, taskParameters) in self.profiles.items():
+            self.commandQueues[rig] = self.context.Queue()
+            process = self.context.Process(target=rigProcess, name='rig-{}'.format(rig), daemon=True,
+                                           args=(rig, settings, taskParameters, self.statusQueue, self.commandQueues[rig], self.simulate))
+            process.start()
+            self.processes[rig] = process
+
+    ## commands are applied by the rig between trials, like the GUI's
+    def command(self, rig, name, argument=None):
+        self.commandQueues[rig].put((name, argument))
+
+    def stopAll(self):
+        for rig in self.processes:
+            if self.running(rig):
+                self.command(rig, 'stop')
+
+    def running(self, rig):
+        return self.rigs[rig]['state'] != 'finished' and self.processes[rig].is_alive()
+
+    def poll(self, timeout=0.1):
+        """Apply the status batches that have arrived; returns the number of batches."""
+        batches = 0
+        while True:
+            try:
+                rig, batch = self.statusQueue.get(timeout=timeout if not batches else 0)
+            except queue.Empty:
+                return batches
+            batches += 1
+            state = self.rigs[rig]
+            for item in batch:
+                if item['kind'] == 'trial':
+                    state.update(trial=item['trial'], numTrials=item['numTrials'], result=item['result'], metrics=item['metrics'])
+                elif item['kind'] == 'state':
+                    state['state'] = item['state']
+                    self.log('[{}] {}'.format(rig, item['state']))
+                elif item['kind'] == 'error':
+                    state['errors'].append(item['text'])
+                    self.log('[{}] {}'.format(rig, item['text']))
+                elif item['kind'] == 'log' and self.verbose:
+                    self.log('\n'.join('[{}] {}'.format(rig, line) for line in item['text'].split('\n')))
+
+    def report(self):
+        lines = []
+        trials = hits = 0
+        for rig, state in self.rigs.items():
+            metrics = state['metrics']
+            if metrics is None:
+                lines.append('{:>8}: {}'.format(rig, state['state']))
+                continue
+            trials += metrics['trials']
+            hits += metrics['counts']['hit']
+            lines.append('{0:>8}: {1:<9} trial {2}/{3}, last {4}, hit rate {5:0.2f}, FA rate {6:0.2f}, d\' {7:0.2f}'.format(
+                rig, state['state'], state['trial']+1, state['numTrials'], state['result'], metrics['hitRate'], metrics['FARate'],
+                metrics['dprime']))
+        lines.append('{:>8}: {} trials, {} rewards on {} rigs'.format('all', trials, hits, len(self.rigs)))
+        return '\n'.join(lines)
+
+    def run(self, reportInterval=REPORT_INTERVAL):
+        """Start every rig and supervise until all sessions have ended; returns each rig's final state."""
+        self.start()
+        lastReport = time.perf_counter()
+        while any(self.running(rig) for rig in self.processes):
+            try:
+                self.poll()
+                if time.perf_counter() - lastReport > reportInterval:
+                    self.log(self.report())
+                    lastReport = time.perf_counter()
+            except KeyboardInterrupt:
+                self.log('Stopping every rig after its current trial')
+                self.stopAll()
+        self.poll(timeout=0)
+        for rig, process in self.processes.items():
+            self.commandQueues[rig].put(None)
+            process.join()
+            if process.exitcode and self.rigs[rig]['state'] != 'finished':
+                self.rigs[rig]['errors'].append('process exited with code {}'.format(process.exitcode))
+        self.log(self.report())
+        return self.rigs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('rigs', help='JSON file mapping rig names to settings and parameters')
+    parser.add_argument('--only', nargs='+', help='run just these rigs from the file')
+    parser.add_argument('--simulate', action='store_true', help='run against the simulated daq (see simDaq)')
+    parser.add_argument('--verbose', action='store_true', help="print every rig's trial log")
+    args = parser.parse_args()
+    entries = _loadJson(args.rigs)
+    profiles = {rig: loadProfile(rig, entry) for rig, entry in entries.items() if not args.only or rig in args.only}
+    RigSupervisor(profiles, simulate=args.simulate, verbose=args.verbose).run()
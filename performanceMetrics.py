@@ -0,0 +1,102 @@
+"""Online performance metrics.
+
+PerformanceMetrics keeps integer-coded outcomes and running counts so that each
+trial updates hit/FA rates, d', windowed rates, lick latencies and per-force
+psychometric counts in constant time, instead of rescanning the whole session.
+"""
+import collections
+
+import numpy as np
+
+
+OUTCOMES = ('hit', 'miss', 'FA', 'CR', 'abort')
+HIT, MISS, FA, CR, ABORT = range(len(OUTCOMES))
+CODES = {outcome: code for code, outcome in enumerate(OUTCOMES)}
+FORCE_BINS = np.arange(0, 80, 10) ## mN; psychometric bins for varyForce sessions (crutch trials land in the top bin)
+
+
+def dprime(hitRate,falseAlarmRate):
+    ## ndtri is the inverse normal cdf (same as scipy.stats.norm.ppf, without the distribution overhead)
+    import scipy.special ## imported on first use: slow to load, and not needed by tools that never score
+    return scipy.special.ndtri(hitRate) - scipy.special.ndtri(falseAlarmRate)
+
+
+def _rate(numerator, other, correction=0):
+    denominator = numerator + other + correction
+    return numerator / denominator if denominator else np.nan
+
+
+class PerformanceMetrics:
+
+    def __init__(self, window=20, forceBins=None):
+        self.counts = np.zeros(len(OUTCOMES), dtype=np.int64)
+        self.window = window
+        self._recent = collections.deque(maxlen=window)
+        self.windowCounts = np.zeros(len(OUTCOMES), dtype=np.int64)
+        self.codes = [] ## integer outcome of every trial, in order
+        self.latencySum = np.zeros(len(OUTCOMES))
+        self.latencyCount = np.zeros(len(OUTCOMES), dtype=np.int64)
+        ## psychometric counts: go trials per force bin (mN) and how many of them were hits
+        self.forceBins = None if forceBins is None else np.asarray(forceBins, dtype=float)
+        if self.forceBins is not None:
+            self.forceTrials = np.zeros(len(self.forceBins) + 1, dtype=np.int64)
+            self.forceHits = np.zeros(len(self.forceBins) + 1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def update(self, result, latency=None, force=None):
+        code = CODES[result]
+        self.codes.append(code)
+        self.counts[code] += 1
+        if len(self._recent) == self.window:
+            self.windowCounts[self._recent[0]] -= 1
+        self._recent.append(code)
+        self.windowCounts[code] += 1
+        if latency is not None:
+            self.latencySum[code] += latency
+            self.latencyCount[code] += 1
+        if self.forceBins is not None and force is not None and code in (HIT, MISS):
+            forceBin = np.searchsorted(self.forceBins, force, side='right')
+            self.forceTrials[forceBin] += 1
+            self.forceHits[forceBin] += code == HIT
+
+    ## running rates keep the +1 in the denominator that the task has always printed
+    @property
+    def hitRate(self):
+        return _rate(self.counts[HIT], self.counts[MISS], 1)
+
+    @property
+    def FARate(self):
+        return _rate(self.counts[FA], self.counts[CR], 1)
+
+    @property
+    def dprime(self):
+        return dprime(self.hitRate, self.FARate)
+
+    @property
+    def windowFull(self):
+        return len(self._recent) == self.window
+
+    @property
+    def windowHitRate(self):
+        return _rate(self.windowCounts[HIT], self.windowCounts[MISS])
+
+    @property
+    def windowFARate(self):
+        return _rate(self.windowCounts[FA], self.windowCounts[CR])
+
+    def meanLatency(self, result='hit'):
+        code = CODES[result]
+        return self.latencySum[code] / self.latencyCount[code] if self.latencyCount[code] else np.nan
+
+    def psychometric(self):
+        ## (bin lower edges in mN, go trials, hit fraction) for each force bin
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.concatenate([[-np.inf], self.forceBins]), self.forceTrials, self.forceHits / self.forceTrials
+
+    def snapshot(self):
+        return {'trials': len(self), 'counts': dict(zip(OUTCOMES, self.counts.tolist())),
+                'hitRate': self.hitRate, 'FARate': self.FARate, 'dprime': self.dprime,
+                'windowHitRate': self.windowHitRate, 'windowFARate': self.windowFARate,
+                'hitLatency': self.meanLatency('hit')}
@@ -0,0 +1,128 @@
+"""Local catalog of saved sessions.
+
+One JSON line per session -- path, animal, date, task parameters and outcome
+counts -- appended as each session is saved, so the GUI can list an animal's
+previous sessions and load their parameters without touching the (possibly
+remote, possibly huge) session files. Later lines for the same path replace
+earlier ones.
+
+Sessions saved before the catalog existed can be added with
+`python sessionCatalog.py <data directory> ...`; session directories only need
+their header read, old pickled sessions have to be loaded once.
+"""
+import json
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+import sessionStorage
+
+
+CATALOG_FILE = os.path.join(os.getcwd(), r'session_catalog.jsonl') ## next to the settings file
+OUTCOMES = ('hit', 'miss', 'FA', 'CR', 'abort')
+_NAME_DATE = re.compile(r'(\d{8}_\d{6})_(.*?)(\.gz)?$')
+
+
+def _parseName(path):
+    ## sessions are named <date>_<time>_<animal>, as a directory or (old sessions) a .gz pickle
+    match = _NAME_DATE.match(os.path.basename(os.path.normpath(path)))
+    if match is None:
+        return None, None
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.strptime(match.group(1), '%Y%m%d_%H%M%S')), match.group(2)
+
+
+def makeEntry(path, taskParameters, counts, date=None):
+    parsedDate, parsedAnimal = _parseName(path)
+    return {'path': os.path.abspath(path), 'animal': taskParameters.get('animal') or parsedAnimal,
+            'date': date or parsedDate or time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(path))),
+            'numTrials': int(sum(counts.values())), 'counts': {outcome: int(counts.get(outcome, 0)) for outcome in OUTCOMES},
+            'taskParameters': taskParameters}
+
+
+def entryFromFile(path):
+    """Catalog entry for a saved session: the header of a session directory, or a full load of an old pickle."""
+    if sessionStorage.sessionPath(path):
+        path = sessionStorage.sessionPath(path)
+        header = sessionStorage.loadHeader(path)
+        counts = header.get('counts')
+        if counts is None: ## written before headers carried counts
+            results = sessionStorage.SessionReader(path).results
+            counts = {outcome: int(np.sum(results == outcome)) for outcome in OUTCOMES}
+        return makeEntry(path, header['taskParameters'], counts)
+    import compress_pickle
+    session = compress_pickle.load(path)
+    results = np.asarray(session.get('results', []))
+    return makeEntry(path, session['taskParameters'], {outcome: int(np.sum(results == outcome)) for outcome in OUTCOMES})
+
+
+def record(entry, catalogFile=CATALOG_FILE):
+    ## appending one line keeps updates cheap and a crash can only lose the line being written
+    with open(catalogFile, 'a') as f:
+        f.write(json.dumps(entry, default=sessionStorage._jsonDefault) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load(catalogFile=CATALOG_FILE):
+    """{path: entry} for every cataloged session."""
+    entries = {}
+    if not os.path.isfile(catalogFile):
+        return entries
+    with open(catalogFile, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue ## partially written line
+            entries[os.path.normcase(entry['path'])] = entry
+    return entries
+
+
+def lookup(path, catalogFile=CATALOG_FILE):
+    path = sessionStorage.sessionPath(path) or path
+    return load(catalogFile).get(os.path.normcase(os.path.abspath(path)))
+
+
+def sessionsFor(animal, catalogFile=CATALOG_FILE):
+    """An animal's sessions, most recent first."""
+    entries = [entry for entry in load(catalogFile).values() if entry['animal'] == animal]
+    return sorted(entries, key=lambda entry: entry['date'], reverse=True)
+
+
+def animals(catalogFile=CATALOG_FILE):
+    return sorted({entry['animal'] for entry in load(catalogFile).values() if entry['animal']})
+
+
+def findSessions(root):
+    """Every saved session under root: session directories and old .gz pickles."""
+    for directory, subdirectories, files in os.walk(root):
+        if sessionStorage.HEADER_FILE in files:
+            yield directory
+            subdirectories[:] = [] ## nothing to find inside a session
+        else:
+            for name in sorted(files):
+                if _NAME_DATE.match(name) and name.endswith('.gz'):
+                    yield os.path.join(directory, name)
+
+
+def indexDirectory(root, catalogFile=CATALOG_FILE, log=print):
+    """Catalog every session under root that is not cataloged yet; returns how many were added."""
+    known = load(catalogFile)
+    added = 0
+    for path in findSessions(root):
+        if os.path.normcase(os.path.abspath(path)) in known:
+            continue
+        try:
+            record(entryFromFile(path), catalogFile)
+            added += 1
+        except Exception as e:
+            log('skipping {}: {!r}'.format(path, e))
+    return added
+
+
+if __name__ == '__main__':
+    for root in sys.argv[1:]:
+        print('{}: {} sessions added to {}'.format(root, indexDirectory(root), CATALOG_FILE))
@@ -0,0 +1,138 @@
+"""Headless session runner.
+
+`python sessionRunner.py mouse1.json mouse2.json ...` runs sessions back to back
+without a window, for scripted runs and unattended overnight training. Each
+argument is a parameter file with the keys updateParameters produces (a JSON
+dict, or a list of dicts to queue several sessions from one file) or a saved
+session, whose parameters are reused as with Load Parameters. DAQ settings come
+from --settings, or from a rig's profile with --rig (see
+controlPanel.settingsFile).
+
+The daq tasks stay in one DaqPool for the whole queue, so back-to-back sessions
+with the same sample rate and trial length reuse them. A session that fails is
+reported and the queue moves on to the next one, on newly created tasks. Ctrl-C
+stops the running session after its current trial (it is saved as usual) and
+drops the rest of the queue; a second Ctrl-C aborts.
+
+Only the light parts of the code are imported up front: the daq driver, scipy
+and the GUI toolkit load on first use (see controlPanel.LazyModule), so the
+runner starts quickly.
+"""
+import argparse
+import json
+import os
+import signal
+import time
+
+import controlPanel
+import sessionCatalog
+import sessionStorage
+import taskControl
+
+
+## keys runTask reads without a default; everything else updateParameters produces is optional
+REQUIRED_PARAMETERS = ('numTrials', 'Fs', 'downSample', 'trialDuration', 'falseAlarmTimeout', 'playTone', 'enablePunish',
+                       'timeToTone', 'varyTone', 'abortEarlyLick', 'rewardWindowDuration', 'rewardAllGos', 'goProbability',
+                       'alternate', 'force', 'varyForce', 'forceTime', 'forceDuration', 'forceContinuous', 'savePath', 'save',
+                       'animal')
+
+
+def loadQueue(sources):
+    """[(label, taskParameters)] for parameter files (a dict or a list of dicts) and saved sessions, in order."""
+    sessions = []
+    for source in sources:
+        if sessionStorage.sessionPath(source) or source.endswith('.gz'):
+            entry = sessionCatalog.lookup(source) or sessionCatalog.entryFromFile(source)
+            taskParameters = dict(entry['taskParameters'])
+            taskParameters.pop('seed', None) ## like Load Parameters: same settings, new trial order
+            sessions.append((source, taskParameters))
+            continue
+        with open(source, 'r') as f:
+            loaded = json.load(f)
+        if isinstance(loaded, dict):
+            sessions.append((source, loaded))
+        else:
+            sessions.extend(('{}[{}]'.format(source, i), taskParameters) for i, taskParameters in enumerate(loaded))
+    for label, taskParameters in sessions:
+        missing = [key for key in REQUIRED_PARAMETERS if key not in taskParameters]
+        if missing:
+            raise ValueError('{} is missing {}'.format(label, ', '.join(missing)))
+    return sessions
+
+
+def runQueue(sessions, settings, backend=None, wait=0, log=print, catalog=sessionCatalog.CATALOG_FILE):
+    """Run the sessions one after another on one set of daq tasks; returns a summary per session."""
+    pool = controlPanel.DaqPool(settings, backend or controlPanel.nidaqmx)
+    state = {'control': None, 'stopping': False}
+
+    def onInterrupt(signum, frame):
+        if state['stopping']:
+            raise KeyboardInterrupt
+        state['stopping'] = True
+        log('\nStopping after the current trial; the rest of the queue is skipped (Ctrl-C again to abort)')
+        if state['control'] is not None:
+            state['control'].stop()
+
+    previousHandler = signal.signal(signal.SIGINT, onInterrupt)
+    summaries = []
+    try:
+        for number, (label, taskParameters) in enumerate(sessions):
+            if state['stopping']:
+                summaries.append({'label': label, 'skipped': True})
+                continue
+            if number and wait:
+                log('Waiting {} s before the next session'.format(wait))
+                time.sleep(wait)
+            log('Session {} of {}: {} ({})'.format(number+1, len(sessions), taskParameters['animal'], label))
+            taskParameters = dict(taskParameters)
+            state['control'] = control = taskControl.TaskControl()
+            if state['stopping']: ## interrupted while waiting
+                control.stop()
+            try:
+                tasks = pool.acquire('continuous' if taskParameters.get('continuous') else 'task', taskParameters)
+                summary = controlPanel.runTask(*tasks, taskParameters, control=control, catalog=catalog)
+                summaries.append({'label': label, 'animal': taskParameters['animal'], 'session': summary.get('session'),
+                                  'counts': summary['metrics']['counts'], 'dprime': summary['metrics']['dprime']})
+            except Exception as e:
+                log('Session {} failed: {!r}'.format(label, e))
+                summaries.append({'label': label, 'animal': taskParameters['animal'], 'error': repr(e)})
+                pool.close() ## whatever state the failed session left its tasks in, the next one gets new ones
+            state['control'] = None
+    finally:
+        signal.signal(signal.SIGINT, previousHandler)
+        pool.close()
+    return summaries
+
+
+def report(summaries):
+    lines = ['Ran {} of {} sessions'.format(sum('counts' in summary for summary in summaries), len(summaries))]
+    for summary in summaries:
+        if summary.get('skipped'):
+            lines.append('\t{}: skipped'.format(summary['label']))
+        elif 'error' in summary:
+            lines.append('\t{}: failed, {}'.format(summary['label'], summary['error']))
+        else:
+            lines.append('\t{0}: {1}, {2} trials, {3} hits, d\' = {4:0.2f}{5}'.format(
+                summary['label'], summary['animal'], sum(summary['counts'].values()), summary['counts']['hit'], summary['dprime'],
+                ', saved in {}'.format(summary['session']) if summary['session'] else ''))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('sources', nargs='+', help='parameter files (JSON) or saved sessions, run in order')
+    parser.add_argument('--settings', help='daq settings file (default: the settings file the GUI uses)')
+    parser.add_argument('--rig', help="use this rig's settings profile")
+    parser.add_argument('--wait', type=float, default=0, help='seconds between sessions')
+    parser.add_argument('--simulate', action='store_true', help='run against the simulated daq (see simDaq)')
+    args = parser.parse_args()
+    settingsFile = args.settings or controlPanel.settingsFile(args.rig)
+    settings = dict(controlPanel.DEFAULT_SETTINGS)
+    if os.path.isfile(settingsFile):
+        with open(settingsFile, 'r') as f:
+            settings.update(json.load(f))
+    backend = None
+    if args.simulate:
+        import simDaq
+        backend = simDaq
+    print(report(runQueue(loadQueue(args.sources), settings, backend, args.wait)))
@@ -0,0 +1,335 @@
+"""Append-only session storage.
+
+A session is a directory holding a small JSON header, one raw binary file per
+data stream (ai, ao, di_events, do_events, ...) and a trial index. Each trial is appended to
+the stream files once, as it finishes, and only becomes part of the session
+when its index line has been flushed -- so a crash loses at most the trials not
+yet written (see AsyncSessionWriter), never the ones before them. Streams have a fixed dtype per session, which lets readers memory-map
+them instead of decompressing and unpickling the whole session.
+
+Trials can optionally be compressed chunk by chunk (see CODECS), with an
+optional byte-shuffle filter; compressed sessions are read trial by trial
+instead of memory-mapped. AsyncSessionWriter moves all of the writing onto a
+background thread so the trial loop never waits on the disk; its queue is kept
+short, so a crash can lose at most maxPending + 1 finished trials.
+"""
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+
+import numpy as np
+
+import digitalEvents
+import instrumentation
+
+
+FORMAT_VERSION = 1
+HEADER_FILE = 'header.json'
+INDEX_FILE = 'trials.jsonl'
+STREAM_EXTENSION = '.dat'
+
+
+## codec name -> (compress, decompress); fast codecs are only offered if their package is installed
+CODECS = {'none': (bytes, bytes),
+          'gzip': (lambda data: zlib.compress(data, 6), zlib.decompress),
+          'gzip1': (lambda data: zlib.compress(data, 1), zlib.decompress)}
+try:
+    import lz4.frame
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+try:
+    import zstandard
+    CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
+
+
+def shuffleBytes(data, itemsize):
+    ## groups the n-th byte of every item together, which makes slowly varying samples compress much better
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, itemsize).T.tobytes()
+
+
+def unshuffleBytes(data, itemsize):
+    return np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+
+
+def _jsonDefault(obj):
+    ## taskParameters can pick up numpy scalars/arrays from runTrial
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+
+def _writeJsonAtomic(fileName, obj):
+    tempName = fileName + '.tmp'
+    with open(tempName, 'w') as f:
+        json.dump(obj, f, default=_jsonDefault, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tempName, fileName)
+
+
+def sessionPath(path):
+    """Return the session directory for a session directory or any file inside one, else None."""
+    if os.path.isfile(path):
+        path = os.path.dirname(path)
+    if os.path.isfile(os.path.join(path, HEADER_FILE)):
+        return path
+    return None
+
+
+def makeSessionDirectory(path):
+    """Create the session directory; returns the name used, path_1, path_2, ... if path is taken."""
+    ## session names have one-second resolution, so back-to-back sessions for one animal can collide
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    candidate = path
+    for suffix in range(1, 1000):
+        try:
+            os.mkdir(candidate)
+            return candidate
+        except FileExistsError:
+            candidate = '{}_{}'.format(path, suffix)
+    raise FileExistsError('no free session directory name for {}'.format(path))
+
+
+def loadHeader(path):
+    with open(os.path.join(sessionPath(path) or path, HEADER_FILE), 'r') as f:
+        return json.load(f)
+
+
+class SessionWriter:
+    """Writes one session, one trial at a time."""
+
+    def __init__(self, path, header, codec='none', shuffle=False):
+        if codec not in CODECS:
+            raise ValueError('unknown codec {}, available: {}'.format(codec, ', '.join(CODECS)))
+        self.path = path = makeSessionDirectory(path) ## may differ from the name asked for, see makeSessionDirectory
+        self.compress = CODECS[codec][0]
+        self.shuffle = shuffle
+        self.header = dict(header)
+        self.header['formatVersion'] = FORMAT_VERSION
+        self.header['codec'] = codec
+        self.header['shuffle'] = shuffle
+        self.header['streams'] = {}
+        self.header['complete'] = False
+        self.numTrials = 0
+        self.bytesWritten = 0
+        self._streams = {}
+        self._index = open(os.path.join(path, INDEX_FILE), 'a')
+        _writeJsonAtomic(os.path.join(path, HEADER_FILE), self.header)
+
+    def _stream(self, name, dtype):
+        if name not in self._streams:
+            if name in self.header['streams']:
+                raise ValueError('stream {} was already closed'.format(name))
+            self.header['streams'][name] = dtype.str
+            _writeJsonAtomic(os.path.join(self.path, HEADER_FILE), self.header)
+            self._streams[name] = open(os.path.join(self.path, name + STREAM_EXTENSION), 'ab')
+        elif self.header['streams'][name] != dtype.str:
+            raise ValueError('stream {} has dtype {}, got {}'.format(name, self.header['streams'][name], dtype.str))
+        return self._streams[name]
+
+    def appendTrial(self, trial, arrays, **info):
+        """Append a trial's arrays ({stream name: array}) plus JSON-able info (result etc.)."""
+        entry = {'trial': trial}
+        entry.update(info)
+        entry['streams'] = {}
+        touched = []
+        for name, data in arrays.items():
+            data = np.ascontiguousarray(data)
+            f = self._stream(name, data.dtype)
+            raw = data.tobytes()
+            if self.shuffle and data.itemsize > 1:
+                raw = shuffleBytes(raw, data.itemsize)
+            chunk = self.compress(raw)
+            entry['streams'][name] = {'offset': f.tell(), 'nbytes': len(chunk), 'shape': list(data.shape)}
+            f.write(chunk)
+            self.bytesWritten += len(chunk)
+            touched.append(f)
+        ## data first, index line last: a trial only exists once its index line is on disk
+        for f in touched:
+            f.flush()
+            os.fsync(f.fileno())
+        self._index.write(json.dumps(entry, default=_jsonDefault) + '\n')
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        self.numTrials += 1
+
+    def updateHeader(self, **fields):
+        self.header.update(fields)
+        _writeJsonAtomic(os.path.join(self.path, HEADER_FILE), self.header)
+
+    def close(self, **fields):
+        for f in self._streams.values():
+            f.close()
+        self._index.close()
+        self.updateHeader(complete=True, numTrials=self.numTrials, **fields)
+
+
+class AsyncSessionWriter:
+    """Runs a SessionWriter on a background thread behind a bounded queue.
+
+    appendTrial only enqueues; it waits only if the disk has fallen maxPending
+    trials behind, and that wait is counted in stalls/stallTime. Queued trials
+    and the one being written are lost if the process dies, so maxPending is
+    kept small: one trial lasts seconds and is written in milliseconds, and a
+    few trials of slack are enough to ride out a slow disk. Writes are
+    also reported to timer (see instrumentation), which can be set after the
+    session directory exists.
+    """
+
+    def __init__(self, path, header, codec='none', shuffle=False, maxPending=4, timer=instrumentation.NULL_TIMER):
+        self.writer = SessionWriter(path, header, codec, shuffle)
+        self.path = self.writer.path
+        self.timer = timer
+        self._queue = queue.Queue(maxsize=maxPending)
+        self.stalls = 0
+        self.stallTime = 0
+        self.writeTime = 0
+        self.error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            trial, arrays, info, onWritten = item
+            t0 = time.perf_counter()
+            bytesWritten = self.writer.bytesWritten
+            try:
+                with self.timer.span('save'):
+                    self.writer.appendTrial(trial, arrays, **info)
+            except Exception as e:
+                self.error = e
+            self.writeTime += time.perf_counter() - t0
+            self.timer.count('bytesWritten', self.writer.bytesWritten - bytesWritten)
+            if onWritten is not None:
+                onWritten()
+
+    def appendTrial(self, trial, arrays, onWritten=None, **info):
+        """Queue a trial; the arrays must not change until onWritten() has been called."""
+        if self.error is not None:
+            raise self.error
+        item = (trial, arrays, info, onWritten)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            t0 = time.perf_counter()
+            self._queue.put(item)
+            self.stalls += 1
+            self.stallTime += time.perf_counter() - t0
+
+    def close(self, **fields):
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.close(**fields)
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        return 'Wrote {0} trials ({1:0.1f} MB) in {2:0.2f} s on the writer thread; trial loop stalled {3} times ({4:0.2f} s)'.format(
+            self.writer.numTrials, self.writer.bytesWritten/1e6, self.writeTime, self.stalls, self.stallTime)
+
+
+class SessionReader:
+    """Memory-mapped access to a session written by SessionWriter."""
+
+    def __init__(self, path):
+        self.path = sessionPath(path) or path
+        self.header = loadHeader(self.path)
+        self.trials = []
+        with open(os.path.join(self.path, INDEX_FILE), 'r') as f:
+            for line in f:
+                try:
+                    self.trials.append(json.loads(line))
+                except ValueError:
+                    break ## partially written line from a crash
+        self._maps = {}
+        self._files = {}
+        self.decompress = CODECS[self.header.get('codec', 'none')][1]
+        self.shuffle = self.header.get('shuffle', False)
+        self.mapped = self.header.get('codec', 'none') == 'none' and not self.shuffle
+
+    def __len__(self):
+        return len(self.trials)
+
+    @property
+    def results(self):
+        return np.array([t.get('result') for t in self.trials])
+
+    def stream(self, name):
+        if not self.mapped:
+            raise ValueError('{} is compressed; read it with trial()'.format(self.path))
+        if name not in self._maps:
+            fileName = os.path.join(self.path, name + STREAM_EXTENSION)
+            dtype = np.dtype(self.header['streams'][name])
+            if os.path.getsize(fileName) == 0:
+                self._maps[name] = np.zeros(0, dtype=dtype)
+            else:
+                self._maps[name] = np.memmap(fileName, dtype=dtype, mode='r')
+        return self._maps[name]
+
+    def _readChunk(self, name, entry):
+        if name not in self._files:
+            self._files[name] = open(os.path.join(self.path, name + STREAM_EXTENSION), 'rb')
+        f = self._files[name]
+        f.seek(entry['offset'])
+        dtype = np.dtype(self.header['streams'][name])
+        raw = self.decompress(f.read(entry['nbytes']))
+        if self.shuffle and dtype.itemsize > 1:
+            raw = unshuffleBytes(raw, dtype.itemsize)
+        return np.frombuffer(raw, dtype=dtype).reshape(entry['shape'])
+
+    def trial(self, trial, name):
+        entry = self.trials[trial]['streams'][name]
+        if not self.mapped:
+            return self._readChunk(name, entry)
+        data = self.stream(name)
+        start = entry['offset'] // data.itemsize
+        return data[start:start + int(np.prod(entry['shape']))].reshape(entry['shape'])
+
+    def digital(self, trial, name, factor=None):
+        """Dense bool traces for an event stream (e.g. 'do_events'); factor defaults to the session's downsampling."""
+        channels = self.header['channels'][name.split('_')[0]]
+        if name.endswith('_iti_events'): ## inter-trial data is not downsampled
+            numSamples, factor = self.trials[trial]['streams']['ai_iti']['shape'][-1], factor or 1
+        else:
+            numSamples, factor = self.trials[trial]['numSamples'], factor or self.header.get('downsampleFactor', 1)
+        return digitalEvents.eventsToDense(self.trial(trial, name), len(channels), numSamples, factor)
+
+
+def scaleAnalog(raw, scaling):
+    """Convert raw (channels x samples) int16 data to volts with per-channel polynomial coefficients."""
+    return np.array([np.polynomial.polynomial.polyval(channel, coefficients) for channel, coefficients in zip(raw, scaling)])
+
+
+def loadSession(path):
+    """Load a session into the dictionary layout runTask used to pickle (analog inputs in volts)."""
+    session = SessionReader(path)
+    outDict = {'taskParameters': session.header['taskParameters'], 'results': session.results}
+    scaling = session.header.get('scaling', {})
+    for name in session.header['streams']:
+        base = name.split('_')[0]
+        if name.endswith('_events'): ## digital lines come back as dense traces, like the analog ones
+            key = name[:-len('_events')]
+            outDict[key + '_data'] = {i: session.digital(i, name) for i in range(len(session))}
+            if len(session.header['channels'][base]) == 1:
+                outDict[key + '_data'] = {i: data[0] for i, data in outDict[key + '_data'].items()}
+        else:
+            key = name
+            outDict[key + '_data'] = {i: session.trial(i, name) for i in range(len(session))}
+            if base in scaling:
+                outDict[key + '_data'] = {i: scaleAnalog(data, scaling[base]) for i, data in outDict[key + '_data'].items()}
+        outDict[key + '_channels'] = session.header['channels'].get(base)
+    return outDict
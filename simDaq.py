@@ -0,0 +1,571 @@
+"""Simulated DAQ backend.
+
+A drop-in stand-in for the parts of nidaqmx that controlPanel uses (Task with
+AI/DI/AO/DO channels, sample clock and start-trigger timing, every-N-samples
+callbacks, and the unscaled/port-byte stream readers), so the trial loop can be
+run, profiled and benchmarked without an NI card or the Arduino.
+
+All tasks created while a SimDevice is active share its sample clock. Starting
+the task that owns the 'trigger' line starts the device; it then turns the
+AO/DO samples written by the tasks into AI/DI samples, block by block, through
+a SimMouse (who licks according to configurable hit/FA probabilities and
+latencies) and a SimArduino (which mirrors mainTask.ino's reward, punish and
+abort logic). speed scales the simulated clock; speed=None runs as fast as the
+host allows.
+
+    import simDaq, controlPanel
+    simDaq.useDevice(simDaq.SimDevice(speed=None, mouse=simDaq.SimMouse(hitProbability=0.9)))
+    tasks = controlPanel.setupDaq(settings, taskParameters, backend=simDaq)
+"""
+import re
+import threading
+import time
+import types
+
+import numpy as np
+from nidaqmx import constants ## re-exported, so callers can take the enums from whichever backend they were given
+from nidaqmx.constants import AcquisitionType, RegenerationMode, TaskMode
+
+
+VOLTS_PER_COUNT = 10 / 32768 ## +-10 V range on a 16 bit converter
+
+
+class SimMouse:
+    """Licks in response to the tone (go: hitProbability, no-go: faProbability) plus spontaneous licks."""
+
+    def __init__(self, hitProbability=0.8, faProbability=0.2, latency=0.3, latencySD=0.1,
+                 spontaneousRate=0.05, lickRate=7, lickDuration=0.02, boutDuration=1., seed=None):
+        self.hitProbability = hitProbability
+        self.faProbability = faProbability
+        self.latency = latency
+        self.latencySD = latencySD
+        self.spontaneousRate = spontaneousRate ## Hz
+        self.lickRate = lickRate ## Hz, within a bout
+        self.lickDuration = lickDuration
+        self.boutDuration = boutDuration
+        self.random = np.random.default_rng(seed)
+
+    def respond(self, goTrial):
+        return self.random.random() < (self.hitProbability if goTrial else self.faProbability)
+
+    def responseLatency(self):
+        return max(self.random.normal(self.latency, self.latencySD), 0.01)
+
+    def spontaneousLicks(self, numSamples, Fs):
+        return np.sort(self.random.integers(0, numSamples, self.random.poisson(self.spontaneousRate * numSamples / Fs)))
+
+    def bout(self, onset, Fs):
+        ## (start, stop) samples of each lick in a bout
+        starts = onset + np.int64(np.arange(0, self.boutDuration, 1 / self.lickRate) * Fs)
+        return [(start, start + int(self.lickDuration * Fs)) for start in starts]
+
+
+class SimArduino:
+    """mainTask.ino: tone on toneControl, reward/punish on lick during their windows, abort lockout on early licks."""
+
+    REWARD_LOCKOUT = 3. ## s; the sketch's delay(3000) after a reward or punishment
+    ABORT_LOCKOUT = 5. ## s; delay(5000) after a lick in the abort window
+
+    def __init__(self):
+        self.lockedUntil = -1
+        self.rewards = 0
+        self.punishments = 0
+        self.squirts = 0
+        self.tones = 0
+        self.aborts = 0
+
+
+class _Stopped(Exception):
+    pass
+
+
+class SimResourceError(RuntimeError):
+    """Raised like nidaqmx's 'resource is reserved' error when two tasks claim the same lines."""
+
+
+class _Channels(list):
+    def __init__(self, task, kind):
+        super().__init__()
+        self.task, self.kind = task, kind
+
+    def _add(self, physical, name):
+        channel = types.SimpleNamespace(physical_channel=physical, name=name or physical,
+                                        ai_dev_scaling_coeff=[0., VOLTS_PER_COUNT])
+        self.append(channel)
+        self.task.channel_names.append(channel.name)
+        return channel
+
+    def add_ai_voltage_chan(self, physical_channel, name_to_assign_to_channel='', **kwargs):
+        return self._add(physical_channel, name_to_assign_to_channel)
+
+    def add_ao_voltage_chan(self, physical_channel, name_to_assign_to_channel='', **kwargs):
+        return self._add(physical_channel, name_to_assign_to_channel)
+
+    def add_di_chan(self, lines, name_to_assign_to_lines='', **kwargs):
+        return self._add(lines, name_to_assign_to_lines)
+
+    def add_do_chan(self, lines, name_to_assign_to_lines='', **kwargs):
+        return self._add(lines, name_to_assign_to_lines)
+
+    def add_ci_count_edges_chan(self, counter, name_to_assign_to_channel='', **kwargs):
+        channel = self._add(counter, name_to_assign_to_channel)
+        channel.ci_count_edges_term = None
+        return channel
+
+
+class _Timing:
+    def __init__(self, task):
+        self.task = task
+        self.rate = None
+        self.source = None
+        self.sample_mode = None
+        self.samps_per_chan = 0
+        self.changeDetection = False
+
+    def cfg_samp_clk_timing(self, rate, source='', active_edge=None, sample_mode=AcquisitionType.FINITE, samps_per_chan=1000):
+        self.rate, self.source, self.sample_mode, self.samps_per_chan = rate, source, sample_mode, samps_per_chan
+
+    def cfg_change_detection_timing(self, rising_edge_chan='', falling_edge_chan='', sample_mode=AcquisitionType.CONTINUOUS, samps_per_chan=1000):
+        self.sample_mode, self.samps_per_chan, self.changeDetection = sample_mode, samps_per_chan, True
+
+    @property
+    def onChangeDetection(self):
+        ## sampled on the change detection event (a timestamp counter), not on a clock
+        return bool(self.source) and self.source.endswith('ChangeDetectionEvent')
+
+
+class _StartTrigger:
+    def __init__(self):
+        self.source = None
+
+    def cfg_dig_edge_start_trig(self, trigger_source, trigger_edge=None):
+        self.source = trigger_source
+
+    def disable_start_trig(self):
+        self.source = None
+
+
+class Task:
+
+    def __init__(self, new_task_name='', device=None):
+        self.name = new_task_name
+        self.device = device or _device
+        self.channel_names = []
+        self.ai_channels = _Channels(self, 'ai')
+        self.di_channels = _Channels(self, 'di')
+        self.ao_channels = _Channels(self, 'ao')
+        self.do_channels = _Channels(self, 'do')
+        self.ci_channels = _Channels(self, 'ci')
+        self.timing = _Timing(self)
+        self.triggers = types.SimpleNamespace(start_trigger=_StartTrigger())
+        self.out_stream = types.SimpleNamespace(regen_mode=RegenerationMode.ALLOW_REGENERATION)
+        self.in_stream = self
+        self.running = False
+        self.closed = False
+        self._condition = threading.Condition()
+        self._input = [] ## acquired chunks not read yet
+        self._available = 0
+        self._output = None ## finite: the written buffer; continuous: list of pending chunks
+        self._outputPending = 0
+        self._callback = None
+        self._sinceCallback = 0
+        self.reserved = False ## holds its lines, either while running or after an explicit commit
+        self._committed = False
+        self.device.tasks.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def kind(self):
+        for kind in ('ai', 'di', 'ao', 'do', 'ci'):
+            if len(getattr(self, kind + '_channels')):
+                return kind
+
+    @property
+    def continuous(self):
+        return self.timing.sample_mode == AcquisitionType.CONTINUOUS
+
+    def register_every_n_samples_acquired_into_buffer_event(self, sample_interval, callback_method):
+        self._callback = (sample_interval, callback_method) if callback_method is not None else None
+
+    ## ---- output ----
+    def write(self, data, auto_start=False, timeout=10.0):
+        data = np.asarray(data)
+        data = data.reshape(len(self.channel_names), -1)
+        if not self.continuous:
+            self._output = data.copy()
+            return data.shape[1]
+        with self._condition:
+            if self._output is None or not isinstance(self._output, list):
+                self._output = []
+            ## non-regenerative output blocks while the device buffer is full
+            bufferSize = max(self.timing.samps_per_chan, data.shape[1])
+            if not self._condition.wait_for(lambda: self._outputPending + data.shape[1] <= bufferSize or not self.running and self._outputPending == 0 or self.device.error,
+                                            timeout):
+                raise TimeoutError('simulated output write timed out')
+            if self.device.error:
+                raise self.device.error
+            self._output.append(data.copy())
+            self._outputPending += data.shape[1]
+            self._condition.notify_all()
+        return data.shape[1]
+
+    def _consume(self, n, wait):
+        ## next n output samples for the device
+        if not self.continuous:
+            chunk = self._output[:, self.device.position:self.device.position + n]
+            return chunk
+        with self._condition:
+            if wait:
+                self._condition.wait_for(lambda: self._outputPending >= n or not self.running or self.device._stopping)
+            if self.device._stopping:
+                raise _Stopped()
+            if self._outputPending < n:
+                raise RuntimeError('simulated output underflow on task {}'.format(self.name or self.channel_names))
+            out, need = [], n
+            while need:
+                chunk = self._output[0]
+                out.append(chunk[:, :need])
+                if chunk.shape[1] <= need:
+                    self._output.pop(0)
+                else:
+                    self._output[0] = chunk[:, need:]
+                need -= out[-1].shape[1]
+            self._outputPending -= n
+            self._condition.notify_all()
+        return np.concatenate(out, axis=1)
+
+    ## ---- input ----
+    @property
+    def avail_samp_per_chan(self):
+        return self._available
+
+    def _produce(self, data):
+        with self._condition:
+            self._input.append(data)
+            self._available += data.shape[1]
+            self._condition.notify_all()
+        if self._callback is not None:
+            self._sinceCallback += data.shape[1]
+            interval, callback = self._callback
+            while self._sinceCallback >= interval:
+                self._sinceCallback -= interval
+                callback(None, None, interval, None)
+
+    def _readRaw(self, n, timeout=10.0):
+        if n == -1:
+            n = self._available
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._available >= n or self.device.error, timeout):
+                raise TimeoutError('simulated read of {} samples timed out'.format(n))
+            if self.device.error:
+                raise self.device.error
+            out, need = [], n
+            while need:
+                chunk = self._input[0]
+                out.append(chunk[:, :need])
+                if chunk.shape[1] <= need:
+                    self._input.pop(0)
+                else:
+                    self._input[0] = chunk[:, need:]
+                need -= out[-1].shape[1]
+            self._available -= n
+        return np.concatenate(out, axis=1) if out else np.zeros((len(self.channel_names), 0))
+
+    def read(self, number_of_samples_per_channel=1, timeout=10.0):
+        data = self._readRaw(number_of_samples_per_channel, timeout)
+        if self.kind == 'ai':
+            data = data * VOLTS_PER_COUNT
+        else:
+            data = data != 0
+        data = data.tolist()
+        return data[0] if len(self.channel_names) == 1 else data
+
+    ## ---- control ----
+    def _physicalChannels(self):
+        return {channel.physical_channel for kind in ('ai', 'di', 'ao', 'do', 'ci') for channel in getattr(self, kind + '_channels')}
+
+    def _reserve(self):
+        if self.reserved:
+            return
+        lines = self._physicalChannels()
+        for other in self.device.tasks:
+            if other is not self and other.reserved and lines & other._physicalChannels():
+                raise SimResourceError('{} reserved by another task'.format(', '.join(sorted(lines & other._physicalChannels()))))
+        if self.device.reserveTime:
+            time.sleep(self.device.reserveTime)
+        self.reserved = True
+
+    def control(self, action):
+        if action in (TaskMode.TASK_RESERVE, TaskMode.TASK_COMMIT):
+            self._reserve()
+            self._committed = True
+        elif action == TaskMode.TASK_UNRESERVE:
+            self.stop()
+            self.reserved = self._committed = False
+        elif action == TaskMode.TASK_ABORT:
+            self.stop()
+
+    def start(self):
+        self._reserve() ## implicit reservation for an uncommitted task, undone by stop
+        with self._condition:
+            self._input, self._available, self._sinceCallback = [], 0, 0
+            if self.continuous and self.kind in ('ao', 'do') and not isinstance(self._output, list):
+                self._output, self._outputPending = [], 0
+        self.startPosition = self.device.absolutePosition
+        self._lastLevel = 0
+        self.running = True
+        self.device.taskStarted(self)
+
+    def wait_until_done(self, timeout=10.0):
+        if not self.device.done.wait(timeout):
+            raise TimeoutError('simulated task did not finish')
+        if self.device.error:
+            raise self.device.error
+
+    def is_task_done(self):
+        return self.device.done.is_set()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.device.taskStopped(self)
+        if not self._committed: ## a committed task goes back to the committed state instead
+            self.reserved = False
+        with self._condition:
+            self._condition.notify_all()
+
+    def close(self):
+        self.stop()
+        self.reserved = self._committed = False
+        self.closed = True
+        if self in self.device.tasks:
+            self.device.tasks.remove(self)
+
+
+class _AnalogUnscaledReader:
+    def __init__(self, in_stream):
+        self.task = in_stream
+
+    def read_int16(self, data, number_of_samples_per_channel=-1, timeout=10.0):
+        raw = self.task._readRaw(number_of_samples_per_channel, timeout)
+        data[:, :raw.shape[1]] = raw
+        return raw.shape[1]
+
+
+class _CounterReader:
+    def __init__(self, in_stream):
+        self.task = in_stream
+
+    def read_many_sample_uint32(self, data, number_of_samples_per_channel=-1, timeout=10.0):
+        raw = self.task._readRaw(number_of_samples_per_channel, timeout)
+        data[:raw.shape[1]] = raw[0]
+        return raw.shape[1]
+
+
+class _DigitalSingleChannelReader:
+    def __init__(self, in_stream):
+        self.task = in_stream
+
+    def read_many_sample_port_byte(self, data, number_of_samples_per_channel=-1, timeout=10.0):
+        raw = self.task._readRaw(number_of_samples_per_channel, timeout)
+        data[:raw.shape[1]] = raw[0]
+        return raw.shape[1]
+
+
+stream_readers = types.SimpleNamespace(AnalogUnscaledReader=_AnalogUnscaledReader,
+                                       DigitalSingleChannelReader=_DigitalSingleChannelReader,
+                                       CounterReader=_CounterReader)
+
+
+def _timebaseHz(terminal):
+    match = re.search(r'(\d+)(k|M)HzTimebase', terminal or '')
+    return int(match.group(1)) * (1e3 if match.group(2) == 'k' else 1e6) if match else 1e5
+
+
+def _lineBit(lines):
+    match = re.search(r'line(\d+)', lines)
+    return 1 << int(match.group(1)) if match else 1
+
+
+class SimDevice:
+    """Shared clock, trigger and plant (mouse + Arduino) for the tasks created against it."""
+
+    def __init__(self, speed=1., mouse=None, arduino=None, blockDuration=0.005, forceThreshold=0.05, noise=0.002, reserveTime=0.,
+                 changeDetectionRate=10000):
+        self.speed = speed
+        self.changeDetectionRate = changeDetectionRate ## Hz; how finely lick edges are resolved when only a change-detection task runs
+        self.reserveTime = reserveTime ## s a task takes to reserve its lines (commit, or start when uncommitted)
+        self.mouse = mouse or SimMouse()
+        self.arduino = arduino or SimArduino()
+        self.blockDuration = blockDuration
+        self.forceThreshold = forceThreshold ## V on force_out that the mouse feels as a go stimulus
+        self.noise = noise ## V rms on the analog inputs
+        self.tasks = []
+        self.done = threading.Event()
+        self.done.set()
+        self.error = None
+        self.position = 0
+        self.absolutePosition = 0 ## samples since the device was created, across runs
+        self.runs = [] ## (wall start, wall stop, samples) of every hardware run, for benchmarks
+        self._licks = []
+        self._previousDo = None
+        self._thread = None
+        self._stopping = False
+
+    def _tasksOf(self, kind):
+        return [task for task in self.tasks if task.kind == kind and task.running]
+
+    def taskStarted(self, task):
+        ## the task driving the trigger line starts the clock for every armed task
+        if task.kind == 'do' and 'trigger' in task.channel_names or task.kind == 'do' and self._thread is None and not self._tasksOf('ai'):
+            self._start(task)
+        elif task.timing.changeDetection and self._thread is None: ## a lick monitor runs on its own
+            self._start(task)
+
+    def taskStopped(self, task):
+        if task is getattr(self, 'master', None):
+            self._stopping = True
+            for other in self.tasks:
+                with other._condition:
+                    other._condition.notify_all()
+            if self._thread is not None and self._thread is not threading.current_thread():
+                self._thread.join()
+            self._thread = None
+
+    def _start(self, master):
+        self.master = master
+        self.Fs = master.timing.rate or self.changeDetectionRate
+        self.numSamples = None if master.continuous else master.timing.samps_per_chan
+        self.position = 0
+        self.error = None
+        self._stopping = False
+        self.done.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        block = max(int(self.blockDuration * self.Fs), 1)
+        t0 = time.perf_counter()
+        try:
+            while not self._stopping and (self.numSamples is None or self.position < self.numSamples):
+                n = block if self.numSamples is None else min(block, self.numSamples - self.position)
+                if self.speed:
+                    delay = t0 + (self.position + n) / self.Fs / self.speed - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                self._step(n)
+                self.position += n
+                self.absolutePosition += n
+        except _Stopped:
+            pass
+        except Exception as e:
+            self.error = e
+            for task in self.tasks:
+                with task._condition:
+                    task._condition.notify_all()
+        self.runs.append((t0, time.perf_counter(), self.position))
+        self.done.set()
+
+    def _outputs(self, kind, n):
+        out = {}
+        for task in self._tasksOf(kind):
+            if task._output is None:
+                continue
+            data = task._consume(n, wait=not self.speed)
+            for name, row in zip(task.channel_names, data):
+                out[name] = row
+        return out
+
+    def _step(self, n):
+        Fs = self.Fs
+        ao = self._outputs('ao', n)
+        do = self._outputs('do', n)
+        start = self.absolutePosition
+        zeros = np.zeros(n, dtype='bool')
+        line = lambda name: do.get(name, zeros)
+
+        ## licks: spontaneous ones in this block plus bouts scheduled earlier
+        for onset in self.mouse.spontaneousLicks(n, Fs) + start:
+            self._licks.extend(self.mouse.bout(onset, Fs)[:1])
+        lick = self._renderLicks(start, n)
+
+        arduino = self.arduino
+        ## early lick during the abort window: the sketch blocks for 5 s, so no tone or reward
+        abortLicks = np.flatnonzero(lick & line('abort'))
+        if len(abortLicks) and start + abortLicks[0] >= arduino.lockedUntil:
+            arduino.aborts += 1
+            arduino.lockedUntil = start + abortLicks[0] + int(SimArduino.ABORT_LOCKOUT * Fs)
+        for name, counter in (('reward', 'rewards'), ('punish', 'punishments')):
+            hits = np.flatnonzero(lick & line(name))
+            if len(hits) and start + hits[0] >= arduino.lockedUntil:
+                setattr(arduino, counter, getattr(arduino, counter) + 1)
+                arduino.lockedUntil = start + hits[0] + int(SimArduino.REWARD_LOCKOUT * Fs)
+        arduino.squirts += int(np.sum(np.diff(np.concatenate([[self._previous('squirt')], line('squirt')]).astype(np.int8)) == 1))
+
+        ## the mouse answers tones it actually hears
+        toneOnsets = np.flatnonzero(np.diff(np.concatenate([[self._previous('tone')], line('tone')]).astype(np.int8)) == 1)
+        for onset in toneOnsets:
+            if start + onset < arduino.lockedUntil:
+                continue
+            arduino.tones += 1
+            goTrial = abs(ao.get('force_out', np.zeros(n))[onset]) > self.forceThreshold
+            if self.mouse.respond(goTrial):
+                self._licks.extend(self.mouse.bout(start + onset + int(self.mouse.responseLatency() * Fs), Fs))
+        self._previousDo = {name: row[-1] for name, row in do.items()}
+
+        ## inputs: length and force follow their commands, plus noise; the lick line is a port byte
+        for task in self._tasksOf('ai'):
+            rows = []
+            for channel in task.ai_channels:
+                command = ao.get(channel.name.replace('_in', '_out'), np.zeros(n))
+                volts = command + self.mouse.random.normal(0, self.noise, n)
+                rows.append(np.clip(np.round(volts / VOLTS_PER_COUNT), -32768, 32767))
+            task._produce(np.array(rows, dtype=np.int16))
+        for task in self._tasksOf('di'):
+            port = (lick * _lineBit(task.di_channels[0].physical_channel)).astype(np.uint8)
+            if not task.timing.changeDetection:
+                task._produce(port[np.newaxis])
+                continue
+            ## change detection: one sample per edge, and the timestamp counters latch on the same event
+            changes = np.flatnonzero(np.diff(np.concatenate([[task._lastLevel], port]).astype(np.int16)))
+            task._lastLevel = port[-1]
+            if not len(changes):
+                continue
+            for counter in self.tasks:
+                if counter.running and counter.kind == 'ci' and counter.timing.onChangeDetection:
+                    ticks = (start + changes - counter.startPosition) / Fs * _timebaseHz(counter.ci_channels[0].ci_count_edges_term)
+                    counter._produce((np.int64(ticks) % 2**32).astype(np.uint32)[np.newaxis])
+            task._produce(port[changes][np.newaxis])
+
+    def _previous(self, name):
+        return bool(self._previousDo.get(name, False)) if self._previousDo else False
+
+    def _renderLicks(self, start, n):
+        lick = np.zeros(n, dtype='bool')
+        remaining = []
+        for onset, offset in self._licks:
+            if offset > start:
+                lick[max(onset - start, 0):max(min(offset - start, n), 0)] = True
+                if offset > start + n:
+                    remaining.append((onset, offset))
+        self._licks = remaining
+        return lick
+
+
+_device = SimDevice()
+
+
+def useDevice(device):
+    """Make device the one new Tasks attach to; returns it."""
+    global _device
+    _device = device
+    return device
+
+
+def currentDevice():
+    return _device
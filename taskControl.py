@@ -0,0 +1,121 @@
+"""Messaging between the GUI and the task thread.
+
+StatusBus carries status out of the task thread: log lines, per-trial results
+and state changes are collected and delivered in batches every `interval`
+seconds, either as one window.write_event_value(key, batch) per batch or onto a
+queue, so the GUI handles a handful of events per second however chatty the
+task is. TaskControl carries commands in: pause, resume, stop after the current
+trial and parameter updates. The trial loop only acts on them at checkpoint(),
+between trials, on its own copy of the parameters -- the GUI never touches the
+dict the task thread is using.
+"""
+import queue
+import threading
+
+
+STATUS_EVENT = '-TaskStatus-'
+## set up with the daq or the session files; they cannot change in the middle of a session
+FIXED_PARAMETERS = ('Fs', 'trialDuration', 'continuous', 'downSample', 'downsampleFactor', 'causalFilter', 'save', 'savePath',
+                    'animal', 'codec', 'shuffle', 'instrument', 'seed')
+
+
+class StatusBus:
+
+    def __init__(self, window=None, key=STATUS_EVENT, interval=0.1):
+        self.window = window
+        self.key = key
+        self.interval = interval
+        self.queue = queue.Queue() ## batches end up here when there is no window
+        self._pending = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def post(self, kind, **fields):
+        fields['kind'] = kind
+        with self._lock:
+            self._pending.append(fields)
+
+    def log(self, *args):
+        ## drop-in for print in the task thread
+        self.post('log', text=' '.join(str(arg) for arg in args))
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        if self.window is not None:
+            self.window.write_event_value(self.key, batch)
+        else:
+            self.queue.put(batch)
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+
+
+class TaskControl:
+
+    def __init__(self):
+        self._commands = queue.Queue()
+        self.paused = False
+        self.stopRequested = False
+
+    ## called from the GUI thread
+    def pause(self):
+        self._commands.put(('pause', None))
+
+    def resume(self):
+        self._commands.put(('resume', None))
+
+    def stop(self):
+        ## finish the trial in progress, then end the session normally (results are still saved)
+        self._commands.put(('stop', None))
+
+    def updateParameters(self, taskParameters):
+        self._commands.put(('update', dict(taskParameters)))
+
+    ## called from the task thread
+    def checkpoint(self, taskParameters, log=print, status=None):
+        """Apply queued commands to taskParameters; blocks while paused. Returns the parameters that changed."""
+        changes = {}
+        while True:
+            try:
+                command, argument = self._commands.get(block=self.paused and not self.stopRequested)
+            except queue.Empty:
+                return changes
+            if command == 'pause' and not self.paused:
+                self.paused = True
+                log('\tPaused')
+                if status is not None:
+                    status.post('state', state='paused')
+            elif command == 'resume' and self.paused:
+                self.paused = False
+                log('\tResumed')
+                if status is not None:
+                    status.post('state', state='running')
+            elif command == 'stop':
+                self.stopRequested = True
+                self.paused = False
+                log('\tStopping after this trial')
+                if status is not None:
+                    status.post('state', state='stopping')
+            elif command == 'update':
+                updated = []
+                for key, value in argument.items():
+                    if value is None or taskParameters.get(key) == value: ## None: left blank in the GUI (e.g. the seed)
+                        continue
+                    if key in FIXED_PARAMETERS:
+                        log('\t{} cannot change during a session; keeping {}'.format(key, taskParameters.get(key)))
+                        continue
+                    taskParameters[key] = changes[key] = value
+                    updated.append(key)
+                if updated:
+                    log('\tparameters updated: {}'.format(', '.join(updated)))
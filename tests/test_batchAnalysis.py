@@ -0,0 +1,44 @@
+import compress_pickle
+import numpy as np
+import pytest
+
+import batchAnalysis
+import sessionStorage
+
+
+def legacySession(downSample, Fs=10000, toneSample=15000, lickDelay=0.25, numSamples=30000):
+    ## the layout runTask pickled before session directories: dense traces per trial, decimated by 10 with downSample
+    factor = batchAnalysis.LEGACY_DOWNSAMPLE if downSample else 1
+    di = np.zeros(numSamples // factor, dtype=bool)
+    do = np.zeros((7, numSamples // factor), dtype=bool)
+    do[0, toneSample // factor:(toneSample + 200) // factor] = True
+    di[(toneSample + int(lickDelay * Fs)) // factor:] = True
+    ao = np.zeros((2, numSamples // factor))
+    ao[1] = 20 / 53.869
+    return {'taskParameters': {'Fs': Fs, 'downSample': downSample, 'animal': 'legacy', 'varyForce': False},
+            'results': np.array(['hit']), 'di_data': {0: di}, 'do_data': {0: do}, 'ao_data': {0: ao}, 'ai_data': {0: ao}}
+
+
+@pytest.mark.parametrize('downSample', [False, True])
+def test_legacyLickLatency(tmp_path, downSample):
+    path = str(tmp_path / '20200101_120000_legacy.gz')
+    compress_pickle.dump(legacySession(downSample), path)
+    entry = batchAnalysis.analyzeSession(path)
+    assert entry['counts']['hit'] == 1
+    assert entry['medianHitLatency'] == pytest.approx(0.25)
+
+
+def writeSession(path, varyForce, forces, hits):
+    writer = sessionStorage.SessionWriter(path, {'taskParameters': {'Fs': 1000, 'animal': 'mouse', 'varyForce': varyForce}})
+    for trial, (force, hit) in enumerate(zip(forces, hits)):
+        writer.appendTrial(trial, {}, result='hit' if hit else 'miss', goTrial=True, force=force, lickLatency=0.2 if hit else None)
+    writer.close()
+
+
+def test_psychometricOnlyFromVaryForceSessions(tmp_path):
+    writeSession(str(tmp_path / '20260101_120000_mouse'), False, [20.] * 50, [True] * 50)
+    writeSession(str(tmp_path / '20260102_120000_mouse'), True, [5., 15., 15., 35.], [False, True, False, True])
+    sessions = batchAnalysis.analyzeDirectories([str(tmp_path)], cacheFile=str(tmp_path / 'cache.jsonl'), workers=1, log=lambda *args: None)
+    summary = batchAnalysis.summarizeAnimals(sessions)['mouse']
+    assert summary['sessions'] == 2 and summary['forceSessions'] == 1 and summary['trials'] == 54
+    assert summary['psychometric'] == [(0., 1, 0.), (10., 2, 0.5), (30., 1, 1.)]
@@ -0,0 +1,21 @@
+import benchmarks
+import controlPanel
+import simDaq
+
+
+def test_modesAreRebuiltOnlyForSettingsTheyUse():
+    simDaq.useDevice(simDaq.SimDevice(speed=None))
+    pool = controlPanel.DaqPool(dict(controlPanel.DEFAULT_SETTINGS), simDaq)
+    taskParameters = dict(benchmarks.SESSION_PARAMETERS, Fs=2000)
+    try:
+        monitor = pool.acquire('lickMonitor', taskParameters)
+        reward = pool.acquire('dispenseReward', taskParameters)
+        trial = pool.acquire('task', taskParameters)
+        faster = dict(taskParameters, Fs=4000)
+        assert pool.acquire('lickMonitor', faster) is monitor ## change detection does not depend on Fs
+        assert pool.acquire('dispenseReward', faster) is not reward ## the squirt pulse is clocked at Fs
+        assert pool.acquire('task', faster) is trial ## re-timed, not rebuilt
+        assert pool.configs['task'][0] == (4000, int(4000*taskParameters['trialDuration']))
+        assert pool.active == 'task'
+    finally:
+        pool.close()
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+import digitalEvents
+
+
+def randomLines(numLines, numSamples, seed):
+    rng = np.random.default_rng(seed)
+    lines = np.zeros((numLines, numSamples), dtype=bool)
+    for line in lines:
+        for start in rng.integers(0, numSamples, rng.integers(0, 6)):
+            line[start:start + rng.integers(1, 40)] = True
+    lines[0, :3] = True ## pulses touching both ends of the trace
+    lines[-1, -3:] = True
+    return lines
+
+
+@pytest.mark.parametrize('factor', [1, 2, 3, 10])
+@pytest.mark.parametrize('numSamples', [200, 203])
+def test_roundTrip(factor, numSamples):
+    for seed in range(20):
+        lines = randomLines(4, numSamples, seed)
+        events = digitalEvents.toEvents(lines)
+        assert events.dtype == np.int32 and events.shape[1] == 3
+        dense = digitalEvents.eventsToDense(events, len(lines), numSamples, factor)
+        ## every factor-th sample, like the analog channels after downsampling
+        np.testing.assert_array_equal(dense, lines[:, ::factor])
+
+
+def test_singleLineAndEmpty():
+    trace = np.array([0, 1, 1, 0, 0, 1], dtype=np.uint8)
+    np.testing.assert_array_equal(digitalEvents.toEvents(trace), [[0, 1, 3], [0, 5, 6]])
+    np.testing.assert_array_equal(digitalEvents.lineEvents(digitalEvents.toEvents(trace), 0), ([1, 5], [3, 6]))
+    empty = digitalEvents.toEvents(np.zeros((3, 50), dtype=bool))
+    assert empty.shape == (0, 3)
+    assert not digitalEvents.eventsToDense(empty, 3, 50, 10).any()
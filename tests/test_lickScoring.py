@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import lickScoring
+
+
+FORCE_TIME, TONE_START, REWARD_END, NUM_SAMPLES = 100, 300, 500, 700
+
+
+def sumScoreTrial(di_data, goTrial, abortEarlyLick):
+    ## the whole-trial scoring runTrial did before online scoring
+    if abortEarlyLick and sum(di_data[FORCE_TIME:TONE_START]) > 0:
+        return 'abort'
+    if goTrial:
+        return 'hit' if sum(di_data[TONE_START:REWARD_END]) > 0 else 'miss'
+    return 'FA' if sum(di_data[TONE_START:REWARD_END]) > 0 else 'CR'
+
+
+def onlineScore(di_data, goTrial, abortEarlyLick, chunk):
+    trial = {'goTrial': goTrial, 'forceTime_samples': FORCE_TIME, 'samplesToToneStart': TONE_START, 'samplesToRewardEnd': REWARD_END}
+    scorer = lickScoring.OnlineLickScorer(trial, 1000, abortEarlyLick)
+    for i in range(0, len(di_data), chunk):
+        scorer.update(di_data[i:i+chunk])
+    return scorer.finish(), scorer
+
+
+def lickTraces():
+    ## single licks on and next to every window edge, then random lick bouts
+    for sample in (0, FORCE_TIME - 1, FORCE_TIME, TONE_START - 1, TONE_START, REWARD_END - 1, REWARD_END, NUM_SAMPLES - 1):
+        trace = np.zeros(NUM_SAMPLES, dtype=np.uint8)
+        trace[sample] = 1
+        yield trace
+    yield np.zeros(NUM_SAMPLES, dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        yield (rng.random(NUM_SAMPLES) < rng.choice([0.001, 0.005, 0.02])).astype(np.uint8)
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 50, NUM_SAMPLES])
+@pytest.mark.parametrize('abortEarlyLick', [False, True])
+@pytest.mark.parametrize('goTrial', [False, True])
+def test_matchesWholeTrialScoring(goTrial, abortEarlyLick, chunk):
+    for trace in lickTraces():
+        result, scorer = onlineScore(trace, goTrial, abortEarlyLick, chunk)
+        assert result == sumScoreTrial(trace, goTrial, abortEarlyLick)
+        if result in ('abort', 'hit', 'FA'): ## the deciding lick is the first one in its window
+            window = (FORCE_TIME, TONE_START) if result == 'abort' else (TONE_START, REWARD_END)
+            licks = np.flatnonzero(trace[window[0]:window[1]]) + window[0]
+            assert scorer.lickSample == licks[0]
+            assert scorer.latency == pytest.approx((licks[0] - TONE_START) / 1000)
+        else:
+            assert scorer.latency is None
+
+
+def test_decidesAtResponseWindowEnd():
+    trial = {'goTrial': True, 'forceTime_samples': FORCE_TIME, 'samplesToToneStart': TONE_START, 'samplesToRewardEnd': REWARD_END}
+    scorer = lickScoring.OnlineLickScorer(trial, 1000, True)
+    scorer.update(np.zeros(REWARD_END - 1, dtype=np.uint8))
+    assert not scorer.decided
+    scorer.update(np.zeros(1, dtype=np.uint8))
+    assert scorer.result == 'miss'
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import scipy.stats
+
+import performanceMetrics
+
+
+def bruteForceRate(results, numerator, other, correction=0):
+    denominator = results.count(numerator) + results.count(other) + correction
+    return results.count(numerator) / denominator if denominator else np.nan
+
+
+def assertRate(value, expected):
+    if np.isnan(expected):
+        assert np.isnan(value)
+    else:
+        assert value == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('window', [1, 5, 20])
+def test_ratesMatchRecomputation(window):
+    rng = np.random.default_rng(window)
+    metrics = performanceMetrics.PerformanceMetrics(window=window, forceBins=performanceMetrics.FORCE_BINS)
+    results, latencies, forces = [], [], []
+    for _ in range(200):
+        result = str(rng.choice(performanceMetrics.OUTCOMES, p=[0.3, 0.2, 0.15, 0.25, 0.1]))
+        latency = float(rng.random()) if result in ('hit', 'FA', 'abort') else None
+        force = float(rng.uniform(0, 80)) if result in ('hit', 'miss') else 0.
+        metrics.update(result, latency=latency, force=force)
+        results.append(result)
+        latencies.append(latency)
+        forces.append(force)
+        recent = results[-window:]
+        assertRate(metrics.hitRate, bruteForceRate(results, 'hit', 'miss', 1))
+        assertRate(metrics.FARate, bruteForceRate(results, 'FA', 'CR', 1))
+        assertRate(metrics.windowHitRate, bruteForceRate(recent, 'hit', 'miss'))
+        assertRate(metrics.windowFARate, bruteForceRate(recent, 'FA', 'CR'))
+        assert metrics.windowFull == (len(results) >= window)
+        with np.errstate(invalid='ignore'): ## d' is nan while both rates are still 0
+            assert metrics.dprime == pytest.approx(scipy.stats.norm.ppf(metrics.hitRate) - scipy.stats.norm.ppf(metrics.FARate), nan_ok=True)
+    assert len(metrics) == len(results)
+    assert dict(zip(performanceMetrics.OUTCOMES, metrics.counts)) == {outcome: results.count(outcome) for outcome in performanceMetrics.OUTCOMES}
+    hitLatencies = [latency for result, latency in zip(results, latencies) if result == 'hit']
+    assert metrics.meanLatency('hit') == pytest.approx(np.mean(hitLatencies))
+    assert np.isnan(metrics.meanLatency('CR'))
+    ## psychometric counts: go trials binned by force (bin 0 is below the first edge)
+    edges, forceTrials, hitFractions = metrics.psychometric()
+    goForces = np.array([force for result, force in zip(results, forces) if result in ('hit', 'miss')])
+    goHits = np.array([result == 'hit' for result in results if result in ('hit', 'miss')])
+    bins = np.digitize(goForces, performanceMetrics.FORCE_BINS)
+    np.testing.assert_array_equal(forceTrials, np.bincount(bins, minlength=len(edges)))
+    np.testing.assert_array_equal(metrics.forceHits, np.bincount(bins, weights=goHits, minlength=len(edges)))
+
+
+def test_emptyMetrics():
+    metrics = performanceMetrics.PerformanceMetrics()
+    snapshot = metrics.snapshot()
+    assert snapshot['trials'] == 0 and snapshot['hitRate'] == 0
+    assert np.isnan(snapshot['windowHitRate']) and not metrics.windowFull
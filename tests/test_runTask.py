@@ -0,0 +1,98 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+import benchmarks
+import controlPanel
+import sessionStorage
+import simDaq
+
+
+## short trials so a session takes a few seconds on the simulated clock; the Arduino's lockouts outlast them
+TRIAL_PARAMETERS = dict(benchmarks.SESSION_PARAMETERS, Fs=2000, trialDuration=3., forceTime=0.5, timeToTone=0.5,
+                        forceDuration=1.5, rewardWindowDuration=1., enablePunish=True)
+
+
+def runSimulated(taskParameters, speed=10, mouseSeed=0, **mouse):
+    ## one runTask session on a fresh simulated rig; returns runTask's summary and the device. Continuous mode
+    ## needs a real-time speed, slow enough that the feeder keeps the output buffer filled on a busy machine
+    device = simDaq.useDevice(simDaq.SimDevice(speed=speed, mouse=simDaq.SimMouse(seed=mouseSeed, **mouse)))
+    tasks = controlPanel.setupDaq(dict(controlPanel.DEFAULT_SETTINGS), taskParameters,
+                                  'continuous' if taskParameters['continuous'] else 'task', backend=simDaq)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            summary = controlPanel.runTask(*tasks[:4], taskParameters, catalog=None)
+    finally:
+        for task in tasks[:4]:
+            task.close()
+    return summary, device
+
+
+def assertMatchesArduino(counts, arduino, taskParameters):
+    ## every scored hit, abort and (with punishment on) FA is one the controller acted on
+    assert (counts['hit'], counts['abort']) == (arduino.rewards, arduino.aborts)
+    assert arduino.punishments == (counts['FA'] if taskParameters['enablePunish'] else 0)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_earlyTerminationWaitsOutLockouts(tmp_path, seed):
+    taskParameters = dict(TRIAL_PARAMETERS, numTrials=15, continuous=True, earlyTermination=True, seed=seed, savePath=str(tmp_path))
+    summary, device = runSimulated(taskParameters, mouseSeed=seed, spontaneousRate=0.3)
+    counts = summary['metrics']['counts']
+    assert counts['hit'] and counts['abort']
+    assertMatchesArduino(counts, device.arduino, taskParameters)
+
+
+@pytest.mark.parametrize('continuous, earlyTermination, downSample, codec', [
+    (False, False, False, 'none'), (False, False, True, 'gzip'), (True, False, True, 'none'), (True, True, False, 'gzip')])
+def test_sessionOnSimulatedRig(tmp_path, continuous, earlyTermination, downSample, codec):
+    numTrials = 6
+    taskParameters = dict(benchmarks.SESSION_PARAMETERS, Fs=2000, numTrials=numTrials, continuous=continuous,
+                          earlyTermination=earlyTermination, downSample=downSample, codec=codec, savePath=str(tmp_path))
+    summary, device = runSimulated(taskParameters, speed=10 if continuous else None, hitProbability=0.9)
+    counts = summary['metrics']['counts']
+    assert sum(counts.values()) == numTrials
+    assertMatchesArduino(counts, device.arduino, taskParameters)
+    ## every trial that did not abort played its tone
+    assert device.arduino.tones == numTrials - counts['abort']
+
+    reader = sessionStorage.SessionReader(summary['session'])
+    header = reader.header
+    assert header['complete'] and header['numTrials'] == numTrials and header['codec'] == codec
+    assert header['taskParameters']['seed'] == taskParameters['seed'] == 0
+    assert header['counts'] == counts
+    assert set(header['channels']) == {'ai', 'di', 'ao', 'do'}
+    factor = controlPanel.downsampleFactor(taskParameters)
+    assert header['downsampleFactor'] == factor and (header['downsampleFilter'] is not None) == downSample
+    assert list(reader.results) == [trial['result'] for trial in reader.trials]
+    fullLength = int(taskParameters['Fs'] * taskParameters['trialDuration'])
+    for number, trial in enumerate(reader.trials):
+        assert trial['trial'] == number
+        numSamples = trial['numSamples']
+        ## only trials cut short at their outcome are shorter than the trial duration
+        assert numSamples == fullLength if not earlyTermination else numSamples <= fullLength
+        assert reader.trial(number, 'ai').shape == (len(header['channels']['ai']), -(-numSamples // factor))
+        assert reader.trial(number, 'ao').shape == (len(header['channels']['ao']), -(-numSamples // factor))
+        do = reader.digital(number, 'do_events', factor=1)
+        assert do.shape == (len(header['channels']['do']), numSamples)
+        assert ('ai_iti' in trial['streams']) == continuous
+    if earlyTermination:
+        assert any(trial['numSamples'] < fullLength for trial in reader.trials)
+
+
+def test_legacyRunTrialReturnsVolts():
+    taskParameters = dict(TRIAL_PARAMETERS, downSample=False, forceContinuous=True, alternate=False, goProbability=1.)
+    simDaq.useDevice(simDaq.SimDevice(speed=None, mouse=simDaq.SimMouse(seed=0)))
+    tasks = controlPanel.setupDaq(dict(controlPanel.DEFAULT_SETTINGS), taskParameters, 'task', backend=simDaq)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            ai_data, di_data, ao_data, do_data, result = controlPanel.runTrial(*tasks[:4], taskParameters)
+    finally:
+        for task in tasks[:4]:
+            task.close()
+    assert ai_data.dtype == np.float64 and ai_data.shape == ao_data.shape
+    ## the simulated force and length inputs follow their commands, plus noise
+    np.testing.assert_allclose(ai_data, ao_data, atol=0.05)
+    assert ao_data[1].max() > 0.5 ## a go trial, so the comparison covers a force command (thousands of raw counts)
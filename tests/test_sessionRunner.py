@@ -0,0 +1,28 @@
+import pytest
+
+import benchmarks
+import controlPanel
+import sessionRunner
+import sessionStorage
+import simDaq
+
+
+@pytest.mark.parametrize('continuous', [False, True])
+def test_failedSessionDoesNotBreakTheQueue(tmp_path, monkeypatch, continuous):
+    postProcessTrial = controlPanel.postProcessTrial
+    def failingPostProcess(ai_data, di_data, trial, taskParameters, *args, **kwargs):
+        if taskParameters['animal'] == 'broken' and trial['trialNumber'] == 1:
+            raise OSError('simulated failure')
+        return postProcessTrial(ai_data, di_data, trial, taskParameters, *args, **kwargs)
+    monkeypatch.setattr(controlPanel, 'postProcessTrial', failingPostProcess)
+    simDaq.useDevice(simDaq.SimDevice(speed=20, mouse=simDaq.SimMouse(seed=0)))
+    taskParameters = dict(benchmarks.SESSION_PARAMETERS, numTrials=4, Fs=2000, trialDuration=1., savePath=str(tmp_path),
+                          continuous=continuous, earlyTermination=continuous)
+    sessions = [('broken', dict(taskParameters, animal='broken')), ('next', dict(taskParameters, animal='next'))]
+    summaries = sessionRunner.runQueue(sessions, dict(controlPanel.DEFAULT_SETTINGS), simDaq, log=lambda *args: None, catalog=None)
+    assert 'simulated failure' in summaries[0]['error']
+    assert sum(summaries[1]['counts'].values()) == 4
+    ## the failed session stopped early but its header still covers the trials that were written
+    broken = sessionStorage.loadHeader(next(path for path in tmp_path.iterdir() if path.name.endswith('_broken')))
+    assert broken['complete'] and broken['numTrials'] < 4
+    assert len(sessionStorage.SessionReader(summaries[1]['session'])) == 4
@@ -0,0 +1,71 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import sessionStorage
+
+
+def makeTrials(numTrials=3, seed=0):
+    rng = np.random.default_rng(seed)
+    trials = []
+    for trial in range(numTrials):
+        numSamples = 100 + 10*trial ## trials of different lengths
+        trials.append({'ai': rng.integers(-2000, 2000, (2, numSamples)).astype(np.int16),
+                       'ao': rng.random((2, numSamples)),
+                       'di_events': np.array([[0, 5 + trial, 20 + trial]], dtype=np.int32)})
+    return trials
+
+
+def writeSession(path, trials, codec='none', shuffle=False, close=True):
+    writer = sessionStorage.SessionWriter(path, {'taskParameters': {'animal': 'test'}}, codec=codec, shuffle=shuffle)
+    for trial, arrays in enumerate(trials):
+        writer.appendTrial(trial, arrays, result='hit' if trial % 2 else 'CR')
+    if close:
+        writer.close()
+    return writer
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+@pytest.mark.parametrize('codec', sorted(sessionStorage.CODECS))
+def test_roundTrip(tmp_path, codec, shuffle):
+    trials = makeTrials()
+    writer = writeSession(str(tmp_path / 'session'), trials, codec, shuffle)
+    reader = sessionStorage.SessionReader(writer.path)
+    assert reader.header['complete'] and reader.header['numTrials'] == len(trials)
+    assert reader.mapped == (codec == 'none' and not shuffle)
+    assert list(reader.results) == ['CR', 'hit', 'CR']
+    for trial, arrays in enumerate(trials):
+        for name, data in arrays.items():
+            read = reader.trial(trial, name)
+            assert read.dtype == data.dtype
+            np.testing.assert_array_equal(read, data)
+
+
+def test_truncatedIndexLine(tmp_path):
+    ## a crash while the index line of the last trial was being written loses only that trial
+    trials = makeTrials()
+    writer = writeSession(str(tmp_path / 'session'), trials, close=False)
+    writer._index.write(json.dumps({'trial': len(trials), 'streams': {}})[:15])
+    writer._index.flush()
+    reader = sessionStorage.SessionReader(writer.path)
+    assert len(reader) == len(trials) and not reader.header['complete']
+    np.testing.assert_array_equal(reader.trial(len(trials) - 1, 'ai'), trials[-1]['ai'])
+
+
+def test_sameSecondSessionsGetDistinctDirectories(tmp_path):
+    path = str(tmp_path / '20260101_120000_mouse')
+    paths = [writeSession(path, makeTrials(1)).path for _ in range(3)]
+    assert paths == [path, path + '_1', path + '_2']
+    assert all(os.path.isfile(os.path.join(p, sessionStorage.HEADER_FILE)) for p in paths)
+
+
+def test_asyncWriterReportsErrors(tmp_path):
+    writer = sessionStorage.AsyncSessionWriter(str(tmp_path / 'session'), {})
+    writer.appendTrial(0, {'ai': np.zeros((2, 10), dtype=np.int16)})
+    writer.appendTrial(1, {'ai': np.zeros((2, 10), dtype=np.float64)}) ## stream dtype cannot change within a session
+    with pytest.raises(ValueError):
+        writer.close()
+    reader = sessionStorage.SessionReader(writer.path)
+    assert len(reader) == 1 and reader.header['complete']
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import trialSchedule
+
+
+TASK_PARAMETERS = {'Fs': 1000, 'alternate': False, 'goProbability': 0.5, 'varyForce': True, 'force': 20.,
+                   'forceTime': 1., 'forceDuration': 3., 'timeToTone': 0.5, 'varyTone': True,
+                   'rewardWindowDuration': 1., 'toneDuration': 0.02, 'numTrials': 50}
+
+
+def decisions(schedule, numTrials, **changes):
+    taskParameters = dict(TASK_PARAMETERS, **changes)
+    return [schedule.decide(taskParameters) for _ in range(numTrials)]
+
+
+def test_sameSeedSameDecisions():
+    seed = trialSchedule.newSeed()
+    assert decisions(trialSchedule.TrialSchedule(seed), 50) == decisions(trialSchedule.TrialSchedule(seed), 50)
+    assert decisions(trialSchedule.TrialSchedule(seed), 50) != decisions(trialSchedule.TrialSchedule(seed + 1), 50)
+
+
+def test_rowsStableAsTableGrows():
+    schedule = trialSchedule.TrialSchedule(1234)
+    first = schedule.draws(5).copy()
+    grown = schedule.draws(1000)
+    np.testing.assert_array_equal(grown[:5], first)
+    np.testing.assert_array_equal(trialSchedule.TrialSchedule(1234).draws(1000), grown)
+    ## decisions drawn one at a time match decisions from a table built at full length up front
+    oneByOne = trialSchedule.TrialSchedule(1234)
+    upFront = trialSchedule.TrialSchedule(1234)
+    upFront.draws(200)
+    assert decisions(oneByOne, 200) == decisions(upFront, 200)
+
+
+@pytest.mark.parametrize('alternate', [False, True])
+def test_compileMatchesDecide(alternate):
+    taskParameters = dict(TASK_PARAMETERS, alternate=alternate)
+    plan = trialSchedule.TrialSchedule(7).compile(taskParameters)
+    decided = decisions(trialSchedule.TrialSchedule(7), taskParameters['numTrials'], alternate=alternate)
+    for key, values in plan.items():
+        np.testing.assert_allclose(values, [decision[key] for decision in decided], err_msg=key)
+
+
+def test_seedIsShort():
+    seeds = [trialSchedule.newSeed() for _ in range(100)]
+    assert all(0 <= seed < 2**63 for seed in seeds) and len(set(seeds)) == len(seeds)
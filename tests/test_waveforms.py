@@ -0,0 +1,85 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import waveforms
+
+
+FLAGS = ('goTrial', 'lastTrialGo', 'forceContinuous', 'playTone', 'rewardAllGos', 'enablePunish', 'abortEarlyLick')
+
+
+def baselineBuild(taskParameters, goTrial, lastTrialGo, force_volts, forceTime_samples, forceDuration_samples,
+                  samplesToToneStart, samplesToToneEnd, samplesToRewardEnd):
+    ## the per-trial output construction runTrial used before WaveformBuilder, kept as the reference
+    numSamples = int(taskParameters['Fs']*taskParameters['trialDuration'])
+    ao_out = np.zeros([2,numSamples])
+    do_out = np.zeros([7,numSamples],dtype='bool')
+    if taskParameters['playTone']:
+      do_out[0,samplesToToneStart:samplesToToneEnd] = True ## tone
+    do_out[1,1:-1] = True ## trigger
+
+    if goTrial:
+        ao_out[1,:forceTime_samples] = np.arange(0,1,1/forceTime_samples) * force_volts
+        ao_out[1,forceTime_samples:forceTime_samples+forceDuration_samples] = force_volts
+        ao_out[1,forceTime_samples+forceDuration_samples:forceTime_samples+forceDuration_samples+forceTime_samples] = np.arange(1,0,-1/forceTime_samples) * force_volts
+
+        do_out[2,samplesToToneStart+50:samplesToRewardEnd] = True ## reward window
+        if taskParameters['rewardAllGos']:
+            do_out[3,samplesToToneStart+50:samplesToToneStart+150] = True  ## delivers reward via squirt
+    if not goTrial:
+        ao_out[1,:] = 0
+        if taskParameters['enablePunish']:
+            do_out[6,samplesToToneStart+50:samplesToRewardEnd] = True ## punish window
+
+    if  taskParameters['forceContinuous']:
+        if goTrial:
+            if not lastTrialGo:
+                ao_out[1,:forceTime_samples] = np.arange(0,1,1/forceTime_samples) * force_volts
+                ao_out[1,forceTime_samples:] = force_volts
+            else:
+                ao_out[1,:] = force_volts
+            do_out[2,samplesToToneStart:samplesToRewardEnd] = True ## reward window
+            if taskParameters['rewardAllGos']:
+                do_out[3,samplesToToneStart+50:samplesToToneStart+500] = True  ## delivers reward via squirt
+        if not goTrial:
+            if lastTrialGo:
+                ao_out[1,:forceTime_samples] = np.arange(1,0,-1/forceTime_samples) * force_volts
+                ao_out[1,forceTime_samples:] = 0
+            else:
+                ao_out[1,:] = 0
+
+    if taskParameters['abortEarlyLick']:
+        do_out[4,forceTime_samples:samplesToToneStart] = True
+
+    cameraRate = 30 # Hz
+    cameraOnsets = np.int32(np.arange(0.01,taskParameters['trialDuration'],1/cameraRate)*taskParameters['Fs'])
+    cameraOffsets = np.int32(cameraOnsets+0.005*taskParameters['Fs'])
+    for on_off in zip(cameraOnsets,cameraOffsets):
+        do_out[5,on_off[0]:on_off[1]] = True
+    return ao_out, do_out
+
+
+@pytest.mark.parametrize('Fs, trialDuration, forceTime, forceDuration, timeToTone, toneDuration, rewardWindowDuration', [
+    (20000, 7., 1., 3., 3., 0.02, 1.),
+    (2000, 3., 0.5, 1.5, 0.5, 0.02, 1.),
+    (1000, 2., 0.3, 1.2, 0.4, 0.05, 0.5),
+    (5000, 4.5, 0.75, 2., 1.25, 0.1, 1.5),
+])
+def test_matchesBaseline(Fs, trialDuration, forceTime, forceDuration, timeToTone, toneDuration, rewardWindowDuration):
+    forceTime_samples = int(forceTime * Fs)
+    forceDuration_samples = int(forceDuration * Fs)
+    samplesToToneStart = int(forceTime_samples + timeToTone * Fs)
+    samplesToToneEnd = int(samplesToToneStart + toneDuration * Fs)
+    samplesToRewardEnd = int(samplesToToneStart + rewardWindowDuration * Fs)
+    builder = waveforms.WaveformBuilder() ## one builder for all combinations, so pooled buffers are reused
+    for values in itertools.product([False, True], repeat=len(FLAGS)):
+        flags = dict(zip(FLAGS, values))
+        taskParameters = dict(flags, Fs=Fs, trialDuration=trialDuration, forceTime=forceTime)
+        arguments = (taskParameters, flags['goTrial'], flags['lastTrialGo'], 2.5, forceTime_samples, forceDuration_samples,
+                     samplesToToneStart, samplesToToneEnd, samplesToRewardEnd)
+        ao_out, do_out = builder.build(*arguments)
+        expected_ao, expected_do = baselineBuild(*arguments)
+        np.testing.assert_allclose(ao_out, expected_ao, atol=1e-9, err_msg=str(flags))
+        np.testing.assert_array_equal(do_out, expected_do, err_msg=str(flags))
+        builder.release(ao_out, do_out)
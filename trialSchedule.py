@@ -0,0 +1,118 @@
+"""Seeded trial schedules.
+
+Every random decision of a trial -- go/no-go, crutch trial, force and tone
+time -- comes from its own uniform draw, and the draws for a whole session come
+from one generator seeded once per session. Row i of the draws always belongs to
+trial i, so a seed reproduces the session and a longer session only appends
+rows.
+
+compile() turns the draws into the session's full trial list (trial type,
+force, tone time and windows in samples) in one vectorized pass; that plan is
+saved with the data. The trial loop resolves each trial with decide() against
+the parameters in force when the trial is built, so online sculpting (go
+probability forced to 0) and parameter updates from the GUI act as overrides of
+the plan, and alternation and continuous force follow the trials that actually
+ran. Either way trial i uses the same draws.
+"""
+import json
+import os
+import secrets
+
+import numpy as np
+
+import sessionStorage
+
+
+GO, CRUTCH, FORCE, TONE = range(4) ## columns of the draws
+NUM_DRAWS = 4
+SCHEDULE_FILE = 'schedule.json' ## written inside the session directory
+MN_PER_VOLT = 53.869 ## force command scaling
+CRUTCH_FORCE = 75 ## mN
+CRUTCH_PROBABILITY = 0.25 ## crutch force applies to 25% of Go trials
+FORCE_RANGE = (0.5, 50) ## mN; forces of the other varyForce trials
+
+
+def newSeed():
+    ## 63 bits: plenty of entropy for default_rng, and short enough to read off the log and type back in
+    return secrets.randbits(63)
+
+
+def resolve(draws, taskParameters, previousGo):
+    """Decisions for rows of draws (trials x NUM_DRAWS), given whether each trial follows a go trial."""
+    Fs = taskParameters['Fs']
+    numTrials = len(draws)
+    if taskParameters['alternate']:
+        goTrial = ~np.asarray(previousGo, dtype=bool)
+    else:
+        goTrial = draws[:, GO] < taskParameters['goProbability']
+    if taskParameters['varyForce']:
+        crutch = draws[:, CRUTCH] < CRUTCH_PROBABILITY
+        low, high = taskParameters.get('forceRange', FORCE_RANGE)
+        force = np.where(crutch, taskParameters.get('crutchForce', CRUTCH_FORCE), draws[:, FORCE]*(high-low) + low)
+    else:
+        crutch = np.zeros(numTrials, dtype=bool)
+        force = np.full(numTrials, float(taskParameters['force']))
+    forceTime_samples = int(taskParameters['forceTime'] * Fs)
+    if taskParameters['varyTone']:
+        low = taskParameters['forceTime'] + taskParameters['timeToTone']
+        high = taskParameters['forceTime'] + taskParameters['forceDuration'] - taskParameters['rewardWindowDuration']
+        samplesToToneStart = ((draws[:, TONE]*(high-low) + low) * Fs).astype(np.int64)
+    else:
+        samplesToToneStart = np.full(numTrials, int(forceTime_samples + taskParameters['timeToTone'] * Fs), dtype=np.int64)
+    force_volts = force / MN_PER_VOLT
+    return {'goTrial': goTrial, 'previousGo': np.asarray(previousGo, dtype=bool), 'crutch': crutch & goTrial,
+            'force_volts': force_volts, 'force': np.where(goTrial, force_volts*MN_PER_VOLT, 0.),
+            'samplesToToneStart': samplesToToneStart,
+            'samplesToToneEnd': (samplesToToneStart + taskParameters['toneDuration'] * Fs).astype(np.int64),
+            'samplesToRewardEnd': (samplesToToneStart + taskParameters['rewardWindowDuration'] * Fs).astype(np.int64)}
+
+
+class TrialSchedule:
+
+    def __init__(self, seed=None):
+        self.seed = newSeed() if seed is None else int(seed)
+        self._draws = np.empty((0, NUM_DRAWS))
+        self.previousGo = False ## type of the last trial built; alternation and continuous force follow it
+        self.position = 0 ## trial built next when decide() is not given a trial number
+
+    def draws(self, numTrials):
+        if numTrials > len(self._draws):
+            ## the generator fills rows in order, so regenerating a longer table keeps the rows already handed out
+            self._draws = np.random.default_rng(self.seed).random((max(numTrials, 2*len(self._draws)), NUM_DRAWS))
+        return self._draws[:numTrials]
+
+    def compile(self, taskParameters, numTrials=None):
+        """The whole session as planned under taskParameters: {field: array over trials}."""
+        numTrials = taskParameters['numTrials'] if numTrials is None else numTrials
+        draws = self.draws(numTrials)
+        if taskParameters['alternate']:
+            previousGo = np.arange(numTrials) % 2 == 1 ## the first trial follows a no-go
+        else:
+            goTrial = draws[:, GO] < taskParameters['goProbability']
+            previousGo = np.concatenate([[False], goTrial[:-1]])
+        return resolve(draws, taskParameters, previousGo)
+
+    def decide(self, taskParameters, trialNumber=None):
+        """One trial's decisions under the parameters as they are now; the trial becomes previousGo for the next."""
+        if trialNumber is None:
+            trialNumber = self.position
+        row = self.draws(trialNumber + 1)[trialNumber:trialNumber + 1]
+        decision = {key: value[0].item() for key, value in resolve(row, taskParameters, [self.previousGo]).items()}
+        decision['trialNumber'] = trialNumber
+        self.previousGo = decision['goTrial']
+        self.position = trialNumber + 1
+        return decision
+
+
+def save(path, schedule, taskParameters):
+    sessionStorage._writeJsonAtomic(os.path.join(path, SCHEDULE_FILE),
+                                    {'seed': schedule.seed, 'numTrials': taskParameters['numTrials'],
+                                     'trials': schedule.compile(taskParameters)})
+
+
+def load(path):
+    """The plan saved with a session: {'seed', 'numTrials', 'trials': {field: array}}."""
+    with open(os.path.join(sessionStorage.sessionPath(path) or path, SCHEDULE_FILE), 'r') as f:
+        saved = json.load(f)
+    saved['trials'] = {key: np.asarray(values) for key, values in saved['trials'].items()}
+    return saved
@@ -0,0 +1,111 @@
+"""Trial output waveforms.
+
+WaveformBuilder keeps everything that only depends on the session parameters
+(camera pulse train, trigger line, force ramps) precomputed, and assembles each
+trial's ao_out/do_out with slice writes into a pool of reused buffers. The cache
+is rebuilt whenever any of the parameters it depends on changes.
+"""
+import threading
+
+import numpy as np
+
+
+CAMERA_RATE = 30 # Hz
+CAMERA_PULSE = 0.005 # s
+CAMERA_DELAY = 0.01 # s
+CACHE_KEYS = ('Fs', 'trialDuration', 'forceTime')
+
+## do_out line order, matching the DO channels added in setupDaq
+TONE, TRIGGER, REWARD, SQUIRT, ABORT, CAMERA, PUNISH = range(7)
+NUM_DO_LINES = 7
+EVENT_LINES = (TONE, REWARD, SQUIRT, ABORT, PUNISH) ## the trial's stimulus and outcome windows; trigger and camera frame the recording
+NUM_AO_CHANNELS = 2
+
+
+def cameraTrain(Fs, trialDuration):
+    cameraOnsets = np.int32(np.arange(CAMERA_DELAY,trialDuration,1/CAMERA_RATE)*Fs)
+    cameraOffsets = np.int32(cameraOnsets+CAMERA_PULSE*Fs)
+    numSamples = int(Fs*trialDuration)
+    ## +1 at each onset, -1 at each offset; the running sum is high inside pulses
+    edges = np.zeros(numSamples+1, dtype=np.int32)
+    np.add.at(edges, np.minimum(cameraOnsets, numSamples), 1)
+    np.add.at(edges, np.minimum(cameraOffsets, numSamples), -1)
+    return np.cumsum(edges[:-1]) > 0
+
+
+class WaveformBuilder:
+
+    def __init__(self):
+        self.key = None
+        self._pool = []
+        self._lock = threading.Lock()
+
+    def prepare(self, taskParameters):
+        key = tuple(taskParameters[k] for k in CACHE_KEYS)
+        if key == self.key:
+            return
+        Fs = taskParameters['Fs']
+        self.numSamples = int(Fs * taskParameters['trialDuration'])
+        forceTime_samples = int(taskParameters['forceTime'] * Fs)
+        self.rampUp = np.arange(forceTime_samples) / max(forceTime_samples, 1)
+        self.rampDown = 1 - self.rampUp
+        self.trigger = np.zeros(self.numSamples, dtype='bool')
+        self.trigger[1:-1] = True ## trigger (tells the intan system when to record and the non-DO nidaq tasks when to start)
+        self.camera = cameraTrain(Fs, taskParameters['trialDuration'])
+        with self._lock:
+            self._pool = [] ## buffers of the old size are dropped
+        self.key = key
+
+    def acquire(self):
+        with self._lock:
+            if self._pool:
+                ao_out, do_out = self._pool.pop()
+                ao_out.fill(0)
+                do_out.fill(False)
+                return ao_out, do_out
+        return np.zeros([NUM_AO_CHANNELS,self.numSamples]), np.zeros([NUM_DO_LINES,self.numSamples],dtype='bool')
+
+    def release(self, ao_out, do_out):
+        ## hand a trial's buffers back once nothing reads them any more
+        with self._lock:
+            if ao_out.shape[1] == self.numSamples and do_out.shape[1] == self.numSamples:
+                self._pool.append((ao_out, do_out))
+
+    def build(self, taskParameters, goTrial, lastTrialGo, force_volts, forceTime_samples, forceDuration_samples,
+              samplesToToneStart, samplesToToneEnd, samplesToRewardEnd):
+        self.prepare(taskParameters)
+        ao_out, do_out = self.acquire()
+        force = ao_out[1]
+        rampUp, rampDown = self.rampUp[:forceTime_samples], self.rampDown[:forceTime_samples]
+        if taskParameters['playTone']:
+            do_out[TONE,samplesToToneStart:samplesToToneEnd] = True
+        do_out[TRIGGER] = self.trigger
+        do_out[CAMERA] = self.camera
+
+        if taskParameters['forceContinuous']: ## force changes at the beginning of transition trials
+            if goTrial:
+                if not lastTrialGo:
+                    np.multiply(rampUp, force_volts, out=force[:forceTime_samples])
+                    force[forceTime_samples:] = force_volts
+                else:
+                    force[:] = force_volts
+                do_out[REWARD,samplesToToneStart:samplesToRewardEnd] = True
+                if taskParameters['rewardAllGos']:
+                    do_out[SQUIRT,samplesToToneStart+50:samplesToToneStart+500] = True
+            elif lastTrialGo:
+                np.multiply(rampDown, force_volts, out=force[:forceTime_samples])
+        elif goTrial:
+            rampEnd = forceTime_samples+forceDuration_samples
+            np.multiply(rampUp, force_volts, out=force[:forceTime_samples])
+            force[forceTime_samples:rampEnd] = force_volts
+            downSamples = len(force[rampEnd:rampEnd+forceTime_samples])
+            np.multiply(rampDown[:downSamples], force_volts, out=force[rampEnd:rampEnd+downSamples])
+            do_out[REWARD,samplesToToneStart+50:samplesToRewardEnd] = True
+            if taskParameters['rewardAllGos']:
+                do_out[SQUIRT,samplesToToneStart+50:samplesToToneStart+150] = True
+
+        if not goTrial and taskParameters['enablePunish']:
+            do_out[PUNISH,samplesToToneStart+50:samplesToRewardEnd] = True
+        if taskParameters['abortEarlyLick']:
+            do_out[ABORT,forceTime_samples:samplesToToneStart] = True
+        return ao_out, do_out